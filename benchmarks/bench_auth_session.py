@@ -0,0 +1,94 @@
+"""
+Compare a burst of sign-in shaped requests sent with a new connection each
+(module level requests.post, as Auth used to) against the pooled session
+Firebase shares between its services.
+
+A local HTTPS server stands in for the identity toolkit. If the openssl
+command is not available the server falls back to plain HTTP, which still
+shows the TCP handshake savings but not the TLS ones.
+
+    python benchmarks/bench_auth_session.py [requests] [threads]
+"""
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import requests  # noqa: E402
+
+from pyrebase.pyrebase import create_session  # noqa: E402
+
+
+class SignInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'idToken': 'x' * 900, 'refreshToken': 'y' * 200, 'expiresIn': '3600'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SignInHandler)
+    scheme = 'http'
+    if shutil.which('openssl'):
+        cert = os.path.join(directory, 'cert.pem')
+        key = os.path.join(directory, 'key.pem')
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', cert],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, '{0}://127.0.0.1:{1}/verifyPassword?key=apiKey'.format(scheme, server.server_port)
+
+
+def burst(post, url, count, threads):
+    headers = {'content-type': 'application/json; charset=UTF-8'}
+    data = json.dumps({'email': 'morty@example.com', 'password': 'password', 'returnSecureToken': True})
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for _ in executor.map(lambda _: post(url, headers=headers, data=data, verify=False).json(), range(count)):
+            pass
+    return time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    warnings.filterwarnings('ignore')
+    directory = tempfile.mkdtemp()
+    try:
+        server, url = start_server(directory)
+        session = create_session({'httpPoolSize': threads})
+        for name, post in (('requests.post', requests.post), ('pooled session', session.post)):
+            elapsed = burst(post, url, count, threads)
+            print('{0:>15}: {1} sign-ins in {2:.2f}s, {3:.0f}/s'.format(name, count, elapsed, count / elapsed))
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
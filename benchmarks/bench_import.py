@@ -0,0 +1,80 @@
+"""
+Compare writing records one set() at a time with import_() against a local
+server that accepts writes like the Realtime Database REST API and
+answers a share of them with 503 to exercise retries.
+
+    python benchmarks/bench_import.py [records] [record bytes]
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pyrebase  # noqa: E402
+
+
+class WriteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    unavailable = 0.05
+
+    def write(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if random.random() < self.unavailable:
+            self.send_response(503)
+            body = b'{"error": "try again"}'
+        else:
+            json.loads(body.decode('utf-8'))
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_PATCH = write
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    record_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WriteHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    firebase = pyrebase.initialize_app({
+        'apiKey': 'apiKey',
+        'authDomain': 'bench.firebaseapp.com',
+        'databaseURL': 'http://127.0.0.1:{0}'.format(server.server_port),
+        'storageBucket': 'bench.appspot.com',
+    })
+    db = firebase.database()
+    records = [{'path': 'users/user{0}'.format(i), 'value': {'name': 'x' * record_bytes, 'n': i}}
+               for i in range(count)]
+    size = sum(len(json.dumps(record['value'])) for record in records) / 1024.0 / 1024.0
+
+    # one request per record, a sample is enough to see the rate
+    sample = records[:min(count, 1000)]
+    WriteHandler.unavailable = 0
+    start = time.perf_counter()
+    for record in sample:
+        db.child(record['path']).set(record['value'])
+    elapsed = time.perf_counter() - start
+    print('{0:>8}: {1:.0f} records/s'.format('set()', len(sample) / elapsed))
+
+    WriteHandler.unavailable = 0.05
+    stats = db.import_(iter(records), max_bytes=64 * 1024)
+    print('{0:>8}: {1:.0f} records/s, {2:.1f} MB/s ({3} requests, {4} retries, {5:.1f} MB)'.format(
+        'import_', stats['records_per_second'], stats['mb_per_second'], stats['requests'], stats['retries'], size))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
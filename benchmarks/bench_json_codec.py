@@ -0,0 +1,68 @@
+"""
+Time encoding and decoding representative Realtime Database payloads with
+each available jsonCodec, next to what Database did before codecs
+(json.dumps(...).encode("utf-8") and json.loads of the response text).
+
+orjson and ujson are skipped when not installed.
+
+    python benchmarks/bench_json_codec.py [repeats]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyrebase.pyrebase import get_codec  # noqa: E402
+
+
+def payloads():
+    user = {
+        'name': 'Mortimer "Morty" Smith',
+        'email': 'morty@example.com',
+        'age': 14,
+        'score': 1234.5,
+        'active': True,
+        'tags': ['adventure', 'school', 'portal'],
+        'address': {'street': '123 Main St', 'city': 'Seattle', 'zip': '98101'},
+        'bio': 'Ünïcödé text / with slashes ' * 4,
+    }
+    return [
+        ('single user', user, 2000),
+        ('10k users', dict(('-N{0:019d}'.format(i), dict(user, age=i)) for i in range(10000)), 2),
+        ('stream patch', {'path': '/users/-N0000000000000000001', 'data': {'score': 99, 'active': False}}, 20000),
+    ]
+
+
+def timed(function, data, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(data)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    codecs = [('before', None)]
+    for name in ('json', 'orjson', 'ujson'):
+        try:
+            codecs.append((name, get_codec(name)))
+        except ImportError:
+            print('{0} is not installed'.format(name))
+    print('{0:>14} {1:>8} {2:>12} {3:>12}'.format('payload', 'codec', 'encode', 'decode'))
+    for label, data, repeats in payloads():
+        repeats *= scale
+        encoded = json.dumps(data).encode('utf-8')
+        for name, codec in codecs:
+            if codec is None:
+                encode = timed(lambda value: json.dumps(value).encode('utf-8'), data, repeats)
+                decode = timed(lambda content: json.loads(content.decode('utf-8')), encoded, repeats)
+            else:
+                encode = timed(codec.dumps, data, repeats)
+                decode = timed(codec.loads, encoded, repeats)
+            print('{0:>14} {1:>8} {2:>10.1f}us {3:>10.1f}us'.format(label, name, encode * 1e6, decode * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Time turning a decoded order_by_child response with a million children
+into a PyreResponse: the re-sort Database.get used to do on every ordered
+query, the default which keeps the received order, and the opt-in sort in
+Firebase's order (get(sort=True)).
+
+    python benchmarks/bench_ordered_get.py [children]
+"""
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyrebase.pyrebase import build_pyre_response  # noqa: E402
+
+
+def resort(request_dict, build_query, query_key):
+    # what Database.get did for every ordered query before
+    sorted_response = sorted(request_dict.items(), key=lambda item: item[1][build_query["orderBy"]])
+    return OrderedDict(sorted_response)
+
+
+def timed(name, function, *args):
+    start = time.perf_counter()
+    function(*args)
+    print('{0:>22}: {1:.3f}s'.format(name, time.perf_counter() - start))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    # the server sends children already ordered by score
+    body = json.dumps(dict(('player{0}'.format(i), {'score': i}) for i in range(count)))
+    build_query = {'orderBy': 'score'}
+    start = time.perf_counter()
+    request_dict = json.loads(body)
+    print('{0:>22}: {1:.3f}s'.format('json decode', time.perf_counter() - start))
+    timed('re-sort (before)', resort, request_dict, build_query, 'players')
+    timed('received order', lambda: build_pyre_response(request_dict, build_query, 'players').val())
+    timed('sort=True', lambda: build_pyre_response(request_dict, build_query, 'players', True).val())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Time push ID generation: the previous generate_key, which picked each
+random character with math.floor(uniform(0, 1) * 64), against
+generate_key and generate_keys(n).
+
+    python benchmarks/bench_push_keys.py [keys]
+"""
+import math
+import os
+import sys
+import time
+from random import uniform
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyrebase.pyrebase import Database  # noqa: E402
+
+
+class PreviousGenerator:
+    def __init__(self):
+        self.last_push_time = 0
+        self.last_rand_chars = []
+
+    def generate_key(self):
+        push_chars = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+        now = int(time.time() * 1000)
+        duplicate_time = now == self.last_push_time
+        self.last_push_time = now
+        time_stamp_chars = [0] * 8
+        for i in reversed(range(0, 8)):
+            time_stamp_chars[i] = push_chars[now % 64]
+            now = int(math.floor(now / 64))
+        new_id = "".join(time_stamp_chars)
+        if not duplicate_time:
+            for i in range(0, 12):
+                self.last_rand_chars.append(int(math.floor(uniform(0, 1) * 64)))
+        else:
+            for i in range(0, 11):
+                if self.last_rand_chars[i] == 63:
+                    self.last_rand_chars[i] = 0
+                self.last_rand_chars[i] += 1
+        for i in range(0, 12):
+            new_id += push_chars[self.last_rand_chars[i]]
+        return new_id
+
+
+def timed(name, function, count):
+    start = time.perf_counter()
+    keys = function()
+    elapsed = time.perf_counter() - start
+    print('{0:>22}: {1:.0f} keys/s, {2} unique of {3}'.format(name, count / elapsed, len(set(keys)), count))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    previous = PreviousGenerator()
+    db = Database(None, 'apiKey', 'https://bench.firebaseio.com', None)
+    timed('previous generate_key', lambda: [previous.generate_key() for _ in range(count)], count)
+    timed('generate_key', lambda: [db.generate_key() for _ in range(count)], count)
+    timed('generate_keys', lambda: db.generate_keys(count), count)
+
+
+if __name__ == '__main__':
+    main()
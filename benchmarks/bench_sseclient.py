@@ -0,0 +1,71 @@
+"""
+Measure how quickly SSEClient splits and decodes events of growing size.
+
+Events are fed from memory in network sized chunks, so the numbers reflect
+parsing cost only.
+
+    python benchmarks/bench_sseclient.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sseclient import SSEClient  # noqa: E402
+
+SIZES = [100, 1000, 10000, 100000, 1000000, 10000000]
+CHUNK_SIZE = 16 * 1024
+
+
+class FakeRaw:
+    chunked = True
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+        self.raw = FakeRaw()
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), CHUNK_SIZE):
+            yield self.body[i:i + CHUNK_SIZE]
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, url, stream=False, **kwargs):
+        return FakeResponse(self.body)
+
+
+def make_event(size):
+    value = b'x' * max(0, size - 30)
+    return b'event: put\ndata: {"path": "/", "data": "' + value + b'"}\n\n'
+
+
+def bench(size):
+    event = make_event(size)
+    repeat = max(1, 10000000 // len(event))
+    client = SSEClient('http://localhost/', session=FakeSession(event * repeat), build_headers=lambda: {})
+    start = time.perf_counter()
+    for _ in range(repeat):
+        next(client)
+    elapsed = time.perf_counter() - start
+    return len(event), repeat, elapsed
+
+
+def main():
+    print('{0:>10} {1:>8} {2:>12} {3:>10}'.format('event B', 'events', 'us/event', 'MB/s'))
+    for size in SIZES:
+        length, repeat, elapsed = bench(size)
+        print('{0:>10} {1:>8} {2:>12.1f} {3:>10.1f}'.format(
+            length, repeat, elapsed / repeat * 1e6, length * repeat / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measure committed transactions per second on one counter as the number of
+concurrent writers grows, and compare with get() followed by set(), which
+is faster but loses updates.
+
+Run it against the Realtime Database emulator, started with a demo project
+so no credentials are needed:
+
+    firebase emulators:start --only database --project demo-bench
+    python benchmarks/bench_transaction.py [database url] [transactions per writer]
+
+The database url defaults to http://127.0.0.1:9000.
+"""
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pyrebase  # noqa: E402
+
+WRITERS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def increment_transactions(counter, writers, count):
+    attempts = []
+    lock = threading.Lock()
+
+    def increment(value):
+        with lock:
+            attempts.append(1)
+        return (value or 0) + 1
+
+    def write(_):
+        for _ in range(count):
+            counter.transaction(increment, max_retries=1000)
+
+    return run(write, writers), len(attempts)
+
+
+def increment_get_set(counter, writers, count):
+    def write(_):
+        for _ in range(count):
+            counter.set((counter.get().val() or 0) + 1)
+
+    return run(write, writers), None
+
+
+def run(write, writers):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(writers) as executor:
+        for _ in executor.map(write, range(writers)):
+            pass
+    return time.perf_counter() - start
+
+
+def main():
+    database_url = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:9000'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    firebase = pyrebase.initialize_app({
+        'apiKey': 'apiKey',
+        'authDomain': 'demo-bench.firebaseapp.com',
+        'databaseURL': database_url,
+        'storageBucket': 'demo-bench.appspot.com',
+        'httpPoolSize': max(WRITERS),
+    })
+    counter = firebase.database().child('bench_transaction', 'counter')
+    print('{0:>7} {1:>12} {2:>10} {3:>8} {4:>14} {5:>10}'.format(
+        'writers', 'transaction', 'tx/s', 'retries', 'get+set', 'lost'))
+    for writers in WRITERS:
+        counter.set(0)
+        elapsed, attempts = increment_transactions(counter, writers, count)
+        total = counter.get().val()
+        assert total == writers * count, total
+        counter.set(0)
+        naive_elapsed, _ = increment_get_set(counter, writers, count)
+        lost = writers * count - counter.get().val()
+        print('{0:>7} {1:>11.2f}s {2:>10.0f} {3:>8} {4:>13.2f}s {5:>10}'.format(
+            writers, elapsed, total / elapsed, attempts - total, naive_elapsed, lost))
+    counter.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""
+Asyncio counterparts of the Pyrebase services, built on aiohttp.
+
+Every method that talks to Firebase returns a coroutine, and all services
+created from one app share a single aiohttp connection pool:
+
+    firebase = pyrebase.aio.initialize_app(config)
+    db = firebase.database()
+    users = await db.child("users").get()
+"""
+import asyncio
+import json
+from collections import OrderedDict
+from random import uniform
+
+import aiohttp
+from requests.exceptions import HTTPError
+
+from sseclient.sseclient import Event, EventBuffer
+from .pyrebase import AccessTokenCache, Auth, BaseDatabase, BaseQuery, JSONCodec, RateLimiter, Storage, \
+    build_pyre_response, get_codec, raise_detailed_error, service_account_credentials
+
+
+def initialize_app(config):
+    return AsyncFirebase(config)
+
+
+class AsyncFirebase:
+    """ Firebase Interface """
+    def __init__(self, config):
+        self.api_key = config["apiKey"]
+        self.auth_domain = config["authDomain"]
+        self.database_url = config["databaseURL"]
+        self.storage_bucket = config["storageBucket"]
+        self.credentials = None
+        self.token_cache = None
+        self.requests = AsyncRequests(config.get("httpPoolSize", 100), config.get("httpKeepAlive", True))
+        self.codec = get_codec(config.get("jsonCodec"))
+        self.compress_threshold = config.get("compressRequests")
+        if config.get("serviceAccount"):
+            self.credentials = service_account_credentials(config["serviceAccount"])
+            self.token_cache = AccessTokenCache(self.credentials)
+
+    def auth(self):
+        return AsyncAuth(self.api_key, self.requests, self.credentials)
+
+    def database(self):
+        return AsyncDatabase(self.credentials, self.api_key, self.database_url, self.requests, self.token_cache,
+                             codec=self.codec, compress_threshold=self.compress_threshold)
+
+    def storage(self):
+        return AsyncStorage(self.credentials, self.storage_bucket, self.requests)
+
+    async def close(self):
+        await self.requests.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def run_many(function, args_list, max_workers=10, rate_limit=None):
+    """
+    Await function with each tuple of arguments, at most max_workers at a
+    time and starting at most rate_limit calls per second if given. Results
+    come back in input order, with the exception in place of a failed call.
+    """
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def call(args):
+        async with semaphore:
+            if limiter:
+                await asyncio.sleep(limiter.reserve())
+            try:
+                return await function(*args)
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*[call(args) for args in args_list])
+
+
+class AsyncRequests:
+    """
+    Lazily opened aiohttp session shared by the async services of one app.
+    """
+    def __init__(self, limit=100, keep_alive=True):
+        self.limit = limit
+        self.keep_alive = keep_alive
+        self.session = None
+
+    def get_session(self):
+        # aiohttp sessions have to be created while the event loop runs
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, force_close=not self.keep_alive)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        async with self.get_session().request(method, url, **kwargs) as response:
+            content = await response.read()
+            return AsyncResponse(url, response.status, response.reason, response.headers, content)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncResponse:
+    """
+    A fully read response with the parts of the requests.Response interface
+    the services rely on.
+    """
+    def __init__(self, url, status_code, reason, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise HTTPError("{0} Error: {1} for url: {2}".format(self.status_code, self.reason, self.url))
+
+
+class AsyncAuth(Auth):
+    """ Authentication Service """
+    async def post(self, request_ref, body):
+        headers = {"content-type": "application/json; charset=UTF-8"}
+        request_object = await self.requests.request("POST", request_ref, headers=headers, data=json.dumps(body))
+        raise_detailed_error(request_object)
+        return request_object.json()
+
+    async def sign_in_with_email_and_password(self, email, password):
+        self.current_user = await self.verify_password(email, password)
+        return self.current_user
+
+    async def verify_password(self, email, password):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"email": email, "password": password, "returnSecureToken": True})
+
+    async def sign_in_many(self, credentials, max_workers=10, rate_limit=None):
+        return await run_many(self.verify_password, credentials, max_workers, rate_limit)
+
+    async def sign_in_with_custom_token(self, token):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyCustomToken?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"returnSecureToken": True, "token": token})
+
+    async def refresh(self, refresh_token):
+        request_ref = "https://securetoken.googleapis.com/v1/token?key={0}".format(self.api_key)
+        request_object_json = await self.post(request_ref, {"grantType": "refresh_token", "refreshToken": refresh_token})
+        # handle weirdly formatted response
+        return {
+            "userId": request_object_json["user_id"],
+            "idToken": request_object_json["id_token"],
+            "refreshToken": request_object_json["refresh_token"]
+        }
+
+    async def refresh_many(self, refresh_tokens, max_workers=10, rate_limit=None):
+        return await run_many(self.refresh, [(refresh_token,) for refresh_token in refresh_tokens], max_workers,
+                              rate_limit)
+
+    async def get_account_info(self, id_token):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getAccountInfo?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"idToken": id_token})
+
+    async def send_email_verification(self, id_token):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"requestType": "VERIFY_EMAIL", "idToken": id_token})
+
+    async def send_password_reset_email(self, email):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"requestType": "PASSWORD_RESET", "email": email})
+
+    async def verify_password_reset_code(self, reset_code, new_password):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/resetPassword?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"oobCode": reset_code, "newPassword": new_password})
+
+    async def create_user_with_email_and_password(self, email, password):
+        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/signupNewUser?key={0}".format(self.api_key)
+        return await self.post(request_ref, {"email": email, "password": password, "returnSecureToken": True})
+
+
+class AsyncQuery(BaseQuery):
+    """ A Query whose requests are made on the running event loop. """
+    __slots__ = ()
+
+    async def get(self, token=None, json_kwargs={}, sort=False):
+        request_object = await self.database.request("GET", self.build_request_url(token), token)
+        request_dict = self.database.codec.loads(request_object.content, **json_kwargs)
+        return build_pyre_response(request_dict, self.build_query, self.key(), sort)
+
+    async def write(self, method, data, token, json_kwargs):
+        database = self.database
+        headers = {}
+        if method != "delete":
+            data = database.build_body(data, headers, json_kwargs)
+        request_object = await database.request(method.upper(), self.build_write_url(token), token, data, headers)
+        return database.codec.loads(request_object.content)
+
+    async def transaction(self, update_function, token=None, max_retries=25, json_kwargs={}):
+        database = self.database
+        codec = database.codec
+        request_ref = self.build_write_url(token)
+        headers = await database.build_headers_async(token)
+        headers["X-Firebase-ETag"] = "true"
+        request_object = await database.requests.request("GET", request_ref, headers=headers)
+        raise_detailed_error(request_object)
+        for attempt in range(max_retries + 1):
+            value = codec.loads(request_object.content)
+            headers = await database.build_headers_async(token)
+            headers["if-match"] = request_object.headers["ETag"]
+            data = database.build_body(update_function(value), headers, json_kwargs)
+            request_object = await database.requests.request("PUT", request_ref, headers=headers, data=data)
+            if request_object.status_code != 412:
+                break
+            # the conflict response carries the current value and its ETag
+            if attempt < max_retries:
+                await asyncio.sleep(uniform(0, min(0.25, 0.002 * 2 ** attempt)))
+        raise_detailed_error(request_object)
+        return codec.loads(request_object.content)
+
+    def stream(self, stream_handler, token=None, stream_id=None):
+        request_ref = self.build_request_url(token)
+        database = self.database
+        return AsyncStream(database.requests, request_ref, stream_handler, database.build_headers_async, stream_id,
+                           database.codec)
+
+
+class AsyncDatabase(BaseDatabase):
+    """
+    Database Service
+
+    Queries are built exactly as with Database and return AsyncQuery
+    objects, whose get(), set() and friends return coroutines.
+    """
+    query_class = AsyncQuery
+
+    async def build_headers_async(self, token=None):
+        if not token and self.credentials and not self.token_cache.fresh():
+            # refreshing the access token blocks, keep it off the event loop
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, self.build_headers, token)
+        return self.build_headers(token)
+
+    async def request(self, method, request_ref, token, data=None, extra_headers={}):
+        headers = await self.build_headers_async(token)
+        headers.update(extra_headers)
+        request_object = await self.requests.request(method, request_ref, headers=headers, data=data)
+        raise_detailed_error(request_object)
+        return request_object
+
+    async def get_many(self, queries, token=None, max_workers=10, json_kwargs={}):
+        requests = self.build_queries(queries)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def get(query):
+            async with semaphore:
+                return await query.get(token, json_kwargs)
+
+        responses = await asyncio.gather(*[get(query) for key, query in requests])
+        return OrderedDict((key, response) for (key, query), response in zip(requests, responses))
+
+    def stream(self, stream_handler, token=None, stream_id=None):
+        return self.root().stream(stream_handler, token, stream_id)
+
+
+class AsyncStream:
+    """
+    A stream read by a task on the running event loop. The handler may be a
+    plain function or a coroutine function.
+    """
+    def __init__(self, requests, url, stream_handler, build_headers, stream_id, codec=None):
+        self.requests = requests
+        self.codec = codec or JSONCodec()
+        self.url = url
+        self.stream_handler = stream_handler
+        self.build_headers = build_headers
+        self.stream_id = stream_id
+        self.last_id = None
+        self.retry = 3000
+        self.task = asyncio.ensure_future(self.start_stream())
+
+    async def start_stream(self):
+        while True:
+            try:
+                await self.read_stream()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(self.retry / 1000.0)
+
+    async def read_stream(self):
+        headers = {"Accept": "text/event-stream", "Cache-Control": "no-cache"}
+        headers.update(await self.build_headers())
+        if self.last_id:
+            headers["Last-Event-ID"] = self.last_id
+        session = self.requests.get_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+        url = self.url
+        # follow redirects by hand so the authorization header is kept
+        while True:
+            response = await session.get(url, headers=headers, allow_redirects=False, timeout=timeout)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            url = response.headers["Location"]
+            response.release()
+        try:
+            if response.status >= 400:
+                raise HTTPError("{0} Error: {1} for url: {2}".format(response.status, response.reason, url))
+            buffer = EventBuffer()
+            async for chunk in response.content.iter_any():
+                buffer.feed(chunk)
+                raw = buffer.next_event()
+                while raw is not None:
+                    if not await self.handle_event(Event.parse(raw)):
+                        return
+                    raw = buffer.next_event()
+        finally:
+            response.release()
+
+    async def handle_event(self, msg):
+        """ Pass an event to the handler, return False to reconnect. """
+        if msg.data == "credential is no longer valid":
+            return False
+        if msg.retry:
+            self.retry = msg.retry
+        if msg.id:
+            self.last_id = msg.id
+        if msg.data == "null":
+            return True
+        msg_data = self.codec.loads(msg.data)
+        msg_data["event"] = msg.event
+        if self.stream_id:
+            msg_data["stream_id"] = self.stream_id
+        result = self.stream_handler(msg_data)
+        if asyncio.iscoroutine(result):
+            await result
+        return True
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        return self
+
+
+class AsyncStorage(Storage):
+    """ Storage Service """
+    def put(self, file, token=None):
+        # reset path
+        path = self.path
+        self.path = None
+        return self._put(path, file, token)
+
+    async def _put(self, path, file, token):
+        request_ref = self.storage_bucket + "/o?name={0}".format(path)
+        if self.credentials and not token:
+            blob = self.bucket.blob(path)
+            loop = asyncio.get_event_loop()
+            if isinstance(file, str):
+                return await loop.run_in_executor(None, lambda: blob.upload_from_filename(filename=file))
+            return await loop.run_in_executor(None, lambda: blob.upload_from_file(file_obj=file))
+        if isinstance(file, str):
+            with open(file, 'rb') as file_object:
+                data = file_object.read()
+        else:
+            data = file.read()
+        headers = {"Authorization": "Firebase " + token} if token else {}
+        request_object = await self.requests.request("POST", request_ref, headers=headers, data=data)
+        raise_detailed_error(request_object)
+        return request_object.json()
+
+    def download(self, filename, token=None):
+        # remove leading backlash
+        path = self.path
+        url = self.get_url(token)
+        if path.startswith('/'):
+            path = path[1:]
+        return self._download(path, url, filename)
+
+    async def _download(self, path, url, filename):
+        loop = asyncio.get_event_loop()
+        if self.credentials:
+            blob = self.bucket.get_blob(path)
+            await loop.run_in_executor(None, blob.download_to_filename, filename)
+            return
+        async with self.requests.get_session().get(url) as response:
+            if response.status == 200:
+                with open(filename, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        f.write(chunk)
+
+    async def delete(self, name):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.bucket.delete_blob, name)
+
+    async def list_files(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: list(self.bucket.list_blobs()))
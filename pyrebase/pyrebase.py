@@ -3,20 +3,34 @@ from requests import Session
 from requests.exceptions import HTTPError
 
 try:
-    from urllib.parse import urlencode, quote
+    from urllib.parse import urlencode, quote, urlsplit
 except:
     from urllib import urlencode, quote
+    from urlparse import urlsplit
+import asyncio
+import binascii
+import bisect
+import gzip
+import io
 import json
-import math
+import os
+import re
 from random import uniform
 import time
-from collections import OrderedDict
-from sseclient import SSEClient
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from sseclient import SSEClient, IncompleteEvent
+from sseclient.sseclient import Event, EventBuffer
 import threading
 import socket
+import sqlite3
+import ssl
+import zlib
+import httplib2
 from oauth2client.service_account import ServiceAccountCredentials
 from gcloud import storage
 from requests.packages.urllib3.contrib.appengine import is_appengine_sandbox
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
 from requests_toolbelt.adapters import appengine
 
 import python_jwt as jwt
@@ -28,6 +42,163 @@ def initialize_app(config):
     return Firebase(config)
 
 
+def create_session(config, transport=None):
+    """
+    Build the pooled session every service of an app sends its requests
+    through, mounting transport, or the one create_transport builds from
+    config, and honouring the optional httpKeepAlive config key.
+    """
+    session = requests.Session()
+    if transport is None:
+        transport = create_transport(config)
+    for scheme in ('http://', 'https://'):
+        session.mount(scheme, transport)
+    if not config.get("httpKeepAlive", True):
+        session.headers["Connection"] = "close"
+    return session
+
+
+def create_transport(config):
+    """
+    Build the transport adapter of an app, configured by the optional
+    httpPoolSize, httpRetries, httpRateLimit and httpCircuitBreaker config
+    keys.
+    """
+    pool_size = config.get("httpPoolSize", 10)
+    retries = config.get("httpRetries", 3)
+    if is_appengine_sandbox():
+        # Fix error in standard GAE environment
+        # is releated to https://github.com/kennethreitz/requests/issues/3187
+        # ProtocolError('Connection aborted.', error(13, 'Permission denied'))
+        adapter = appengine.AppEngineAdapter(max_retries=retries)
+    else:
+        retry_policy = retries if isinstance(retries, RetryPolicy) else RetryPolicy(retries)
+        rate_limiter = config.get("httpRateLimit")
+        if rate_limiter is not None and not isinstance(rate_limiter, RateLimiter):
+            rate_limiter = RateLimiter(rate_limiter)
+        circuit_breaker = config.get("httpCircuitBreaker")
+        if circuit_breaker is True:
+            circuit_breaker = CircuitBreaker()
+        elif circuit_breaker and not isinstance(circuit_breaker, CircuitBreaker):
+            circuit_breaker = CircuitBreaker(circuit_breaker)
+        adapter = RetryingAdapter(retry_policy, rate_limiter, circuit_breaker or None, pool_maxsize=pool_size)
+    return adapter
+
+
+def get_codec(codec):
+    """ The codec for the jsonCodec config value: a name or an object with dumps and loads. """
+    if codec is None or codec == "json":
+        return JSONCodec()
+    if codec == "orjson":
+        return OrjsonCodec()
+    if codec == "ujson":
+        return UjsonCodec()
+    if isinstance(codec, str):
+        raise ValueError("Unknown jsonCodec: {0}".format(codec))
+    return codec
+
+
+class JSONCodec:
+    """
+    Encodes database values to UTF-8 JSON bytes and decodes JSON bytes or
+    text with the json module. json_kwargs are passed to json.dumps and
+    json.loads.
+    """
+    def __init__(self):
+        self.encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def dumps(self, data, **json_kwargs):
+        if json_kwargs:
+            return json.dumps(data, **json_kwargs).encode("utf-8")
+        return self.encoder.encode(data).encode("utf-8")
+
+    def loads(self, data, **json_kwargs):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return json.loads(data, **json_kwargs)
+
+
+class OrjsonCodec(JSONCodec):
+    """ Uses orjson, falling back to the json module when given json_kwargs. """
+    def __init__(self):
+        JSONCodec.__init__(self)
+        import orjson
+        self.orjson = orjson
+
+    def dumps(self, data, **json_kwargs):
+        if json_kwargs:
+            return JSONCodec.dumps(self, data, **json_kwargs)
+        # json.dumps turns int and float keys into strings, keep doing that
+        return self.orjson.dumps(data, option=self.orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data, **json_kwargs):
+        if json_kwargs:
+            return JSONCodec.loads(self, data, **json_kwargs)
+        return self.orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    """ Uses ujson, falling back to the json module when given json_kwargs. """
+    def __init__(self):
+        JSONCodec.__init__(self)
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, data, **json_kwargs):
+        if json_kwargs:
+            return JSONCodec.dumps(self, data, **json_kwargs)
+        return self.ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+    def loads(self, data, **json_kwargs):
+        if json_kwargs:
+            return JSONCodec.loads(self, data, **json_kwargs)
+        return self.ujson.loads(data)
+
+
+def iter_json(data, chunk_size=64 * 1024, **json_kwargs):
+    """
+    Serialize data to UTF-8 JSON in chunks of about chunk_size bytes, so a
+    large document can be written without building the whole string.
+    """
+    encoder = json.JSONEncoder(separators=(",", ":"), **json_kwargs)
+    parts = []
+    size = 0
+    for part in encoder.iterencode(data):
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(parts).encode("utf-8")
+            parts = []
+            size = 0
+    if parts:
+        yield "".join(parts).encode("utf-8")
+
+
+def gzip_chunks(chunks, level=6):
+    """ Gzip an iterator of bytes chunk by chunk. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def service_account_credentials(service_account):
+    scopes = [
+        'https://www.googleapis.com/auth/firebase.database',
+        'https://www.googleapis.com/auth/userinfo.email',
+        "https://www.googleapis.com/auth/cloud-platform"
+    ]
+    service_account_type = type(service_account)
+    if service_account_type is str:
+        return ServiceAccountCredentials.from_json_keyfile_name(service_account, scopes)
+    if service_account_type is dict:
+        return ServiceAccountCredentials.from_json_keyfile_dict(service_account, scopes)
+
+
 class Firebase:
     """ Firebase Interface """
     def __init__(self, config):
@@ -36,38 +207,31 @@ class Firebase:
         self.database_url = config["databaseURL"]
         self.storage_bucket = config["storageBucket"]
         self.credentials = None
-        self.requests = requests.Session()
+        self.token_cache = None
+        self.transport = create_transport(config)
+        self.requests = create_session(config, self.transport)
+        self.codec = get_codec(config.get("jsonCodec"))
+        self.compress_threshold = config.get("compressRequests")
+        self._stream_manager = None
         if config.get("serviceAccount"):
-            scopes = [
-                'https://www.googleapis.com/auth/firebase.database',
-                'https://www.googleapis.com/auth/userinfo.email',
-                "https://www.googleapis.com/auth/cloud-platform"
-            ]
-            service_account_type = type(config["serviceAccount"])
-            if service_account_type is str:
-                self.credentials = ServiceAccountCredentials.from_json_keyfile_name(config["serviceAccount"], scopes)
-            if service_account_type is dict:
-                self.credentials = ServiceAccountCredentials.from_json_keyfile_dict(config["serviceAccount"], scopes)
-        if is_appengine_sandbox():
-            # Fix error in standard GAE environment
-            # is releated to https://github.com/kennethreitz/requests/issues/3187
-            # ProtocolError('Connection aborted.', error(13, 'Permission denied'))
-            adapter = appengine.AppEngineAdapter(max_retries=3)
-        else:
-            adapter = requests.adapters.HTTPAdapter(max_retries=3)
-
-        for scheme in ('http://', 'https://'):
-            self.requests.mount(scheme, adapter)
+            self.credentials = service_account_credentials(config["serviceAccount"])
+            self.token_cache = AccessTokenCache(self.credentials)
 
     def auth(self):
         return Auth(self.api_key, self.requests, self.credentials)
 
-    def database(self):
-        return Database(self.credentials, self.api_key, self.database_url, self.requests)
+    def database(self, cache=None, journal=None):
+        return Database(self.credentials, self.api_key, self.database_url, self.requests, self.token_cache, cache,
+                        self.codec, self.compress_threshold, journal)
 
     def storage(self):
         return Storage(self.credentials, self.storage_bucket, self.requests)
 
+    def stream_manager(self, max_workers=8):
+        if self._stream_manager is None:
+            self._stream_manager = StreamManager(max_workers)
+        return self._stream_manager
+
 
 class Auth:
     """ Authentication Service """
@@ -76,35 +240,57 @@ class Auth:
         self.current_user = None
         self.requests = requests
         self.credentials = credentials
+        self.private_key = None
 
     def sign_in_with_email_and_password(self, email, password):
+        self.current_user = self.verify_password(email, password)
+        return self.current_user
+
+    def verify_password(self, email, password):
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"email": email, "password": password, "returnSecureToken": True})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
-        self.current_user = request_object.json()
         return request_object.json()
 
+    def sign_in_many(self, credentials, max_workers=10, rate_limit=None):
+        """
+        Sign in each (email, password) pair concurrently, see run_many.
+        current_user is left untouched.
+        """
+        return run_many(self.verify_password, credentials, max_workers, rate_limit)
+
+    def get_private_key(self):
+        # parsing the key costs about as much as signing, so do it once
+        if self.private_key is None:
+            self.private_key = RSA.importKey(self.credentials._private_key_pkcs8_pem)
+        return self.private_key
+
     def create_custom_token(self, uid, additional_claims=None):
+        return generate_custom_token(self.credentials.service_account_email, self.get_private_key(), uid,
+                                     additional_claims)
+
+    def create_custom_tokens(self, uids, additional_claims=None, processes=None):
+        """
+        Create a custom token for each uid, in order. With processes set the
+        signing is spread over a pool of that many processes.
+        """
+        if not processes:
+            return [self.create_custom_token(uid, additional_claims) for uid in uids]
+        uids = list(uids)
+        count = len(uids)
         service_account_email = self.credentials.service_account_email
-        private_key = RSA.importKey(self.credentials._private_key_pkcs8_pem)
-        payload = {
-            "iss": service_account_email,
-            "sub": service_account_email,
-            "aud": "https://identitytoolkit.googleapis.com/google.identity.identitytoolkit.v1.IdentityToolkit",
-            "uid": uid
-        }
-        if additional_claims:
-            payload["claims"] = additional_claims
-        exp = datetime.timedelta(minutes=60)
-        return jwt.generate_jwt(payload, private_key, "RS256", exp)
+        private_key_pem = self.credentials._private_key_pkcs8_pem
+        with ProcessPoolExecutor(processes) as executor:
+            return list(executor.map(sign_custom_token, [service_account_email] * count, [private_key_pem] * count,
+                                     uids, [additional_claims] * count, chunksize=max(1, count // (processes * 4))))
 
     def sign_in_with_custom_token(self, token):
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyCustomToken?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"returnSecureToken": True, "token": token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         return request_object.json()
 
@@ -112,7 +298,7 @@ class Auth:
         request_ref = "https://securetoken.googleapis.com/v1/token?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"grantType": "refresh_token", "refreshToken": refresh_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         request_object_json = request_object.json()
         # handle weirdly formatted response
@@ -123,11 +309,15 @@ class Auth:
         }
         return user
 
+    def refresh_many(self, refresh_tokens, max_workers=10, rate_limit=None):
+        """ Refresh each token concurrently, see run_many. """
+        return run_many(self.refresh, [(refresh_token,) for refresh_token in refresh_tokens], max_workers, rate_limit)
+
     def get_account_info(self, id_token):
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getAccountInfo?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"idToken": id_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         return request_object.json()
 
@@ -135,7 +325,7 @@ class Auth:
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"requestType": "VERIFY_EMAIL", "idToken": id_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         return request_object.json()
 
@@ -143,7 +333,7 @@ class Auth:
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"requestType": "PASSWORD_RESET", "email": email})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         return request_object.json()
 
@@ -151,7 +341,7 @@ class Auth:
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/resetPassword?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"oobCode": reset_code, "newPassword": new_password})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         return request_object.json()
 
@@ -159,167 +349,411 @@ class Auth:
         request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/signupNewUser?key={0}".format(self.api_key)
         headers = {"content-type": "application/json; charset=UTF-8" }
         data = json.dumps({"email": email, "password": password, "returnSecureToken": True})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.requests.post(request_ref, headers=headers, data=data)
         raise_detailed_error(request_object)
         return request_object.json()
 
 
-class Database:
-    """ Database Service """
-    def __init__(self, credentials, api_key, database_url, requests):
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+# every pair of push characters, indexed by their 12 bit value
+PUSH_PAIRS = [first + second for first in PUSH_CHARS for second in PUSH_CHARS]
+# the 12 random characters of a push ID hold a 72 bit number
+PUSH_RANDOM_LIMIT = 64 ** 12
 
-        if not database_url.endswith('/'):
-            url = ''.join([database_url, '/'])
-        else:
-            url = database_url
 
-        self.credentials = credentials
-        self.api_key = api_key
-        self.database_url = url
-        self.requests = requests
+def encode_push_chars(number, length):
+    """ number as length push characters, most significant first. """
+    pairs = []
+    for shift in range(6 * (length - 2), -1, -12):
+        pairs.append(PUSH_PAIRS[(number >> shift) & 4095])
+    return "".join(pairs)
 
-        self.path = ""
-        self.build_query = {}
-        self.last_push_time = 0
-        self.last_rand_chars = []
+
+class BaseQuery:
+    """
+    A database path and query parameters. Queries are immutable: builder
+    methods return a new query, so they can be kept and used from any thread.
+    Requests are made by the subclasses, Query and the async client's
+    AsyncQuery.
+    """
+    __slots__ = ("database", "path", "params")
+
+    def __init__(self, database, path="", params=()):
+        object.__setattr__(self, "database", database)
+        object.__setattr__(self, "path", path)
+        # (name, value) pairs in the order they were first set
+        object.__setattr__(self, "params", params)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Query objects are immutable")
+
+    def __eq__(self, other):
+        return (isinstance(other, BaseQuery) and self.database is other.database and
+                self.path == other.path and self.params == other.params)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.database), self.path, self.params))
+
+    def __repr__(self):
+        return "<{0} {1!r} {2!r}>".format(type(self).__name__, self.path, dict(self.params))
+
+    @property
+    def build_query(self):
+        return dict(self.params)
+
+    def with_param(self, name, value):
+        params = tuple((key, value if key == name else current) for key, current in self.params)
+        if name not in dict(self.params):
+            params += ((name, value),)
+        return type(self)(self.database, self.path, params)
 
     def order_by_key(self):
-        self.build_query["orderBy"] = "$key"
-        return self
+        return self.with_param("orderBy", "$key")
 
     def order_by_value(self):
-        self.build_query["orderBy"] = "$value"
-        return self
+        return self.with_param("orderBy", "$value")
 
     def order_by_child(self, order):
-        self.build_query["orderBy"] = order
-        return self
+        return self.with_param("orderBy", order)
 
     def start_at(self, start):
-        self.build_query["startAt"] = start
-        return self
+        return self.with_param("startAt", start)
 
     def end_at(self, end):
-        self.build_query["endAt"] = end
-        return self
+        return self.with_param("endAt", end)
 
     def equal_to(self, equal):
-        self.build_query["equalTo"] = equal
-        return self
+        return self.with_param("equalTo", equal)
 
     def limit_to_first(self, limit_first):
-        self.build_query["limitToFirst"] = limit_first
-        return self
+        return self.with_param("limitToFirst", limit_first)
 
     def limit_to_last(self, limit_last):
-        self.build_query["limitToLast"] = limit_last
-        return self
+        return self.with_param("limitToLast", limit_last)
 
     def shallow(self):
-        self.build_query["shallow"] = True
-        return self
+        return self.with_param("shallow", True)
 
     def child(self, *args):
         new_path = "/".join([str(arg) for arg in args])
         if self.path:
-            self.path += "/{}".format(new_path)
+            path = "{0}/{1}".format(self.path, new_path)
+        elif new_path.startswith("/"):
+            path = new_path[1:]
         else:
-            if new_path.startswith("/"):
-                new_path = new_path[1:]
-            self.path = new_path
-        return self
+            path = new_path
+        return type(self)(self.database, path, self.params)
+
+    def key(self):
+        return self.path.split("/")[-1]
 
     def build_request_url(self, token):
         parameters = {}
         if token:
             parameters['auth'] = token
-        for param in list(self.build_query):
-            if type(self.build_query[param]) is str:
-                parameters[param] = quote('"' + self.build_query[param] + '"')
-            elif type(self.build_query[param]) is bool:
-                parameters[param] = "true" if self.build_query[param] else "false"
+        for param, value in self.params:
+            if type(value) is str:
+                parameters[param] = quote('"' + value + '"')
             else:
-                parameters[param] = self.build_query[param]
-        # reset path and build_query for next query
-        request_ref = '{0}{1}.json?{2}'.format(self.database_url, self.path, urlencode(parameters))
-        self.path = ""
-        self.build_query = {}
-        return request_ref
+                # numbers, booleans and null are sent as JSON, so None is null rather than "None"
+                parameters[param] = json.dumps(value)
+        return '{0}{1}.json?{2}'.format(self.database.database_url, self.path, urlencode(parameters))
+
+    def build_write_url(self, token):
+        return self.database.check_token(self.database.database_url, self.path, token)
+
+    def push(self, data, token=None, json_kwargs={}):
+        return self.write("post", data, token, json_kwargs)
+
+    def set(self, data, token=None, json_kwargs={}):
+        return self.write("put", data, token, json_kwargs)
+
+    def update(self, data, token=None, json_kwargs={}):
+        return self.write("patch", data, token, json_kwargs)
+
+    def remove(self, token=None):
+        return self.write("delete", None, token, {})
+
+    def get_many(self, queries, token=None, max_workers=10, json_kwargs={}):
+        return self.database.get_many(queries, token, max_workers, json_kwargs)
+
+    def generate_key(self):
+        return self.database.generate_key()
+
+    def generate_keys(self, count):
+        return self.database.generate_keys(count)
+
+    def sort(self, origin, by_key):
+        return self.database.sort(origin, by_key)
+
+
+class Query(BaseQuery):
+    """ A query whose requests are made on the calling thread. """
+    __slots__ = ()
+
+    def get(self, token=None, json_kwargs={}, sort=False):
+        database = self.database
+        if database.cache:
+            return build_pyre_response(self.get_cached(token, json_kwargs), self.build_query, self.key(), sort)
+        request_ref = self.build_request_url(token)
+        # headers
+        headers = database.build_headers(token)
+        # do request
+        request_object = database.requests.get(request_ref, headers=headers)
+        raise_detailed_error(request_object)
+        request_dict = database.codec.loads(request_object.content, **json_kwargs)
+        return build_pyre_response(request_dict, self.build_query, self.key(), sort)
+
+    def get_cached(self, token, json_kwargs):
+        database = self.database
+        cache = database.cache
+        key = cache.key(self, token, json_kwargs)
+        entry = cache.lookup(key)
+        if entry and entry.fresh:
+            return entry.value
+        request_ref = self.build_request_url(token)
+        headers = database.build_headers(token)
+        headers["X-Firebase-ETag"] = "true"
+        if entry:
+            headers["if-none-match"] = entry.etag
+        request_object = database.requests.get(request_ref, headers=headers)
+        raise_detailed_error(request_object)
+        etag = request_object.headers.get("ETag")
+        if entry and (request_object.status_code == 304 or etag == entry.etag):
+            cache.revalidated(key, entry)
+            return entry.value
+        if entry:
+            cache.changed()
+        request_dict = database.codec.loads(request_object.content, **json_kwargs)
+        cache.store(key, self.path, request_dict, etag, len(request_object.content))
+        return request_dict
+
+    def write(self, method, data, token, json_kwargs):
+        database = self.database
+        if database.journal is not None:
+            return database.journal.write(method, self.path, data, token, json_kwargs)
+        request_ref = self.build_write_url(token)
+        headers = database.build_headers(token)
+        if method == "delete":
+            request_object = database.requests.delete(request_ref, headers=headers)
+        else:
+            data = database.build_body(data, headers, json_kwargs)
+            request_object = getattr(database.requests, method)(request_ref, headers=headers, data=data)
+        if database.cache:
+            database.cache.written(self.path)
+        raise_detailed_error(request_object)
+        return database.codec.loads(request_object.content)
+
+    def transaction(self, update_function, token=None, max_retries=25, json_kwargs={}):
+        """
+        Write update_function(current value) here if nothing else wrote the
+        location since it was read, retrying with the new value otherwise.
+        Returns the value written. Raise from update_function to abort.
+        """
+        database = self.database
+        request_ref = self.build_write_url(token)
+        headers = database.build_headers(token)
+        headers["X-Firebase-ETag"] = "true"
+        request_object = database.requests.get(request_ref, headers=headers)
+        raise_detailed_error(request_object)
+        for attempt in range(max_retries + 1):
+            value = database.codec.loads(request_object.content)
+            headers = database.build_headers(token)
+            headers["if-match"] = request_object.headers["ETag"]
+            data = database.build_body(update_function(value), headers, json_kwargs)
+            request_object = database.requests.put(request_ref, headers=headers, data=data)
+            if request_object.status_code != 412:
+                break
+            # the conflict response carries the current value and its ETag
+            if attempt < max_retries:
+                time.sleep(uniform(0, min(0.25, 0.002 * 2 ** attempt)))
+        if database.cache:
+            database.cache.written(self.path)
+        raise_detailed_error(request_object)
+        return database.codec.loads(request_object.content)
+
+    def stream(self, stream_handler, token=None, stream_id=None, lazy=False, manager=None):
+        request_ref = self.build_request_url(token)
+        build_headers = self.database.build_headers
+        if manager:
+            if lazy:
+                raise ValueError("Lazy streams can not be run by a StreamManager")
+            return manager.stream(request_ref, stream_handler, build_headers, stream_id, self.database.codec)
+        return Stream(request_ref, stream_handler, build_headers, stream_id, lazy, self.database.codec)
+
+    def iterate(self, order_by="$key", page_size=1000, cursor=None, prefetch=False, token=None, json_kwargs={}):
+        return PageIterator(self, order_by, page_size, cursor, prefetch, token, json_kwargs)
+
+    def export(self, sink, max_children=1000, max_bytes=10 * 1024 * 1024, max_workers=8, split_depth=1, token=None):
+        return Exporter(self, sink, max_children, max_bytes, max_workers, split_depth, token).run()
+
+    def import_(self, source, max_bytes=1024 * 1024, max_workers=8, progress=None, token=None):
+        return Importer(self, source, max_bytes, max_workers, progress, token).run()
+
+    def batch(self, token=None, max_operations=1000, flush_interval=None, json_kwargs={}):
+        return BatchWriter(self.database, self.path, token, max_operations, flush_interval, json_kwargs)
+
+    def write_behind(self, token=None, flush_interval=0.5, max_operations=1000, max_pending=100000, max_workers=4,
+                     block=True, json_kwargs={}):
+        return WriteBehindQueue(self.database, self.path, token, flush_interval, max_operations, max_pending,
+                                max_workers, block, json_kwargs)
+
+
+class BaseDatabase:
+    """
+    What the database services share: building queries, request headers and
+    bodies, and push IDs. query_class is the query type they make.
+    """
+    query_class = None
+
+    def __init__(self, credentials, api_key, database_url, requests, token_cache=None, cache=None, codec=None,
+                 compress_threshold=None, journal=None):
+
+        if not database_url.endswith('/'):
+            url = ''.join([database_url, '/'])
+        else:
+            url = database_url
+
+        self.credentials = credentials
+        self.api_key = api_key
+        self.database_url = url
+        self.requests = requests
+        if credentials and not token_cache:
+            token_cache = AccessTokenCache(credentials)
+        self.token_cache = token_cache
+        self.cache = cache
+        self.codec = codec or JSONCodec()
+        self.compress_threshold = compress_threshold
+        self.journal = journal
+
+        self.last_push_time = 0
+        self.last_random = 0
+        self.push_lock = threading.Lock()
+        if journal is not None:
+            journal.start(self)
+
+    def root(self):
+        return self.query_class(self)
+
+    def child(self, *args):
+        return self.root().child(*args)
+
+    def order_by_key(self):
+        return self.root().order_by_key()
+
+    def order_by_value(self):
+        return self.root().order_by_value()
+
+    def order_by_child(self, order):
+        return self.root().order_by_child(order)
+
+    def start_at(self, start):
+        return self.root().start_at(start)
+
+    def end_at(self, end):
+        return self.root().end_at(end)
+
+    def equal_to(self, equal):
+        return self.root().equal_to(equal)
+
+    def limit_to_first(self, limit_first):
+        return self.root().limit_to_first(limit_first)
+
+    def limit_to_last(self, limit_last):
+        return self.root().limit_to_last(limit_last)
+
+    def shallow(self):
+        return self.root().shallow()
 
     def build_headers(self, token=None):
         headers = {"content-type": "application/json; charset=UTF-8"}
         if not token and self.credentials:
-            access_token = self.credentials.get_access_token().access_token
+            access_token = self.token_cache.get_access_token()
             headers['Authorization'] = 'Bearer ' + access_token
         return headers
 
-    def get(self, token=None, json_kwargs={}):
-        build_query = self.build_query
-        query_key = self.path.split("/")[-1]
-        request_ref = self.build_request_url(token)
-        # headers
-        headers = self.build_headers(token)
-        # do request
-        request_object = self.requests.get(request_ref, headers=headers)
-        raise_detailed_error(request_object)
-        request_dict = request_object.json(**json_kwargs)
-
-        # if primitive or simple query return
-        if isinstance(request_dict, list):
-            return PyreResponse(convert_list_to_pyre(request_dict), query_key)
-        if not isinstance(request_dict, dict):
-            return PyreResponse(request_dict, query_key)
-        if not build_query:
-            return PyreResponse(convert_to_pyre(request_dict.items()), query_key)
-        # return keys if shallow
-        if build_query.get("shallow"):
-            return PyreResponse(request_dict.keys(), query_key)
-        # otherwise sort
-        sorted_response = None
-        if build_query.get("orderBy"):
-            if build_query["orderBy"] == "$key":
-                sorted_response = sorted(request_dict.items(), key=lambda item: item[0])
-            elif build_query["orderBy"] == "$value":
-                sorted_response = sorted(request_dict.items(), key=lambda item: item[1])
-            else:
-                sorted_response = sorted(request_dict.items(), key=lambda item: item[1][build_query["orderBy"]])
-        return PyreResponse(convert_to_pyre(sorted_response), query_key)
+    def build_body(self, data, headers, json_kwargs={}):
+        """
+        Encode data as a request body. Bytes are sent as already encoded JSON
+        and an iterator of JSON chunks as a chunked body. With
+        compress_threshold set, bodies of at least that many bytes and all
+        chunked bodies are gzipped and headers gets a Content-Encoding.
+        """
+        if isinstance(data, bytes):
+            body = data
+        elif hasattr(data, "__next__"):
+            if self.compress_threshold is None:
+                return (chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in data)
+            headers["Content-Encoding"] = "gzip"
+            return gzip_chunks(data)
+        else:
+            body = self.codec.dumps(data, **json_kwargs)
+        if self.compress_threshold is not None and len(body) >= self.compress_threshold:
+            headers["Content-Encoding"] = "gzip"
+            return gzip.compress(body, 6)
+        return body
+
+    def get(self, token=None, json_kwargs={}, sort=False):
+        return self.root().get(token, json_kwargs, sort)
+
+    def get_many(self, queries, token=None, max_workers=10, json_kwargs={}):
+        """
+        Run one GET per entry of queries on a pool of max_workers threads and
+        return a dict of path (or the entry's "key") to PyreResponse.
+
+        An entry is a Query, a path, or a dict with a "path" and query builder
+        method names mapped to their argument, e.g.
+        {"path": "users", "order_by_child": "age", "limit_to_first": 10}.
+        Builders without arguments such as "shallow" take True.
+        """
+        requests = self.build_queries(queries)
+        with ThreadPoolExecutor(max_workers) as executor:
+            responses = executor.map(lambda request: request[1].get(token, json_kwargs), requests)
+            return OrderedDict((key, response) for (key, query), response in zip(requests, responses))
+
+    def build_queries(self, queries):
+        requests = []
+        for query in queries:
+            if isinstance(query, BaseQuery):
+                requests.append((query.path, query))
+                continue
+            if not isinstance(query, dict):
+                query = {"path": query}
+            query = dict(query)
+            path = str(query.pop("path")).strip("/")
+            key = query.pop("key", path)
+            built = self.child(path)
+            for name, argument in query.items():
+                if name in ("order_by_key", "order_by_value", "shallow"):
+                    if argument:
+                        built = getattr(built, name)()
+                elif name in ("order_by_child", "start_at", "end_at", "equal_to", "limit_to_first", "limit_to_last"):
+                    built = getattr(built, name)(argument)
+                else:
+                    raise ValueError("Unknown query option: {0}".format(name))
+            requests.append((key, built))
+        return requests
 
     def push(self, data, token=None, json_kwargs={}):
-        request_ref = self.check_token(self.database_url, self.path, token)
-        self.path = ""
-        headers = self.build_headers(token)
-        request_object = self.requests.post(request_ref, headers=headers, data=json.dumps(data, **json_kwargs).encode("utf-8"))
-        raise_detailed_error(request_object)
-        return request_object.json()
+        return self.root().push(data, token, json_kwargs)
 
     def set(self, data, token=None, json_kwargs={}):
-        request_ref = self.check_token(self.database_url, self.path, token)
-        self.path = ""
-        headers = self.build_headers(token)
-        request_object = self.requests.put(request_ref, headers=headers, data=json.dumps(data, **json_kwargs).encode("utf-8"))
-        raise_detailed_error(request_object)
-        return request_object.json()
+        return self.root().set(data, token, json_kwargs)
 
     def update(self, data, token=None, json_kwargs={}):
-        request_ref = self.check_token(self.database_url, self.path, token)
-        self.path = ""
-        headers = self.build_headers(token)
-        request_object = self.requests.patch(request_ref, headers=headers, data=json.dumps(data, **json_kwargs).encode("utf-8"))
-        raise_detailed_error(request_object)
-        return request_object.json()
+        return self.root().update(data, token, json_kwargs)
 
     def remove(self, token=None):
-        request_ref = self.check_token(self.database_url, self.path, token)
-        self.path = ""
-        headers = self.build_headers(token)
-        request_object = self.requests.delete(request_ref, headers=headers)
-        raise_detailed_error(request_object)
-        return request_object.json()
+        return self.root().remove(token)
 
-    def stream(self, stream_handler, token=None, stream_id=None):
-        request_ref = self.build_request_url(token)
-        return Stream(request_ref, stream_handler, self.build_headers, stream_id)
+    def stream(self, stream_handler, token=None, stream_id=None, lazy=False, manager=None):
+        return self.root().stream(stream_handler, token, stream_id, lazy, manager)
+
+    def transaction(self, update_function, token=None, max_retries=25, json_kwargs={}):
+        return self.root().transaction(update_function, token, max_retries, json_kwargs)
 
     def check_token(self, database_url, path, token):
         if token:
@@ -328,36 +762,1163 @@ class Database:
             return '{0}{1}.json'.format(database_url, path)
 
     def generate_key(self):
-        push_chars = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
-        now = int(time.time() * 1000)
-        duplicate_time = now == self.last_push_time
-        self.last_push_time = now
-        time_stamp_chars = [0] * 8
-        for i in reversed(range(0, 8)):
-            time_stamp_chars[i] = push_chars[now % 64]
-            now = int(math.floor(now / 64))
-        new_id = "".join(time_stamp_chars)
-        if not duplicate_time:
-            for i in range(0, 12):
-                self.last_rand_chars.append(int(math.floor(uniform(0, 1) * 64)))
-        else:
-            for i in range(0, 11):
-                if self.last_rand_chars[i] == 63:
-                    self.last_rand_chars[i] = 0
-                self.last_rand_chars[i] += 1
-        for i in range(0, 12):
-            new_id += push_chars[self.last_rand_chars[i]]
-        return new_id
+        return self.generate_keys(1)[0]
+
+    def generate_keys(self, count):
+        """
+        count push IDs, each sorting after the one before, including those
+        from earlier calls and other threads using this Database.
+        """
+        with self.push_lock:
+            now = int(time.time() * 1000)
+            if now > self.last_push_time:
+                self.last_push_time = now
+                self.last_random = int(binascii.hexlify(os.urandom(9)), 16)
+            else:
+                # same millisecond, or the clock went back: count up from the last ID
+                self.last_random += 1
+            if self.last_random + count > PUSH_RANDOM_LIMIT:
+                # out of IDs for this millisecond, borrow the next one
+                self.last_push_time += 1
+                self.last_random = int(binascii.hexlify(os.urandom(9)), 16) % (PUSH_RANDOM_LIMIT - count)
+            push_time = self.last_push_time
+            first_random = self.last_random
+            self.last_random += count - 1
+        time_stamp = encode_push_chars(push_time, 8)
+        return [time_stamp + encode_push_chars(random, 12) for random in range(first_random, first_random + count)]
 
     def sort(self, origin, by_key):
         # unpack pyre objects
-        pyres = origin.each()
-        new_list = []
-        for pyre in pyres:
-            new_list.append(pyre.item)
-        # sort
-        data = sorted(dict(new_list).items(), key=lambda item: item[1][by_key])
-        return PyreResponse(convert_to_pyre(data), origin.key())
+        children = dict(pyre.item for pyre in origin.each())
+        return PyreResponse(sort_children(children, by_key), origin.key())
+
+
+class Database(BaseDatabase):
+    """
+    Database Service
+
+    The builder methods return immutable Query objects, so one Database can
+    be shared between threads and a query can be built once and reused.
+    """
+    query_class = Query
+
+    def iterate(self, order_by="$key", page_size=1000, cursor=None, prefetch=False, token=None, json_kwargs={}):
+        return self.root().iterate(order_by, page_size, cursor, prefetch, token, json_kwargs)
+
+    def export(self, sink, max_children=1000, max_bytes=10 * 1024 * 1024, max_workers=8, split_depth=1, token=None):
+        return self.root().export(sink, max_children, max_bytes, max_workers, split_depth, token)
+
+    def import_(self, source, max_bytes=1024 * 1024, max_workers=8, progress=None, token=None):
+        return self.root().import_(source, max_bytes, max_workers, progress, token)
+
+    def batch(self, token=None, max_operations=1000, flush_interval=None, json_kwargs={}):
+        return self.root().batch(token, max_operations, flush_interval, json_kwargs)
+
+    def write_behind(self, token=None, flush_interval=0.5, max_operations=1000, max_pending=100000, max_workers=4,
+                     block=True, json_kwargs={}):
+        return self.root().write_behind(token, flush_interval, max_operations, max_pending, max_workers, block,
+                                        json_kwargs)
+
+
+class PageIterator:
+    """
+    Iterates over the (key, value) children of a location in order_by order,
+    requesting page_size children at a time. With prefetch the next page is
+    requested on another thread while the current one is consumed.
+
+    cursor is the position of the last child returned: pass it to iterate()
+    to carry on after it. It is the key when ordering by "$key", otherwise a
+    [value, key] list.
+    """
+    def __init__(self, query, order_by="$key", page_size=1000, cursor=None, prefetch=False, token=None,
+                 json_kwargs={}):
+        self.query = type(query)(query.database, query.path)
+        self.order_by = order_by
+        self.page_size = page_size
+        self.cursor = cursor
+        self.prefetch = prefetch
+        self.token = token
+        self.json_kwargs = json_kwargs
+        self.children = self.iter_children()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.children)
+
+    next = __next__
+
+    def iter_children(self):
+        cursor = self.cursor
+        limit = self.page_size if cursor is None else self.page_size + 1
+        executor = ThreadPoolExecutor(1) if self.prefetch else None
+        prefetched = None
+        try:
+            while True:
+                page = prefetched.result() if prefetched else self.fetch(cursor, limit)
+                prefetched = None
+                children = [child for child in page if self.after(child, cursor)]
+                full = len(page) >= limit
+                if not children:
+                    if not full:
+                        return
+                    # more than a page of children share the cursor's value
+                    limit *= 2
+                    continue
+                cursor = self.position(children[-1])
+                limit = self.page_size + 1
+                if full and executor:
+                    prefetched = executor.submit(self.fetch, cursor, limit)
+                for child in children:
+                    self.cursor = self.position(child)
+                    yield child
+                if not full:
+                    return
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def fetch(self, cursor, limit):
+        query = self.query
+        if self.order_by == "$key":
+            query = query.order_by_key()
+            start = cursor
+        elif self.order_by == "$value":
+            query = query.order_by_value()
+            start = cursor[0] if cursor is not None else None
+        else:
+            query = query.order_by_child(self.order_by)
+            start = cursor[0] if cursor is not None else None
+        if cursor is not None and isinstance(start, (dict, list)):
+            return self.fetch_tail(query, cursor)
+        if cursor is not None:
+            query = query.start_at(start)
+        return self.read(query.limit_to_first(limit))
+
+    def fetch_tail(self, query, cursor):
+        """
+        The children after a cursor on an object value. Objects sort last and
+        can't be passed to startAt, so read longer and longer tails of the
+        location until one reaches back to the cursor.
+        """
+        limit = self.page_size + 1
+        while True:
+            children = self.read(query.limit_to_last(limit))
+            if len(children) < limit or not self.after(children[0], cursor):
+                return [child for child in children if self.after(child, cursor)]
+            limit *= 2
+
+    def read(self, query):
+        """ The (key, value) children query returns, in order. """
+        children = query.get(self.token, self.json_kwargs, sort=True).val()
+        if isinstance(children, list):
+            # integer keyed children come as an array, with null for missing keys
+            children = dict((str(index), child) for index, child in enumerate(children) if child is not None)
+            children = sort_children(children, query.build_query["orderBy"])
+        return list(children.items()) if isinstance(children, dict) else []
+
+    def position(self, child):
+        key, value = child
+        if self.order_by == "$key":
+            return key
+        if self.order_by == "$value":
+            return [value, key]
+        return [child_value(value, self.order_by), key]
+
+    def after(self, child, cursor):
+        if cursor is None:
+            return True
+        if self.order_by == "$key":
+            return firebase_key(child[0]) > firebase_key(cursor)
+        value, key = self.position(child)
+        return (firebase_value(value), firebase_key(key)) > (firebase_value(cursor[0]), firebase_key(cursor[1]))
+
+
+class Exporter:
+    """
+    Writes the data below a location as records of {"path": ..., "value": ...}
+    with paths relative to the location.
+
+    The location and the levels below it down to split_depth are listed with
+    shallow requests and split into their children. Below that a node is read
+    in one request if it has at most max_children children, otherwise in
+    ranges of max_children keys written as one record per child. A node or
+    range whose response grows past max_bytes is dropped while downloading
+    and split into its children instead, however deep it is, so no response
+    held in memory is larger than max_bytes unless a single value is. Up to
+    max_workers requests run at once and records are written as they arrive.
+
+    sink is a file name, a file object, or a function called with each path
+    and value. Records are written to files as newline delimited JSON, and
+    exporting to a file name that already holds records skips their paths,
+    so an interrupted export can be run again to finish it.
+    """
+    def __init__(self, query, sink, max_children=1000, max_bytes=10 * 1024 * 1024, max_workers=8, split_depth=1,
+                 token=None):
+        self.query = type(query)(query.database, query.path)
+        self.sink = sink
+        self.max_children = max_children
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.split_depth = split_depth
+        self.token = token
+        self.done = set()
+        self.records = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        """ Export everything, returns the number of records and requests. """
+        codec = self.query.database.codec
+        if isinstance(self.sink, str):
+            self.done = resume_ndjson(self.sink, codec)
+            with open(self.sink, "ab") as sink:
+                self.export(lambda path, value: write_record(sink, path, value, codec))
+        elif hasattr(self.sink, "write"):
+            self.export(lambda path, value: write_record(self.sink, path, value, codec))
+        else:
+            self.export(self.sink)
+        return {"records": self.records, "requests": self.requests}
+
+    def export(self, write):
+        pending = deque([(self.visit, "", 0)])
+        running = set()
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            while pending or running:
+                # keep a bounded number of requests queued on the pool
+                while pending and len(running) < self.max_workers * 2:
+                    task = pending.popleft()
+                    running.add(executor.submit(*task))
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    kind, path, value, depth = future.result()
+                    if kind == "value":
+                        self.write(write, path, value)
+                    elif kind == "children":
+                        for key, child in value.items():
+                            self.write(write, join_path(path, key), child)
+                    elif kind == "split":
+                        for key, child in value.items():
+                            child_path = join_path(path, key)
+                            if child is not True:
+                                # shallow listings include values that aren't objects
+                                self.write(write, child_path, child)
+                            elif child_path not in self.done:
+                                pending.append((self.visit, child_path, depth + 1))
+                    else:
+                        keys = sorted(value, key=firebase_key)
+                        for start in range(0, len(keys), self.max_children):
+                            chunk = keys[start:start + self.max_children]
+                            if any(join_path(path, key) not in self.done for key in chunk):
+                                children = OrderedDict((key, value[key]) for key in chunk)
+                                pending.append((self.read_range, path, children, depth))
+
+    def write(self, write, path, value):
+        if path not in self.done and value is not None:
+            write(path, value)
+            self.records += 1
+
+    def visit(self, path, depth):
+        """ Read the node at path, or list its children if it is too big. """
+        query = self.query.child(path) if path else self.query
+        children = self.request(query.shallow())
+        if not isinstance(children, dict):
+            return "value", path, children, depth
+        if depth < self.split_depth:
+            return "split", path, children, depth
+        if all(child is not True for child in children.values()):
+            return "value", path, children, depth
+        if len(children) > self.max_children:
+            return "ranges", path, children, depth
+        content = self.read(query, self.max_bytes)
+        if content is None:
+            return "split", path, children, depth
+        return "value", path, query.database.codec.loads(content), depth
+
+    def read_range(self, path, children, depth):
+        """ Read the children listed in children, or split them if they are too big. """
+        query = self.query.child(path) if path else self.query
+        keys = list(children)
+        content = self.read(query.order_by_key().start_at(keys[0]).end_at(keys[-1]), self.max_bytes)
+        if content is None:
+            return "split", path, children, depth
+        return "children", path, query.database.codec.loads(content), depth
+
+    def request(self, query):
+        return query.database.codec.loads(self.read(query))
+
+    def read(self, query, max_bytes=None):
+        """ The response body for query, or None once it grows past max_bytes. """
+        database = query.database
+        request_object = database.requests.get(query.build_request_url(self.token),
+                                               headers=database.build_headers(self.token), stream=True)
+        with self.lock:
+            self.requests += 1
+        try:
+            raise_detailed_error(request_object)
+            chunks = []
+            size = 0
+            for chunk in request_object.iter_content(64 * 1024):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    return None
+                chunks.append(chunk)
+            return b"".join(chunks)
+        finally:
+            request_object.close()
+
+
+class Importer:
+    """
+    Writes records of {"path": ..., "value": ...}, with paths relative to the
+    location, as multi-location updates of up to max_bytes each, sending up
+    to max_workers at once. Reading the source waits while that many are in
+    flight. Failed updates are retried by the app's transport as its
+    httpRetries policy allows, and counted in retries.
+
+    source is a file name or file object of newline delimited JSON, as
+    written by export(), or an iterable of record dicts. progress, if given,
+    is called with the stats after every update.
+    """
+    def __init__(self, query, source, max_bytes=1024 * 1024, max_workers=8, progress=None, token=None):
+        self.query = type(query)(query.database, query.path)
+        self.source = source
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.progress = progress
+        self.token = token
+        self.records = 0
+        self.bytes = 0
+        self.requests = 0
+        self.retries = 0
+        self.started = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        """ Import everything, returns the stats. """
+        self.started = time.time()
+        codec = self.query.database.codec
+        if isinstance(self.source, str):
+            with open(self.source, "rb") as source:
+                self.write(read_ndjson(source, codec))
+        elif hasattr(self.source, "read"):
+            self.write(read_ndjson(self.source, codec))
+        else:
+            self.write(self.source)
+        return self.stats()
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            "records": self.records,
+            "bytes": self.bytes,
+            "requests": self.requests,
+            "retries": self.retries,
+            "seconds": elapsed,
+            "records_per_second": self.records / elapsed,
+            "mb_per_second": self.bytes / elapsed / 1024 / 1024,
+        }
+
+    def write(self, records):
+        running = set()
+        # paths in the update being built and every ancestor of them
+        paths = set()
+        ancestors = set()
+        members = []
+        size = 2
+        count = 0
+        codec = self.query.database.codec
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for path, value in iter_records(records):
+                member = codec.dumps(path) + b":" + codec.dumps(value)
+                # a repeated path would be sent as a duplicate key, send it in the next update
+                conflict = (path in paths or path in ancestors or
+                            any(parent in paths for parent in iter_parents(path)))
+                if members and (conflict or size + len(member) + 1 > self.max_bytes):
+                    running.add(executor.submit(self.send, members, size, count))
+                    paths, ancestors, members, size, count = set(), set(), [], 2, 0
+                    if conflict:
+                        # an overlapping update must not overtake the ones before it
+                        running = self.wait(running, 0)
+                running = self.wait(running, self.max_workers * 2)
+                members.append(member)
+                size += len(member) + 1
+                count += 1
+                paths.add(path)
+                ancestors.update(iter_parents(path))
+            if members:
+                running.add(executor.submit(self.send, members, size, count))
+            self.wait(running, 0)
+
+    def wait(self, running, limit):
+        """ Wait until at most limit updates are running, raising any failure. """
+        while len(running) > limit:
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                if self.progress:
+                    self.progress(self.stats())
+        return running
+
+    def send(self, members, size, count):
+        database = self.query.database
+        data = b"{" + b",".join(members) + b"}"
+        request_ref = self.query.build_write_url(self.token)
+        headers = database.build_headers(self.token)
+        data = database.build_body(data, headers)
+        request_object = database.requests.patch(request_ref, headers=headers, data=data)
+        if database.cache:
+            database.cache.written(self.query.path)
+        with self.lock:
+            self.retries += transport_retries(request_object)
+        raise_detailed_error(request_object)
+        with self.lock:
+            self.records += count
+            self.bytes += size
+            self.requests += 1
+
+
+def iter_records(records):
+    """ (path, value) pairs from record dicts, splitting a record for the whole location into its children. """
+    for record in records:
+        path = record["path"].strip("/")
+        value = record["value"]
+        if path:
+            yield path, value
+        elif isinstance(value, dict):
+            for key, child in value.items():
+                yield key, child
+        elif value is not None:
+            raise ValueError("Only objects can be imported at the location itself")
+
+
+def iter_parents(path):
+    segments = path.split("/")
+    for i in range(1, len(segments)):
+        yield "/".join(segments[:i])
+
+
+def read_ndjson(lines, codec):
+    for line in lines:
+        if line.strip():
+            yield codec.loads(line)
+
+
+def retry_after(request_object, attempt):
+    """
+    Seconds to wait before retrying: the Retry-After header of
+    request_object if any, or exponential backoff with jitter.
+    """
+    try:
+        return float(request_object.headers["Retry-After"])
+    except (AttributeError, KeyError, ValueError):
+        return uniform(0, min(30.0, 0.1 * 2 ** attempt))
+
+
+def transport_retries(request_object):
+    """ How many times RetryingAdapter retried the request behind request_object. """
+    return getattr(request_object, "retries", 0)
+
+
+def write_record(sink, path, value, codec):
+    # one write per record so an interrupted export leaves at most one partial line
+    line = codec.dumps({"path": path, "value": value}) + b"\n"
+    sink.write(line.decode("utf-8") if isinstance(sink, io.TextIOBase) else line)
+
+
+def resume_ndjson(filename, codec):
+    """ Paths of the complete records in filename, dropping a partial last line. """
+    done = set()
+    try:
+        with open(filename, "rb+") as records:
+            end = 0
+            for line in records:
+                if not line.endswith(b"\n"):
+                    break
+                done.add(codec.loads(line)["path"])
+                end += len(line)
+            records.truncate(end)
+    except IOError:
+        pass
+    return done
+
+
+class BatchWriter:
+    """
+    Collects set, update and remove operations on paths below a base path and
+    writes them as multi-location updates at the deepest common ancestor of
+    the paths touched.
+
+    Pending operations are written once max_operations have been collected,
+    flush_interval seconds after the first one if given, when flush() is
+    called, or when a with block around the writer exits without error.
+    """
+    def __init__(self, database, path, token=None, max_operations=1000, flush_interval=None, json_kwargs={}):
+        self.database = database
+        self.path = path.strip("/")
+        self.token = token
+        self.max_operations = max_operations
+        self.flush_interval = flush_interval
+        self.json_kwargs = json_kwargs
+        # full path -> value, None removes
+        self.pending = OrderedDict()
+        # every proper ancestor of a pending path
+        self.ancestors = set()
+        self.lock = threading.RLock()
+        self.timer = None
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.close()
+
+    def set(self, path, data):
+        self.add(path, data)
+        return self
+
+    def update(self, path, data):
+        for key, value in data.items():
+            self.add(join_path(path, key), value)
+        return self
+
+    def remove(self, path):
+        self.add(path, None)
+        return self
+
+    def add(self, path, value):
+        path = join_path(self.path, path)
+        if not path:
+            raise ValueError("Batched writes need a path below the database root")
+        with self.lock:
+            self.raise_error()
+            if self.conflicts(path):
+                # a multi-location update can't hold a path and its ancestor
+                self.flush()
+            self.pending.pop(path, None)
+            self.pending[path] = value
+            segments = path.split("/")
+            for i in range(1, len(segments)):
+                self.ancestors.add("/".join(segments[:i]))
+            if len(self.pending) >= self.max_operations:
+                self.flush()
+            elif self.flush_interval and not self.timer:
+                self.timer = threading.Timer(self.flush_interval, self.timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def conflicts(self, path):
+        if path in self.ancestors:
+            return True
+        segments = path.split("/")
+        return any("/".join(segments[:i]) in self.pending for i in range(1, len(segments)))
+
+    def flush(self):
+        """ Write everything pending, returns the response data or None. """
+        with self.lock:
+            self.raise_error()
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return None
+            pending = self.pending
+            self.pending = OrderedDict()
+            self.ancestors = set()
+            root = common_ancestor([path.rsplit("/", 1)[0] if "/" in path else "" for path in pending])
+            offset = len(root) + 1 if root else 0
+            data = OrderedDict((path[offset:], value) for path, value in pending.items())
+            database = self.database
+            request_ref = database.check_token(database.database_url, root, self.token)
+            headers = database.build_headers(self.token)
+            data = database.build_body(data, headers, self.json_kwargs)
+            request_object = database.requests.patch(request_ref, headers=headers, data=data)
+            if database.cache:
+                database.cache.written(root)
+            raise_detailed_error(request_object)
+            return database.codec.loads(request_object.content)
+
+    def timed_flush(self):
+        with self.lock:
+            self.timer = None
+            try:
+                self.flush()
+            except Exception as e:
+                # raised from the next call on the writer
+                self.error = e
+
+    def raise_error(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+
+def join_path(*parts):
+    return "/".join(str(part).strip("/") for part in parts if str(part).strip("/"))
+
+
+def common_ancestor(paths):
+    """ Longest path every one of paths lies at or below. """
+    common = None
+    for path in paths:
+        segments = path.split("/") if path else []
+        if common is None:
+            common = segments
+            continue
+        i = 0
+        while i < min(len(common), len(segments)) and common[i] == segments[i]:
+            i += 1
+        common = common[:i]
+    return "/".join(common or [])
+
+
+class WriteBehindQueue:
+    """
+    Queues set, update and remove operations on paths below a base path and
+    writes them from a background thread, so callers don't wait for the
+    network.
+
+    Writes to a path still pending are coalesced: a set replaces the pending
+    value of the path and everything below it, an update merges its
+    children into it. Pending writes are sent flush_interval seconds after
+    the first one, or once max_operations are pending, as multi-location
+    updates of up to max_operations each over max_workers threads. Failed
+    updates are retried by the app's transport as its httpRetries policy
+    allows, and counted in retries.
+
+    Once max_pending paths are pending, writes to other paths wait for room,
+    or are dropped and counted if block is False. flush() waits until every
+    write queued before it has been sent and raises the first failure since
+    the last call.
+    """
+    def __init__(self, database, path, token=None, flush_interval=0.5, max_operations=1000, max_pending=100000,
+                 max_workers=4, block=True, json_kwargs={}):
+        self.database = database
+        self.path = path.strip("/")
+        self.token = token
+        self.flush_interval = flush_interval
+        self.max_operations = max_operations
+        self.max_pending = max_pending
+        self.block = block
+        self.json_kwargs = json_kwargs
+        # full path -> value, None removes
+        self.pending = OrderedDict()
+        # proper ancestor of pending paths -> how many of them it has
+        self.ancestors = {}
+        self.first_pending = None
+        self.condition = threading.Condition()
+        # writes accepted, and accepted before the last finished flush
+        self.sequence = 0
+        self.written_sequence = 0
+        self.flush_requested = False
+        self.closed = False
+        self.error = None
+        self.in_flight = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.requests = 0
+        self.retries = 0
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set(self, path, data):
+        self.add(path, data)
+        return self
+
+    def update(self, path, data):
+        for key, value in data.items():
+            self.add(join_path(path, key), value)
+        return self
+
+    def remove(self, path):
+        self.add(path, None)
+        return self
+
+    def add(self, path, value):
+        path = join_path(self.path, path)
+        if not path:
+            raise ValueError("Queued writes need a path below the database root")
+        with self.condition:
+            while len(self.pending) >= self.max_pending and not self.coalesces(path) and not self.closed:
+                if not self.block:
+                    self.dropped += 1
+                    return
+                self.condition.wait()
+            if self.closed:
+                raise ValueError("Write-behind queue is closed")
+            self.sequence += 1
+            self.queued += 1
+            for parent in iter_parents(path):
+                if parent in self.pending:
+                    self.pending[parent] = set_child(self.pending[parent], path[len(parent) + 1:], value)
+                    self.coalesced += 1
+                    return
+            if path in self.pending:
+                self.coalesced += 1
+            elif path in self.ancestors:
+                prefix = path + "/"
+                for child in [child for child in self.pending if child.startswith(prefix)]:
+                    self.discard(child)
+                    self.coalesced += 1
+            self.pending[path] = value
+            for parent in iter_parents(path):
+                self.ancestors[parent] = self.ancestors.get(parent, 0) + 1
+            if self.first_pending is None:
+                self.first_pending = time.time()
+                self.condition.notify_all()
+            elif len(self.pending) >= self.max_operations:
+                self.condition.notify_all()
+
+    def coalesces(self, path):
+        return path in self.pending or path in self.ancestors or any(
+            parent in self.pending for parent in iter_parents(path))
+
+    def discard(self, path):
+        del self.pending[path]
+        for parent in iter_parents(path):
+            count = self.ancestors[parent] - 1
+            if count:
+                self.ancestors[parent] = count
+            else:
+                del self.ancestors[parent]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.closed or self.flush_requested or len(self.pending) >= self.max_operations):
+                    if self.pending:
+                        remaining = self.first_pending + self.flush_interval - time.time()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                pending = self.pending
+                sequence = self.sequence
+                closed = self.closed
+                self.pending = OrderedDict()
+                self.ancestors = {}
+                self.first_pending = None
+                self.flush_requested = False
+                self.in_flight = len(pending)
+                # blocked writers have room again
+                self.condition.notify_all()
+            if pending:
+                self.send_all(pending)
+            with self.condition:
+                self.in_flight = 0
+                self.written_sequence = sequence
+                self.condition.notify_all()
+            if closed and not pending:
+                return
+
+    def send_all(self, pending):
+        items = sorted(pending.items())
+        groups = [items[i:i + self.max_operations] for i in range(0, len(items), self.max_operations)]
+        futures = [self.executor.submit(self.send, operations) for operations in groups]
+        for operations, future in zip(groups, futures):
+            try:
+                future.result()
+            except Exception as e:
+                with self.condition:
+                    self.failed += len(operations)
+                    if self.error is None:
+                        # raised from the next flush() or close()
+                        self.error = e
+
+    def send(self, operations):
+        database = self.database
+        root = common_ancestor([path.rsplit("/", 1)[0] if "/" in path else "" for path, value in operations])
+        offset = len(root) + 1 if root else 0
+        data = OrderedDict((path[offset:], value) for path, value in operations)
+        request_ref = database.check_token(database.database_url, root, self.token)
+        headers = database.build_headers(self.token)
+        data = database.build_body(data, headers, self.json_kwargs)
+        request_object = database.requests.patch(request_ref, headers=headers, data=data)
+        if database.cache:
+            database.cache.written(root)
+        with self.condition:
+            self.requests += 1
+            self.retries += transport_retries(request_object)
+        raise_detailed_error(request_object)
+        with self.condition:
+            self.written += len(operations)
+
+    def flush(self):
+        """ Wait until everything queued so far has been sent. """
+        with self.condition:
+            target = self.sequence
+            if self.written_sequence < target:
+                self.flush_requested = True
+                self.condition.notify_all()
+                while self.written_sequence < target:
+                    self.condition.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """ Send everything queued and stop the background thread. """
+        with self.condition:
+            if not self.closed:
+                self.closed = True
+                self.condition.notify_all()
+        self.thread.join()
+        self.executor.shutdown()
+        with self.condition:
+            self.raise_error()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "written": self.written,
+                "failed": self.failed,
+                "requests": self.requests,
+                "retries": self.retries,
+            }
+
+
+def set_child(tree, path, value):
+    """ A copy of tree with value at path below it, None removing it. """
+    key, _, rest = path.partition("/")
+    if not isinstance(tree, dict):
+        if value is None:
+            return tree
+        tree = {}
+    else:
+        tree = dict(tree)
+    if rest:
+        value = set_child(tree.get(key), rest, value)
+    if value is None:
+        tree.pop(key, None)
+    else:
+        tree[key] = value
+    return tree
+
+
+class WriteJournal:
+    """
+    SQLite journal of database writes. Given to Database, set, update, push
+    and remove return once the write is committed to the journal, and a
+    background thread sends journaled writes in order, keeping them through
+    connection errors, 5xx and 429 responses and process restarts. Writes
+    rejected with another error are dropped and raised from the next
+    flush() or close(). The journal does its own retrying, with backoff
+    and without limit, so its requests are sent with the transport's
+    retries off.
+
+    Writes committed while an earlier group is being committed share the
+    next commit. A write replaces older unsent writes at or below its path,
+    and consecutive writes are sent together as multi-location updates of
+    up to max_operations paths.
+    """
+    def __init__(self, filename, max_operations=1000, synchronous="FULL"):
+        self.filename = filename
+        self.max_operations = max_operations
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous={0}".format(synchronous))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS writes (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "op INTEGER NOT NULL, path TEXT NOT NULL, value BLOB NOT NULL, token TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS writes_path ON writes (path)")
+        # guards the connection, shared by the committing and sending threads
+        self.connection_lock = threading.Lock()
+        self.op = self.connection.execute("SELECT COALESCE(MAX(op), 0) FROM writes").fetchone()[0]
+        self.condition = threading.Condition()
+        self.group = JournalGroup()
+        self.committing = False
+        self.closed = False
+        self.error = None
+        self.database = None
+        self.thread = None
+        self.committed = 0
+        self.commits = 0
+        self.compacted = 0
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+        self.retries = 0
+
+    def start(self, database):
+        """ Send journaled writes, including those left by an earlier process, through database. """
+        if self.database is not None:
+            raise ValueError("The journal is already used by a Database")
+        self.database = database
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, method, path, data, token=None, json_kwargs={}):
+        """ Journal a write, returns what the request would have. """
+        database = self.database
+        if method == "post":
+            key = database.generate_key()
+            rows = [(join_path(path, key), self.encode(data, json_kwargs))]
+            result = {"name": key}
+        elif method == "patch":
+            rows = [(join_path(path, key), self.encode(value, json_kwargs)) for key, value in data.items()]
+            result = data
+        elif method == "put":
+            rows = [(path, self.encode(data, json_kwargs))]
+            result = data
+        else:
+            rows = [(path, b"null")]
+            result = None
+        if rows:
+            self.append(rows, token)
+        return result
+
+    def encode(self, data, json_kwargs):
+        if isinstance(data, bytes):
+            return data
+        if hasattr(data, "__next__"):
+            return b"".join(chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in data)
+        return self.database.codec.dumps(data, **json_kwargs)
+
+    def append(self, rows, token):
+        with self.condition:
+            if self.closed:
+                raise ValueError("The journal is closed")
+            group = self.group
+            group.append((rows, token))
+            while not group.done:
+                if self.committing:
+                    self.condition.wait()
+                    continue
+                # lead the commit of everything waiting, our rows included
+                self.committing = True
+                writes = self.group
+                self.group = JournalGroup()
+                self.condition.release()
+                try:
+                    self.commit(writes)
+                except Exception as e:
+                    writes.error = e
+                finally:
+                    self.condition.acquire()
+                    self.committing = False
+                    writes.done = True
+                    self.condition.notify_all()
+            if group.error is not None:
+                raise group.error
+
+    def commit(self, writes):
+        with self.connection_lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for rows, token in writes:
+                    self.op += 1
+                    for path, value in rows:
+                        if path:
+                            cursor.execute("DELETE FROM writes WHERE path = ? OR (path > ? AND path < ?)",
+                                           (path, path + "/", path + "0"))
+                        else:
+                            cursor.execute("DELETE FROM writes")
+                        self.compacted += cursor.rowcount
+                        cursor.execute("INSERT INTO writes (op, path, value, token) VALUES (?, ?, ?, ?)",
+                                       (self.op, path, value, token))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        self.committed += sum(len(rows) for rows, token in writes)
+        self.commits += 1
+
+    def pending(self):
+        """ Number of journaled writes not yet sent. """
+        with self.connection_lock:
+            return self.connection.execute("SELECT COUNT(*) FROM writes").fetchone()[0]
+
+    def next_writes(self):
+        """ The oldest journaled writes that can be sent as one update. """
+        with self.connection_lock:
+            rows = self.connection.execute("SELECT seq, op, path, value, token FROM writes ORDER BY seq LIMIT ?",
+                                           (self.max_operations + 1,)).fetchall()
+        if not rows or not rows[0][2]:
+            # a write at the database root goes alone
+            return rows[:1]
+        writes = []
+        paths = set()
+        ancestors = set()
+        for op in group_by_op(rows):
+            token = op[0][4]
+            conflict = any(not path or path in paths or path in ancestors or
+                           any(parent in paths for parent in iter_parents(path)) for seq, _, path, value, _ in op)
+            if writes and (conflict or token != writes[0][4] or len(writes) + len(op) > self.max_operations):
+                break
+            writes.extend(op)
+            for seq, _, path, value, _ in op:
+                paths.add(path)
+                ancestors.update(iter_parents(path))
+        return writes
+
+    def run(self):
+        retries_off.active = True
+        attempt = 0
+        while True:
+            with self.condition:
+                closed = self.closed
+            writes = self.next_writes()
+            if not writes:
+                with self.condition:
+                    if self.closed:
+                        return
+                    self.condition.notify_all()
+                    self.condition.wait(1)
+                continue
+            try:
+                delay = self.send(writes, attempt)
+            except Exception as e:
+                with self.condition:
+                    self.failed += len(writes)
+                    if self.error is None:
+                        # raised from the next flush() or close()
+                        self.error = e
+                delay = None
+            if delay is None:
+                attempt = 0
+                with self.connection_lock:
+                    self.connection.executemany("DELETE FROM writes WHERE seq = ?", [(write[0],) for write in writes])
+                continue
+            if closed:
+                return
+            attempt += 1
+            with self.condition:
+                self.retries += 1
+                self.condition.wait(delay)
+
+    def send(self, writes, attempt):
+        """ Send writes, returns None or the seconds to wait before retrying them. """
+        database = self.database
+        token = writes[0][4]
+        if len(writes) == 1 and not writes[0][2]:
+            root = ""
+            method = database.requests.put
+            data = writes[0][3]
+        else:
+            root = common_ancestor([path.rsplit("/", 1)[0] if "/" in path else "" for _, _, path, _, _ in writes])
+            offset = len(root) + 1 if root else 0
+            codec = database.codec
+            method = database.requests.patch
+            data = b"{" + b",".join(codec.dumps(path[offset:]) + b":" + value
+                                    for _, _, path, value, _ in writes) + b"}"
+        request_ref = database.check_token(database.database_url, root, token)
+        with self.condition:
+            self.requests += 1
+        try:
+            headers = database.build_headers(token)
+            data = database.build_body(data, headers)
+            request_object = method(request_ref, headers=headers, data=data)
+        except (requests.exceptions.RequestException, socket.error, httplib2.HttpLib2Error):
+            # offline, keep the writes until the connection is back
+            return retry_after(None, attempt)
+        if request_object.status_code >= 500 or request_object.status_code == 429:
+            return retry_after(request_object, attempt)
+        if database.cache:
+            database.cache.written(root)
+        raise_detailed_error(request_object)
+        with self.condition:
+            self.sent += len(writes)
+        return None
+
+    def flush(self, timeout=None):
+        """
+        Wait until every journaled write has been sent, returns False if
+        timeout seconds passed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            self.condition.notify_all()
+        while self.pending():
+            with self.condition:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self.condition.wait(0.05)
+        with self.condition:
+            self.raise_error()
+        return True
+
+    def raise_error(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self, timeout=None):
+        """
+        Try to send what is journaled for up to timeout seconds, or until
+        sent if None, and close the file. Unsent writes are sent once the
+        journal is opened again.
+        """
+        try:
+            if self.thread is not None:
+                self.flush(timeout)
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+            if self.thread is not None:
+                self.thread.join()
+            with self.connection_lock:
+                self.connection.close()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "committed": self.committed,
+                "commits": self.commits,
+                "compacted": self.compacted,
+                "sent": self.sent,
+                "failed": self.failed,
+                "requests": self.requests,
+                "retries": self.retries,
+            }
+
+
+class JournalGroup(list):
+    """ Writes committed together. """
+    done = False
+    error = None
+
+
+def group_by_op(rows):
+    """ Runs of journal rows written by the same operation. """
+    ops = []
+    for row in rows:
+        if ops and ops[-1][0][1] == row[1]:
+            ops[-1].append(row)
+        else:
+            ops.append([row])
+    return ops
 
 
 class Storage:
@@ -420,7 +1981,7 @@ class Storage:
             blob = self.bucket.get_blob(path)
             blob.download_to_filename(filename)
         else:
-            r = requests.get(url, stream=True)
+            r = self.requests.get(url, stream=True)
             if r.status_code == 200:
                 with open(filename, 'wb') as f:
                     for chunk in r:
@@ -439,6 +2000,290 @@ class Storage:
         return self.bucket.list_blobs()
 
 
+def generate_custom_token(service_account_email, private_key, uid, additional_claims=None):
+    payload = {
+        "iss": service_account_email,
+        "sub": service_account_email,
+        "aud": "https://identitytoolkit.googleapis.com/google.identity.identitytoolkit.v1.IdentityToolkit",
+        "uid": uid
+    }
+    if additional_claims:
+        payload["claims"] = additional_claims
+    exp = datetime.timedelta(minutes=60)
+    return jwt.generate_jwt(payload, private_key, "RS256", exp)
+
+
+# private keys parsed by sign_custom_token, by PEM
+rsa_keys = {}
+
+
+def sign_custom_token(service_account_email, private_key_pem, uid, additional_claims=None):
+    """ Process pool entry point for Auth.create_custom_tokens. """
+    if private_key_pem not in rsa_keys:
+        rsa_keys[private_key_pem] = RSA.importKey(private_key_pem)
+    return generate_custom_token(service_account_email, rsa_keys[private_key_pem], uid, additional_claims)
+
+
+def run_many(function, args_list, max_workers=10, rate_limit=None):
+    """
+    Call function with each tuple of arguments on a pool of max_workers
+    threads, starting at most rate_limit calls per second if given.
+
+    Results come back in input order. A call that raises puts its exception
+    in the results instead of aborting the batch. Raise the app's
+    httpPoolSize to match max_workers above 10.
+    """
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+
+    def call(args):
+        if limiter:
+            limiter.acquire()
+        try:
+            return function(*args)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(call, args_list))
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate calls per second on average and bursts of up
+    to burst calls, shared safely between threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1.0, self.rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token and return how long to wait before using it. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # go into debt if the bucket is empty, later callers wait longer
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self):
+        """ Take a token, sleeping until it is available. Returns the wait. """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """ Make the next call wait at least seconds, as after a 429 response. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a request is retried: after connection errors
+    and timeouts, and responses with one of statuses, up to max_retries
+    times. Waits follow the Retry-After header, giving up if it asks for
+    more than max_backoff seconds, or back off exponentially with full
+    jitter from backoff seconds up to max_backoff.
+
+    POST requests, such as push() and most Auth calls, may not be safe to
+    repeat and are only retried when the connection failed before anything
+    was sent or on a 429 response. Bodies that can't be sent twice, like
+    files and iterators, are never retried.
+    """
+    idempotent_methods = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"])
+
+    def __init__(self, max_retries=3, backoff=0.1, max_backoff=30.0, statuses=(429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+
+    def delay(self, request, attempt, response=None, error=None):
+        """ Seconds to wait before retry number attempt + 1, or None not to retry. """
+        if attempt >= self.max_retries:
+            return None
+        if request.body is not None and not isinstance(request.body, (bytes, str)):
+            return None
+        idempotent = request.method in self.idempotent_methods
+        if error is not None:
+            if not idempotent and not connect_failed(error):
+                return None
+        else:
+            if response.status_code not in self.statuses:
+                return None
+            if not idempotent and response.status_code != 429:
+                return None
+            try:
+                wait = float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                pass
+            else:
+                return wait if wait <= self.max_backoff else None
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def connect_failed(error):
+    """ Whether a connection error happened before the request was sent. """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+class CircuitBreaker:
+    """
+    Per host, rejects requests for reset_timeout seconds once
+    failure_threshold requests in a row failed with a connection error or
+    a 5xx response, then lets one request through and accepts requests
+    again if it succeeds.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # host -> consecutive failures
+        self.failures = {}
+        # host -> time the circuit opened
+        self.opened = {}
+        # hosts with a trial request in flight
+        self.trials = set()
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return True
+            if host in self.trials or time.time() - opened < self.reset_timeout:
+                return False
+            self.trials.add(host)
+            return True
+
+    def record(self, host, failed):
+        with self.lock:
+            self.trials.discard(host)
+            if not failed:
+                self.failures.pop(host, None)
+                self.opened.pop(host, None)
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.failure_threshold:
+                self.opened[host] = time.time()
+
+    def state(self, host):
+        with self.lock:
+            if host not in self.opened:
+                return "closed"
+            if host in self.trials or time.time() - self.opened[host] < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ A request rejected without sending it because its host keeps failing. """
+
+
+# requests sent from a thread with retries_off.active set are not retried by RetryingAdapter
+retries_off = threading.local()
+
+
+class RetryingAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter retrying requests as retry_policy allows, waiting on
+    rate_limiter before every attempt and rejecting requests to failing
+    hosts with circuit_breaker. A 429 response pauses rate_limiter, so every
+    thread sharing it backs off. Each of them may be None.
+
+    Responses carry the number of retries behind them as response.retries.
+    """
+    def __init__(self, retry_policy=None, rate_limiter=None, circuit_breaker=None, **kwargs):
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.retry_seconds = 0.0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.throttled_responses = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).netloc
+        retry_policy = None if getattr(retries_off, "active", False) else self.retry_policy
+        attempt = 0
+        while True:
+            if self.circuit_breaker and not self.circuit_breaker.allow(host):
+                with self.lock:
+                    self.rejected += 1
+                raise CircuitOpenError("Too many failed requests to {0}".format(host), request=request)
+            if self.rate_limiter:
+                wait = self.rate_limiter.acquire()
+                if wait:
+                    with self.lock:
+                        self.throttled += 1
+                        self.throttled_seconds += wait
+            with self.lock:
+                self.requests += 1
+            response = None
+            try:
+                response = requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.record(host, True)
+                delay = retry_policy.delay(request, attempt, error=e) if retry_policy else None
+                if delay is None:
+                    raise
+            else:
+                self.record(host, response.status_code >= 500)
+                if response.status_code == 429:
+                    with self.lock:
+                        self.throttled_responses += 1
+                delay = retry_policy.delay(request, attempt, response=response) if retry_policy else None
+                if delay is None:
+                    response.retries = attempt
+                    return response
+                response.close()
+            with self.lock:
+                self.retries += 1
+                self.retry_seconds += delay
+            if response is not None and response.status_code == 429 and self.rate_limiter:
+                # the next acquire() waits, here and in every other thread
+                self.rate_limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    def record(self, host, failed):
+        if failed:
+            with self.lock:
+                self.failures += 1
+        if self.circuit_breaker:
+            self.circuit_breaker.record(host, failed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "retry_seconds": self.retry_seconds,
+                "failures": self.failures,
+                "throttled": self.throttled,
+                "throttled_seconds": self.throttled_seconds,
+                "throttled_responses": self.throttled_responses,
+                "rejected": self.rejected,
+            }
+
+
 def raise_detailed_error(request_object):
     try:
         request_object.raise_for_status()
@@ -448,6 +2293,32 @@ def raise_detailed_error(request_object):
         raise HTTPError(e, request_object.text)
 
 
+def build_pyre_response(request_dict, build_query, query_key, sort=False):
+    # if primitive or simple query return
+    if not isinstance(request_dict, dict) or not build_query:
+        return PyreResponse(request_dict, query_key)
+    # return keys if shallow
+    if build_query.get("shallow"):
+        return PyreResponse(request_dict.keys(), query_key)
+    # results are kept in the order they were received unless asked to sort
+    if sort and build_query.get("orderBy"):
+        request_dict = sort_children(request_dict, build_query["orderBy"])
+    return PyreResponse(request_dict, query_key)
+
+
+def sort_children(children, order_by):
+    """ Sort a dict of children as Firebase orders them for orderBy. """
+    # ties are ordered by key, sort by key first and rely on sorted() being stable
+    items = sorted(children.items(), key=lambda item: firebase_key(item[0]))
+    if order_by == "$value":
+        items.sort(key=lambda item: firebase_value(item[1]))
+    elif "/" in order_by:
+        items.sort(key=lambda item: firebase_value(child_value(item[1], order_by)))
+    elif order_by != "$key":
+        items.sort(key=lambda item: firebase_value(item[1].get(order_by) if isinstance(item[1], dict) else None))
+    return OrderedDict(items)
+
+
 def convert_to_pyre(items):
     pyre_list = []
     for item in items:
@@ -457,42 +2328,42 @@ def convert_to_pyre(items):
 
 def convert_list_to_pyre(items):
     pyre_list = []
-    for item in items:
-        pyre_list.append(Pyre([items.index(item), item]))
+    for index, item in enumerate(items):
+        pyre_list.append(Pyre((index, item)))
     return pyre_list
 
 
 class PyreResponse:
-    def __init__(self, pyres, query_key):
-        self.pyres = pyres
+    """
+    Wraps the decoded response. Pyre objects for the children are only
+    created when each() is called.
+    """
+    def __init__(self, data, query_key):
+        self.data = data
         self.query_key = query_key
 
+    @property
+    def pyres(self):
+        if isinstance(self.data, (dict, list)):
+            return self.each()
+        return self.data
+
     def val(self):
-        if isinstance(self.pyres, list):
-            # unpack pyres into OrderedDict
-            pyre_list = []
-            # if firebase response was a list
-            if isinstance(self.pyres[0].key(), int):
-                for pyre in self.pyres:
-                    pyre_list.append(pyre.val())
-                return pyre_list
-            # if firebase response was a dict with keys
-            for pyre in self.pyres:
-                pyre_list.append((pyre.key(), pyre.val()))
-            return OrderedDict(pyre_list)
-        else:
-            # return primitive or simple query results
-            return self.pyres
+        return self.data
 
     def key(self):
         return self.query_key
 
     def each(self):
-        if isinstance(self.pyres, list):
-            return self.pyres
+        if isinstance(self.data, dict):
+            return convert_to_pyre(self.data.items())
+        if isinstance(self.data, list):
+            return convert_list_to_pyre(self.data)
 
 
 class Pyre:
+    __slots__ = ("item",)
+
     def __init__(self, item):
         self.item = item
 
@@ -503,6 +2374,211 @@ class Pyre:
         return self.item[0]
 
 
+class AccessTokenCache:
+    """
+    Holds the service account's OAuth access token in memory.
+
+    The token is renewed on a background timer refresh_margin seconds before
+    it expires. Should that fail, the first caller to find the token about to
+    expire refreshes it while concurrent callers wait for that one refresh.
+    """
+    # tokens this close to expiry are never handed out
+    expiry_skew = 60
+
+    def __init__(self, credentials, refresh_margin=300, background=True):
+        self.credentials = credentials
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self.access_token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+        # the counters are updated outside lock on the fast path
+        self.stats_lock = threading.Lock()
+        self.timer = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def fresh(self):
+        return self.access_token is not None and time.time() < self.expires_at - self.expiry_skew
+
+    def get_access_token(self):
+        if self.fresh():
+            self.count("hits")
+            return self.access_token
+        with self.lock:
+            # another thread may have refreshed while we waited for the lock
+            if self.fresh():
+                self.count("hits")
+            else:
+                self.count("misses")
+                self.refresh()
+            return self.access_token
+
+    def count(self, name):
+        with self.stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def refresh(self):
+        """ Fetch a new access token, the caller must hold the lock. """
+        try:
+            info = self.credentials.get_access_token()
+            if info.expires_in is not None and info.expires_in <= self.refresh_margin:
+                # the credentials' own copy is about to expire as well
+                self.credentials.refresh(httplib2.Http())
+                info = self.credentials.get_access_token()
+        except Exception:
+            self.count("errors")
+            raise
+        self.count("refreshes")
+        expires_in = info.expires_in if info.expires_in is not None else 3600
+        self.access_token = info.access_token
+        self.expires_at = time.time() + expires_in
+        if self.background:
+            self.schedule(expires_in - self.refresh_margin)
+
+    def schedule(self, delay):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(delay, 0), self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def background_refresh(self):
+        with self.lock:
+            try:
+                self.refresh()
+            except Exception:
+                # leave it to the next caller once the token is close to expiry
+                pass
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "errors": self.errors,
+                "expires_in": max(self.expires_at - time.time(), 0),
+            }
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+
+class ReadCache:
+    """
+    LRU cache of Database.get responses holding up to max_bytes of response
+    bodies. Entries are served without a request for ttl seconds, then
+    revalidated with their ETag so unchanged data is not downloaded or
+    decoded again.
+
+    Cached values are shared between responses and should not be modified.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.stale = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, query, token, json_kwargs):
+        params = tuple(sorted(query.params))
+        return query.path, params, token, tuple(sorted(json_kwargs.items()))
+
+    def lookup(self, key):
+        """ Return the entry for key or None, counting a hit if it is fresh. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            if time.time() - entry.stored_at < self.ttl:
+                self.hits += 1
+                entry.fresh = True
+            else:
+                entry.fresh = False
+            return entry
+
+    def revalidated(self, key, entry):
+        with self.lock:
+            self.revalidations += 1
+            entry.stored_at = time.time()
+
+    def changed(self):
+        """ Count a revalidation that downloaded new data, a miss for hit_rate. """
+        with self.lock:
+            self.stale += 1
+
+    def store(self, key, path, value, etag, size):
+        if etag is None or size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old.size
+            self.entries[key] = CacheEntry(path, value, etag, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def invalidate(self, prefix=""):
+        """ Drop entries at prefix and below it. """
+        prefix = prefix.strip("/")
+        self.remove(lambda path: not prefix or path == prefix or path.startswith(prefix + "/"))
+
+    def written(self, path):
+        """ Drop entries a write at path may have changed, at, above or below it. """
+        path = path.strip("/")
+        self.remove(lambda cached: (not path or not cached or cached == path or path.startswith(cached + "/") or
+                                    cached.startswith(path + "/")))
+
+    def remove(self, match):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if match(entry.path)]:
+                self.size -= self.entries.pop(key).size
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidations + self.stale + self.misses
+            return {
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "stale": self.stale,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.revalidations) / float(lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+
+class CacheEntry:
+    __slots__ = ("path", "value", "etag", "size", "stored_at", "fresh")
+
+    def __init__(self, path, value, etag, size):
+        self.path = path
+        self.value = value
+        self.etag = etag
+        self.size = size
+        self.stored_at = time.time()
+        self.fresh = False
+
+
 class KeepAuthSession(Session):
     """
     A session that doesn't drop Authentication on redirects between domains.
@@ -531,11 +2607,13 @@ class ClosableSSEClient(SSEClient):
 
 
 class Stream:
-    def __init__(self, url, stream_handler, build_headers, stream_id):
+    def __init__(self, url, stream_handler, build_headers, stream_id, lazy=False, codec=None):
         self.build_headers = build_headers
+        self.codec = codec or JSONCodec()
         self.url = url
         self.stream_handler = stream_handler
         self.stream_id = stream_id
+        self.lazy = lazy
         self.sse = None
         self.thread = None
         self.start()
@@ -553,14 +2631,26 @@ class Stream:
         return self
 
     def start_stream(self):
-        self.sse = ClosableSSEClient(self.url, session=self.make_session(), build_headers=self.build_headers)
+        # In lazy mode put and patch data is decoded as the handler iterates it
+        stream_events = ("put", "patch") if self.lazy else ()
+        self.sse = ClosableSSEClient(self.url, session=self.make_session(), build_headers=self.build_headers,
+                                     stream_events=stream_events)
         for msg in self.sse:
             if msg:
-                msg_data = json.loads(msg.data)
-                msg_data["event"] = msg.event
-                if self.stream_id:
-                    msg_data["stream_id"] = self.stream_id
-                self.stream_handler(msg_data)
+                try:
+                    if msg.event in stream_events:
+                        stream_data = StreamData(msg.data_stream or [msg.data.encode("utf-8")])
+                        msg_data = {"path": stream_data.path, "data": stream_data}
+                    else:
+                        msg_data = self.codec.loads(msg.data)
+                    msg_data["event"] = msg.event
+                    if self.stream_id:
+                        msg_data["stream_id"] = self.stream_id
+                    self.stream_handler(msg_data)
+                except IncompleteEvent:
+                    # the connection dropped mid event, firebase resends the
+                    # current data once reconnected
+                    continue
 
     def close(self):
         while not self.sse and not hasattr(self.sse, 'resp'):
@@ -569,3 +2659,798 @@ class Stream:
         self.sse.close()
         self.thread.join()
         return self
+
+
+class ChunkedDecoder:
+    """
+    Incrementally decodes a body sent with chunked transfer encoding.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        # bytes left in the current chunk, None while reading a size line
+        self.remaining = None
+        # bytes of the CRLF closing the current chunk still to be skipped
+        self.trailer = 0
+        self.done = False
+
+    def feed(self, data):
+        self.buf += data
+        decoded = bytearray()
+        while not self.done:
+            if self.trailer:
+                skip = min(self.trailer, len(self.buf))
+                del self.buf[:skip]
+                self.trailer -= skip
+                if self.trailer:
+                    break
+            if self.remaining is None:
+                end = self.buf.find(b'\r\n')
+                if end == -1:
+                    break
+                # ignore chunk extensions
+                size = int(bytes(self.buf[:end]).split(b';')[0], 16)
+                del self.buf[:end + 2]
+                if size == 0:
+                    self.done = True
+                    break
+                self.remaining = size
+            take = min(self.remaining, len(self.buf))
+            if not take:
+                break
+            decoded += self.buf[:take]
+            del self.buf[:take]
+            self.remaining -= take
+            if self.remaining == 0:
+                self.remaining = None
+                self.trailer = 2
+        return bytes(decoded)
+
+
+class StreamProtocol(asyncio.Protocol):
+    """
+    Speaks just enough HTTP/1.1 to read one event stream for a ManagedStream.
+    """
+    def __init__(self, stream, url, headers):
+        self.stream = stream
+        self.url = url
+        self.headers = headers
+        self.transport = None
+        self.head = bytearray()
+        self.status = None
+        self.chunked = None
+        self.events = EventBuffer()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stream.protocol = self
+        if not self.stream.running:
+            transport.close()
+            return
+        parts = urlsplit(self.url)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        lines = ["GET {0} HTTP/1.1".format(target), "Host: {0}".format(parts.netloc)]
+        for name, value in self.headers.items():
+            lines.append("{0}: {1}".format(name, value))
+        transport.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    def data_received(self, data):
+        if self.status is None:
+            self.head += data
+            end = self.head.find(b'\r\n\r\n')
+            if end == -1:
+                return
+            data = bytes(self.head[end + 4:])
+            if not self.read_head(bytes(self.head[:end]).decode("latin-1")):
+                self.transport.close()
+                return
+        if self.chunked:
+            data = self.chunked.feed(data)
+        self.events.feed(data)
+        while True:
+            raw = self.events.next_event()
+            if raw is None:
+                break
+            self.stream.handle_event(self, raw)
+        if self.chunked and self.chunked.done:
+            self.transport.close()
+
+    def read_head(self, head):
+        """ Parse the response head, return True if an event stream follows. """
+        lines = head.split("\r\n")
+        self.status = int(lines[0].split(" ")[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if self.status in (301, 302, 303, 307, 308) and headers.get("location"):
+            self.stream.redirect(headers["location"])
+            return False
+        if self.status != 200:
+            self.stream.failed(HTTPError("{0} response to {1}".format(lines[0], self.url)), self.status >= 500)
+            return False
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            self.chunked = ChunkedDecoder()
+        return True
+
+    def connection_lost(self, exc):
+        self.stream.disconnected(self)
+
+
+class ManagedStream:
+    """
+    A stream whose connection is run by a StreamManager. Handlers are called
+    in order for each stream, on the manager's worker threads.
+    """
+    def __init__(self, manager, url, stream_handler, build_headers, stream_id, codec=None):
+        self.manager = manager
+        self.codec = codec or JSONCodec()
+        self.url = url
+        self.stream_handler = stream_handler
+        self.build_headers = build_headers
+        self.stream_id = stream_id
+        self.last_id = None
+        self.retry = 3000
+        self.error = None
+        self.running = False
+        self.protocol = None
+        self.connection = None
+        self.retry_handle = None
+        self.closed = threading.Event()
+        self.pending = deque()
+        self.draining = False
+        self.paused = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.running = True
+        self.error = None
+        self.closed.clear()
+        self.manager.loop.call_soon_threadsafe(self.connect, self.url)
+        return self
+
+    def close(self):
+        self.manager.loop.call_soon_threadsafe(self.stop)
+        self.closed.wait()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.retry_handle:
+            self.retry_handle.cancel()
+            self.retry_handle = None
+        if self.connection:
+            self.connection.cancel()
+        if self.protocol:
+            self.protocol.transport.close()
+        else:
+            self.finish()
+
+    def finish(self):
+        self.manager.streams.discard(self)
+        self.closed.set()
+
+    # everything below runs on the manager's event loop
+
+    def connect(self, url):
+        self.retry_handle = None
+        if not self.running:
+            return
+        self.manager.streams.add(self)
+        loop = self.manager.loop
+        # building headers can refresh an access token, keep that off the loop
+        headers_future = loop.run_in_executor(None, self.build_headers)
+        headers_future.add_done_callback(lambda future: self.open(url, future))
+
+    def open(self, url, headers_future):
+        if not self.running:
+            self.finish()
+            return
+        if headers_future.exception():
+            self.connect_failed(headers_future.exception())
+            return
+        headers = {"Accept": "text/event-stream", "Cache-Control": "no-cache"}
+        headers.update(headers_future.result())
+        if self.last_id:
+            headers["Last-Event-ID"] = self.last_id
+        parts = urlsplit(url)
+        secure = parts.scheme == "https"
+        port = parts.port or (443 if secure else 80)
+        loop = self.manager.loop
+        self.connection = loop.create_task(loop.create_connection(
+            lambda: StreamProtocol(self, url, headers), parts.hostname, port,
+            ssl=self.manager.ssl_context if secure else None))
+        self.connection.add_done_callback(self.connected)
+
+    def connected(self, connection):
+        self.connection = None
+        # on success the protocol has registered itself in connection_made
+        if connection.cancelled():
+            self.finish()
+        elif connection.exception():
+            self.connect_failed(connection.exception())
+
+    def connect_failed(self, error):
+        self.failed(error, True)
+        if self.running:
+            self.schedule_reconnect()
+        else:
+            self.finish()
+
+    def redirect(self, location):
+        self.protocol = None
+        self.manager.loop.call_soon(self.connect, location)
+
+    def failed(self, error, retry):
+        self.error = error
+        self.manager.count("errors")
+        if not retry:
+            self.running = False
+
+    def disconnected(self, protocol):
+        if protocol is not self.protocol:
+            return
+        self.protocol = None
+        if self.running:
+            self.schedule_reconnect()
+        else:
+            self.finish()
+
+    def schedule_reconnect(self):
+        self.manager.count("reconnects")
+        self.retry_handle = self.manager.loop.call_later(self.retry / 1000.0, self.connect, self.url)
+
+    def handle_event(self, protocol, raw):
+        msg = Event.parse(raw)
+        if msg.data == "credential is no longer valid":
+            # reconnect with fresh credentials
+            protocol.transport.close()
+            return
+        if msg.retry:
+            self.retry = msg.retry
+        if msg.id:
+            self.last_id = msg.id
+        if msg.data == "null":
+            return
+        # decoding a large snapshot here would hold up every other stream
+        self.dispatch(msg.event, msg.data)
+
+    def dispatch(self, event, data):
+        manager = self.manager
+        manager.count("events")
+        manager.add_queue_depth(1)
+        with self.lock:
+            self.pending.append((event, data, time.time()))
+            if len(self.pending) >= manager.max_pending and self.protocol and not self.paused:
+                # stop reading until the handler catches up
+                self.paused = True
+                self.protocol.transport.pause_reading()
+            if self.draining:
+                return
+            self.draining = True
+        manager.executor.submit(self.drain)
+
+    def resume(self):
+        if self.protocol:
+            self.protocol.transport.resume_reading()
+
+    # runs on a worker thread
+
+    def drain(self):
+        manager = self.manager
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.draining = False
+                    return
+                event, data, received = self.pending.popleft()
+                if self.paused and len(self.pending) <= manager.max_pending // 2:
+                    self.paused = False
+                    manager.loop.call_soon_threadsafe(self.resume)
+            manager.add_queue_depth(-1)
+            started = time.time()
+            try:
+                msg_data = self.codec.loads(data)
+                msg_data["event"] = event
+                if self.stream_id:
+                    msg_data["stream_id"] = self.stream_id
+                self.stream_handler(msg_data)
+            except Exception as e:
+                self.error = e
+                manager.count("errors")
+            manager.record_latency(time.time() - started, started - received)
+
+
+class StreamManager:
+    """
+    Runs any number of database streams on one event loop thread, instead of
+    a thread and blocking connection per stream, and calls their handlers on
+    a bounded pool of worker threads.
+    """
+    def __init__(self, max_workers=8, max_pending=1000):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.ssl_context = ssl.create_default_context()
+        self.streams = set()
+        self.queue_depth = 0
+        self.counters = {"events": 0, "errors": 0, "reconnects": 0}
+        self.handler_calls = 0
+        self.handler_time = 0.0
+        self.handler_time_max = 0.0
+        self.wait_time = 0.0
+        self.started = time.time()
+        self.metrics_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stream(self, url, stream_handler, build_headers, stream_id=None, codec=None):
+        return ManagedStream(self, url, stream_handler, build_headers, stream_id, codec).start()
+
+    def count(self, name):
+        with self.metrics_lock:
+            self.counters[name] += 1
+
+    def add_queue_depth(self, change):
+        with self.metrics_lock:
+            self.queue_depth += change
+
+    def record_latency(self, handler_time, wait_time):
+        with self.metrics_lock:
+            self.handler_calls += 1
+            self.handler_time += handler_time
+            self.handler_time_max = max(self.handler_time_max, handler_time)
+            self.wait_time += wait_time
+
+    def metrics(self):
+        with self.metrics_lock:
+            calls = self.handler_calls or 1
+            return {
+                "streams": len(self.streams),
+                "events": self.counters["events"],
+                "event_rate": self.counters["events"] / (time.time() - self.started),
+                "queue_depth": self.queue_depth,
+                "errors": self.counters["errors"],
+                "reconnects": self.counters["reconnects"],
+                "handler_calls": self.handler_calls,
+                "handler_latency_avg": self.handler_time / calls,
+                "handler_latency_max": self.handler_time_max,
+                "queue_wait_avg": self.wait_time / calls,
+            }
+
+    def close(self):
+        for stream in list(self.streams):
+            stream.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
+
+
+json_whitespace = re.compile(b'[ \t\n\r]*')
+json_structure = re.compile(b'["{}\\[\\]]')
+json_string_end = re.compile(b'["\\\\]')
+json_scalar_end = re.compile(b'[ \t\n\r,}\\]]')
+
+
+class JSONChunkReader:
+    """
+    Reads consecutive JSON values from an iterator of byte chunks, holding
+    no more than the value currently being decoded in memory.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = bytearray()
+        self.pos = 0
+
+    def fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buf += chunk
+        return True
+
+    def need_more(self):
+        if not self.fill():
+            raise ValueError("Unexpected end of JSON stream")
+
+    def peek(self):
+        """ Skip whitespace and return the next byte, or None at the end. """
+        while True:
+            self.pos = json_whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return bytes(self.buf[self.pos:self.pos + 1])
+            if not self.fill():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected {0!r} in JSON stream".format(char))
+        self.pos += 1
+
+    def members(self, close):
+        """
+        Step through the members of the object or array just opened, yielding
+        the key or index of each. The caller reads each value before resuming.
+        """
+        if self.peek() == close:
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            if close == b'}':
+                key = self.read_value()
+                self.expect(b':')
+                yield key
+            else:
+                yield index
+                index += 1
+            separator = self.peek()
+            self.pos += 1
+            if separator == close:
+                return
+            if separator != b',':
+                raise ValueError("Expected ',' or {0!r} in JSON stream".format(close))
+
+    def read_value(self):
+        if self.peek() is None:
+            raise ValueError("Unexpected end of JSON stream")
+        # drop everything already decoded
+        del self.buf[:self.pos]
+        self.pos = 0
+        end = self.scan_value()
+        value = json.loads(self.buf[:end].decode("utf-8"))
+        self.pos = end
+        return value
+
+    def scan_value(self):
+        first = self.buf[self.pos:self.pos + 1]
+        if first == b'"':
+            return self.scan_string(self.pos + 1)
+        if first not in (b'{', b'['):
+            return self.scan_scalar(self.pos)
+        depth = 0
+        i = self.pos
+        while True:
+            match = json_structure.search(self.buf, i)
+            if match is None:
+                i = len(self.buf)
+                self.need_more()
+                continue
+            char = match.group()
+            if char == b'"':
+                i = self.scan_string(match.end())
+                continue
+            i = match.end()
+            if char in (b'{', b'['):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return i
+
+    def scan_string(self, i):
+        while True:
+            match = json_string_end.search(self.buf, i)
+            if match is None:
+                i = len(self.buf)
+                self.need_more()
+                continue
+            if match.group() == b'"':
+                return match.end()
+            # skip the escaped character
+            i = match.end() + 1
+            while len(self.buf) < i:
+                self.need_more()
+
+    def scan_scalar(self, i):
+        while True:
+            match = json_scalar_end.search(self.buf, i)
+            if match is not None:
+                return match.start()
+            i = len(self.buf)
+            if not self.fill():
+                return i
+
+
+class StreamData:
+    """
+    Lazily decoded data of a put or patch stream event.
+
+    Iterating yields (path, key, value) for each top-level child of the data,
+    decoding one child at a time as the event arrives. Primitive data is
+    yielded once with a key of None. The data can only be iterated once.
+    """
+    def __init__(self, chunks):
+        self.reader = JSONChunkReader(chunks)
+        self.path = None
+        self.data = None
+        self.streaming = False
+        self.reader.expect(b'{')
+        for key in self.reader.members(b'}'):
+            if key == "data" and self.path is not None:
+                # leave the data to be decoded while iterating
+                self.streaming = True
+                return
+            value = self.reader.read_value()
+            if key == "path":
+                self.path = value
+            elif key == "data":
+                self.data = value
+
+    def __iter__(self):
+        if not self.streaming:
+            # data came before path so it had to be decoded in one go
+            return iter_children(self.path, self.data)
+        return self.iter_streamed()
+
+    def iter_streamed(self):
+        reader = self.reader
+        first = reader.peek()
+        if first in (b'{', b'['):
+            reader.pos += 1
+            close = b'}' if first == b'{' else b']'
+            for key in reader.members(close):
+                yield self.path, key, reader.read_value()
+        else:
+            yield self.path, None, reader.read_value()
+
+
+def iter_children(path, data):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield path, key, value
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            yield path, index, value
+    else:
+        yield path, None, data
+
+
+class LocalMirror:
+    """
+    An in-memory copy of the data at a database reference, kept up to date by
+    a stream. Reads and ordered queries are answered locally.
+
+    indexes is a list of (path, child) pairs, e.g. [("players", "points")],
+    kept sorted so order_by_child queries on them are answered with binary
+    searches instead of sorting every child.
+    """
+    def __init__(self, query, token=None, indexes=(), stream_id=None):
+        self.tree = None
+        self.lock = threading.RLock()
+        self.ready = threading.Event()
+        self.indexes = {}
+        self.subscriptions = {}
+        self.next_subscription = 0
+        for path, child in indexes:
+            self.add_index(path, child)
+        self.stream = query.stream(self.handle_event, token, stream_id)
+
+    def wait(self, timeout=None):
+        """ Block until the first snapshot arrives, returns False on timeout. """
+        return self.ready.wait(timeout)
+
+    def close(self):
+        self.stream.close()
+        return self
+
+    def add_index(self, path, child):
+        path = path.strip("/")
+        child = child.strip("/")
+        with self.lock:
+            if (path, child) not in self.indexes:
+                index = ChildIndex(child)
+                index.rebuild(self.node(path))
+                self.indexes[(path, child)] = index
+
+    def subscribe(self, path, callback):
+        """
+        Call callback(path, value) whenever data at, above or below path
+        changes. Returns an id for unsubscribe().
+        """
+        with self.lock:
+            self.next_subscription += 1
+            self.subscriptions[self.next_subscription] = (path.strip("/"), callback)
+            return self.next_subscription
+
+    def unsubscribe(self, subscription_id):
+        with self.lock:
+            self.subscriptions.pop(subscription_id, None)
+
+    def handle_event(self, message):
+        event = message["event"]
+        path = message["path"].strip("/")
+        if event == "put":
+            changes = [(path, message["data"])]
+        elif event == "patch":
+            changes = [(join_path(path, key), value) for key, value in message["data"].items()]
+        else:
+            return
+        with self.lock:
+            for changed, value in changes:
+                self.set_node(changed, normalize_tree(value))
+                self.update_indexes(changed)
+            self.ready.set()
+            notify = [(path, callback) for path, callback in self.subscriptions.values()
+                      if any(related_paths(path, changed) for changed, value in changes)]
+            notify = [(path, callback, self.node(path)) for path, callback in notify]
+        for path, callback, value in notify:
+            callback(path, value)
+
+    def node(self, path):
+        node = self.tree
+        for key in path.split("/") if path else []:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return node
+
+    def set_node(self, path, value):
+        if not path:
+            self.tree = value
+            return
+        keys = path.split("/")
+        if value is None:
+            # delete and prune parents left empty, as Firebase does
+            parents = []
+            node = self.tree
+            for key in keys[:-1]:
+                if not isinstance(node, dict) or key not in node:
+                    return
+                parents.append((node, key))
+                node = node[key]
+            if isinstance(node, dict):
+                node.pop(keys[-1], None)
+                while not node and parents:
+                    node, key = parents.pop()
+                    del node[key]
+                if not self.tree:
+                    self.tree = None
+            return
+        if not isinstance(self.tree, dict):
+            self.tree = {}
+        node = self.tree
+        for key in keys[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        node[keys[-1]] = value
+
+    def update_indexes(self, changed):
+        for (path, child), index in self.indexes.items():
+            if not changed or changed == path or path.startswith(changed + "/"):
+                index.rebuild(self.node(path))
+            elif not path or changed.startswith(path + "/"):
+                key = changed[len(path) + 1 if path else 0:].split("/")[0]
+                index.update(key, self.node(join_path(path, key)))
+
+    def get(self, path=""):
+        """ The value at path, or None. The value is shared, don't modify it. """
+        with self.lock:
+            return self.node(path.strip("/"))
+
+    def query(self, path="", order_by_child=None, order_by_key=False, order_by_value=False, start_at=None,
+              end_at=None, equal_to=None, limit_to_first=None, limit_to_last=None):
+        """ Run a query on the children at path, returns a PyreResponse in query order. """
+        path = path.strip("/")
+        with self.lock:
+            node = self.node(path)
+            if not isinstance(node, dict):
+                return PyreResponse(node, path.split("/")[-1])
+            if equal_to is not None:
+                start_at = end_at = equal_to
+            index = self.indexes.get((path, order_by_child.strip("/"))) if order_by_child else None
+            if index:
+                keys = index.range(start_at, end_at)
+            elif order_by_child or order_by_value:
+                child = order_by_child.strip("/") if order_by_child else None
+                entries = sorted((firebase_value(child_value(value, child) if child else value), firebase_key(key), key)
+                                 for key, value in node.items())
+                keys = [entry[2] for entry in range_entries(entries, start_at, end_at, firebase_value)]
+            else:
+                entries = sorted(((), firebase_key(key), key) for key in node)
+                keys = [entry[2] for entry in range_entries(entries, start_at, end_at, firebase_key, by_key=True)]
+            if limit_to_first is not None:
+                keys = keys[:limit_to_first]
+            if limit_to_last is not None:
+                keys = keys[max(len(keys) - limit_to_last, 0):]
+            return PyreResponse(OrderedDict((key, node[key]) for key in keys), path.split("/")[-1])
+
+
+class ChildIndex:
+    """ Children of one location sorted by the value of child, in Firebase's order. """
+    def __init__(self, child):
+        self.child = child
+        self.entries = []
+        self.positions = {}
+
+    def rebuild(self, node):
+        self.positions = {}
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self.positions[key] = (firebase_value(child_value(value, self.child)), firebase_key(key), key)
+        self.entries = sorted(self.positions.values())
+
+    def update(self, key, value):
+        old = self.positions.pop(key, None)
+        if old is not None:
+            del self.entries[bisect.bisect_left(self.entries, old)]
+        if value is not None:
+            entry = (firebase_value(child_value(value, self.child)), firebase_key(key), key)
+            self.positions[key] = entry
+            bisect.insort(self.entries, entry)
+
+    def range(self, start_at=None, end_at=None):
+        return [entry[2] for entry in range_entries(self.entries, start_at, end_at, firebase_value)]
+
+
+def range_entries(entries, start_at, end_at, sort_key, by_key=False):
+    """ The slice of sorted (value, key, name) entries from start_at to end_at. """
+    low, high = 0, len(entries)
+    if start_at is not None:
+        bound = sort_key(start_at)
+        low = bisect.bisect_left(entries, ((), bound) if by_key else (bound,))
+    if end_at is not None:
+        bound = sort_key(end_at)
+        high = bisect.bisect_right(entries, ((), bound, str(end_at)) if by_key else (bound, MAX_KEY))
+    return entries[low:high]
+
+
+# sorts after every firebase_key
+MAX_KEY = (2,)
+
+
+def firebase_key(key):
+    """ Sort key for child keys: 32-bit integer keys numerically first, then strings. """
+    key = str(key)
+    if key[:1].isdigit() or key[:1] == "-":
+        try:
+            number = int(key)
+        except ValueError:
+            return 1, key
+        if -2147483648 <= number <= 2147483647 and str(number) == key:
+            return 0, number
+    return 1, key
+
+
+def firebase_value(value):
+    """ Sort key for values: null, false, true, numbers, strings, then objects. """
+    if value is None:
+        return 0, 0
+    if value is False:
+        return 1, 0
+    if value is True:
+        return 2, 0
+    if isinstance(value, (int, float)):
+        return 3, value
+    if isinstance(value, str):
+        return 4, value
+    return 5, 0
+
+
+def child_value(value, child):
+    for key in child.split("/"):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def related_paths(path, other):
+    """ True if path and other are the same location or one is below the other. """
+    return (not path or not other or path == other or path.startswith(other + "/") or
+            other.startswith(path + "/"))
+
+
+def normalize_tree(value):
+    """ Replace the lists Firebase sends for integer keyed children with dicts. """
+    if isinstance(value, list):
+        return dict((str(index), normalize_tree(item)) for index, item in enumerate(value) if item is not None)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (list, dict)):
+                value[key] = normalize_tree(item)
+    return value
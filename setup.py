@@ -22,5 +22,10 @@ setup(
         'requests_toolbelt==0.7.0',
         'python_jwt==2.0.1',
         'pycryptodome==3.4.3'
-    ]
+    ],
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+        'orjson': ['orjson>=3'],
+        'ujson': ['ujson>=2'],
+    }
 )
@@ -1 +1 @@
-from .sseclient import SSEClient
\ No newline at end of file
+from .sseclient import SSEClient, IncompleteEvent
@@ -9,10 +9,65 @@ import requests
 
 # Technically, we should support streams that mix line endings.  This regex,
 # however, assumes that a system will provide consistent line endings.
-end_of_field = re.compile(r'\r\n\r\n|\r\r|\n\n')
+end_of_field = re.compile(b'\r\n\r\n|\r\r|\n\n')
+end_of_line = re.compile(b'[\r\n]')
+# Start of a data field whose preceding lines have all arrived.  The
+# lookahead makes sure an optional leading space has arrived too.
+data_field = re.compile(b'(?:^|[\r\n])data:(?: |(?=[^ ]))')
+
+
+class IncompleteEvent(Exception):
+    """
+    Raised while reading a streamed event's data if the connection drops
+    before the data field is complete.
+    """
+
+
+class EventBuffer(object):
+    """
+    Accumulates raw bytes from an event stream and splits off whole events.
+
+    Only newly arrived bytes (plus enough overlap to catch a terminator split
+    across two chunks) are scanned, so finding event boundaries is linear in
+    the size of the stream rather than quadratic in the size of an event.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        # Everything before this offset is known not to start a terminator.
+        self.scan_pos = 0
+
+    def __len__(self):
+        return len(self.buf)
+
+    def feed(self, chunk):
+        self.buf += chunk
+
+    def clear(self):
+        del self.buf[:]
+        self.scan_pos = 0
+
+    def consume(self, size):
+        del self.buf[:size]
+        self.scan_pos = 0
+
+    def next_event(self):
+        """
+        Remove the next complete event from the buffer and return it decoded
+        as text, or return None if no complete event has arrived yet.
+        """
+        match = end_of_field.search(self.buf, max(0, self.scan_pos - 3))
+        if match is None:
+            self.scan_pos = len(self.buf)
+            return None
+        raw = self.buf[:match.start()].decode('utf-8')
+        del self.buf[:match.end()]
+        self.scan_pos = 0
+        return raw
+
 
 class SSEClient(object):
-    def __init__(self, url, session, build_headers, last_id=None, retry=3000, **kwargs):
+    def __init__(self, url, session, build_headers, last_id=None, retry=3000, stream_events=(), **kwargs):
         self.url = url
         self.last_id = last_id
         self.retry = retry
@@ -34,7 +89,17 @@ class SSEClient(object):
         self.requests_kwargs['headers']['Accept'] = 'text/event-stream'
 
         # Keep data here as it streams in
-        self.buf = u''
+        self.event_buffer = EventBuffer()
+
+        # Events named here are returned as soon as their data field starts,
+        # with the data handed over through Event.data_stream instead of
+        # being buffered in full.
+        self.stream_events = stream_events
+        # The streamed event currently being read, if any.
+        self.streamed = None
+        # Set while the fields following a streamed data field are still to
+        # be skipped.
+        self.event_tail = False
 
         self._connect()
 
@@ -47,39 +112,27 @@ class SSEClient(object):
         self.requester = self.session or requests
         self.resp = self.requester.get(self.url, stream=True, **self.requests_kwargs)
 
-        self.resp_iterator = self.resp.iter_content(decode_unicode=True)
+        self.resp_iterator = self.iter_content()
 
         # TODO: Ensure we're handling redirects.  Might also stick the 'origin'
         # attribute on Events like the Javascript spec requires.
         self.resp.raise_for_status()
 
-    def _event_complete(self):
-        return re.search(end_of_field, self.buf) is not None
+    def iter_content(self):
+        # A chunked response can be consumed chunk by chunk as it arrives.
+        # Otherwise a sized read blocks until the whole size is available, so
+        # fall back to single bytes rather than holding back short events.
+        chunk_size = None if getattr(self.resp.raw, 'chunked', False) else 1
+        return self.resp.iter_content(chunk_size=chunk_size)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        while not self._event_complete():
-            try:
-                nextchar = next(self.resp_iterator)
-                self.buf += nextchar
-            except (StopIteration, requests.RequestException):
-                time.sleep(self.retry / 1000.0)
-                self._connect()
+        if self.streamed is not None:
+            self._drain_streamed_event()
 
-                # The SSE spec only supports resuming from a whole message, so
-                # if we have half a message we should throw it out.
-                head, sep, tail = self.buf.rpartition('\n')
-                self.buf = head + sep
-                continue
-
-        split = re.split(end_of_field, self.buf)
-        head = split[0]
-        tail = "".join(split[1:])
-
-        self.buf = tail
-        msg = Event.parse(head)
+        msg = self._read_event()
 
         if msg.data == "credential is no longer valid":
             self._connect()
@@ -88,6 +141,10 @@ class SSEClient(object):
         if msg.data == 'null':
             return None
 
+        self._remember(msg)
+        return msg
+
+    def _remember(self, msg):
         # If the server requests a specific retry delay, we need to honor it.
         if msg.retry:
             self.retry = msg.retry
@@ -97,8 +154,80 @@ class SSEClient(object):
         if msg.id:
             self.last_id = msg.id
 
+    def _reconnect(self):
+        time.sleep(self.retry / 1000.0)
+        self._connect()
+
+        # The SSE spec only supports resuming from a whole message, so
+        # if we have half a message we should throw it out.
+        self.event_buffer.clear()
+        self.event_tail = False
+
+    def _read_event(self):
+        while True:
+            raw = self.event_buffer.next_event()
+            if raw is not None:
+                if not self.event_tail:
+                    return Event.parse(raw)
+                # Whatever followed the data field of a streamed event.
+                self.event_tail = False
+                self._remember(Event.parse(raw))
+                continue
+            if self.stream_events and not self.event_tail:
+                msg = self._start_streamed_event()
+                if msg is not None:
+                    return msg
+            try:
+                chunk = next(self.resp_iterator)
+            except (StopIteration, requests.RequestException):
+                self._reconnect()
+                continue
+            self.event_buffer.feed(chunk)
+
+    def _start_streamed_event(self):
+        buf = self.event_buffer.buf
+        match = data_field.search(buf)
+        if match is None:
+            return None
+        msg = Event.parse(buf[:match.start()].decode('utf-8'))
+        if msg.event not in self.stream_events:
+            return None
+        self.event_buffer.consume(match.end())
+        msg.data_stream = self._iter_data_field()
+        self.streamed = msg
+        self.event_tail = True
         return msg
 
+    def _iter_data_field(self):
+        buf = self.event_buffer
+        while True:
+            match = end_of_line.search(buf.buf)
+            if match is not None:
+                if match.start():
+                    yield bytes(buf.buf[:match.start()])
+                # Leave the line ending so the event terminator still matches.
+                buf.consume(match.start())
+                return
+            if len(buf):
+                yield bytes(buf.buf)
+                buf.clear()
+            try:
+                chunk = next(self.resp_iterator)
+            except (StopIteration, requests.RequestException):
+                # The next read fails as well and triggers the reconnect.
+                buf.clear()
+                self.event_tail = False
+                raise IncompleteEvent('Connection lost while reading event data')
+            buf.feed(chunk)
+
+    def _drain_streamed_event(self):
+        msg, self.streamed = self.streamed, None
+        try:
+            for _ in msg.data_stream:
+                pass
+        except IncompleteEvent:
+            pass
+
     if six.PY2:
         next = __next__
 
@@ -112,6 +241,9 @@ class Event(object):
         self.event = event
         self.id = id
         self.retry = retry
+        # Iterator over the raw bytes of the data field for events the client
+        # was asked to stream, otherwise None.
+        self.data_stream = None
 
     def dump(self):
         lines = []
@@ -135,6 +267,7 @@ class Event(object):
         and return a Event object.
         """
         msg = cls()
+        data = []
         for line in raw.split('\n'):
             m = cls.sse_line_pattern.match(line)
             if m is None:
@@ -149,12 +282,8 @@ class Event(object):
                 continue
 
             if name == 'data':
-                # If we already have some data, then join to it with a newline.
-                # Else this is it.
-                if msg.data:
-                    msg.data = '%s\n%s' % (msg.data, value)
-                else:
-                    msg.data = value
+                # Multiple data lines are joined with newlines below.
+                data.append(value)
             elif name == 'event':
                 msg.event = value
             elif name == 'id':
@@ -162,6 +291,8 @@ class Event(object):
             elif name == 'retry':
                 msg.retry = int(value)
 
+        if data:
+            msg.data = '\n'.join(data)
         return msg
 
     def __str__(self):
@@ -1,6 +1,9 @@
+import threading
+
 import pytest
+from requests.adapters import HTTPAdapter
 
-from tests.tools import make_db
+from tests.tools import make_db, make_fake_db, make_response
 
 
 @pytest.fixture(scope='session')
@@ -11,3 +14,28 @@ def db():
         yield lambda: make_db(service_account=True).child('pyrebase_tests')
     finally:
         make_db(service_account=True).child('pyrebase_tests').remove()
+
+
+@pytest.fixture
+def database():
+    """ A Database whose requests go to a FakeSession, database.requests. """
+    return make_fake_db()
+
+
+@pytest.fixture
+def script(monkeypatch):
+    """ Answers for HTTPAdapter.send, in order: a status code, a (status code, headers) pair or an exception. """
+    answers = []
+    sent = []
+    lock = threading.Lock()
+
+    def send(adapter, request, **kwargs):
+        with lock:
+            sent.append(request.method)
+            answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return make_response(*answer) if isinstance(answer, tuple) else make_response(answer)
+
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    return answers, sent
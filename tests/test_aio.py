@@ -0,0 +1,199 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from pyrebase.aio import AsyncDatabase, AsyncResponse, AsyncStream, run_many
+
+
+class FakeRequests:
+    """ Answers requests with respond(method, url, headers, data) -> (status, content, headers). """
+    def __init__(self, respond=None, stream_responses=None):
+        self.respond = respond
+        self.calls = []
+        self.session = FakeStreamSession(stream_responses or {})
+
+    async def request(self, method, url, headers=None, data=None):
+        self.calls.append((method, url, headers, data))
+        status, content, response_headers = self.respond(method, url, headers, data)
+        return AsyncResponse(url, status, "OK", response_headers, content)
+
+    def get_session(self):
+        return self.session
+
+
+class FakeStreamSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    async def get(self, url, headers=None, allow_redirects=True, timeout=None):
+        self.requests.append((url, dict(headers)))
+        return self.responses[url]
+
+
+class FakeStreamResponse:
+    def __init__(self, status, headers=None, chunks=()):
+        self.status = status
+        self.reason = "OK"
+        self.headers = headers or {}
+        self.content = FakeContent(chunks)
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class FakeContent:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def iter_any(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def make_database(respond=None):
+    requests = FakeRequests(respond)
+    return AsyncDatabase(None, "key", "https://example.firebaseio.com", requests), requests
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_get_and_write():
+    def respond(method, url, headers, data):
+        if method == "GET":
+            return 200, b'{"b": {"age": 2}, "a": {"age": 1}}', {}
+        return 200, data or b"null", {}
+
+    db, requests = make_database(respond)
+
+    async def main():
+        users = await db.child("users").order_by_child("age").get(sort=True)
+        written = await db.child("users").child("c").set({"age": 3})
+        removed = await db.child("users").child("c").remove()
+        return users, written, removed
+
+    users, written, removed = run(main())
+    assert [user.key() for user in users.each()] == ["a", "b"]
+    assert written == {"age": 3}
+    assert removed is None
+    assert [(method, url, data) for method, url, headers, data in requests.calls] == [
+        ("GET", 'https://example.firebaseio.com/users.json?orderBy=%2522age%2522', None),
+        ("PUT", "https://example.firebaseio.com/users/c.json", b'{"age":3}'),
+        ("DELETE", "https://example.firebaseio.com/users/c.json", None),
+    ]
+
+
+def test_errors_are_raised():
+    db, requests = make_database(lambda method, url, headers, data: (403, b'{"error": "Permission denied"}', {}))
+    with pytest.raises(Exception) as info:
+        run(db.child("private").get())
+    assert "Permission denied" in str(info.value)
+
+
+def test_get_many():
+    def respond(method, url, headers, data):
+        name = url.split("/")[-1].split(".")[0]
+        return 200, json.dumps({"name": name}).encode("utf-8"), {}
+
+    db, requests = make_database(respond)
+    responses = run(db.get_many(["users/rick", "users/morty"], max_workers=1))
+    assert list(responses) == ["users/rick", "users/morty"]
+    assert responses["users/morty"].val() == {"name": "morty"}
+
+
+def test_transaction():
+    state = {"value": 1, "etag": "1", "conflicts": 1}
+
+    def respond(method, url, headers, data):
+        if method == "GET":
+            return 200, json.dumps(state["value"]).encode("utf-8"), {"ETag": state["etag"]}
+        if state["conflicts"]:
+            # someone else wrote the location in between
+            state["conflicts"] -= 1
+            state["value"], state["etag"] = 5, "2"
+            return 412, b"5", {"ETag": "2"}
+        assert headers["if-match"] == state["etag"]
+        state["value"] = json.loads(data.decode("utf-8"))
+        return 200, data, {}
+
+    db, requests = make_database(respond)
+    assert run(db.child("counter").transaction(lambda count: count + 1)) == 6
+    assert state["value"] == 6
+
+
+def test_sync_only_methods_are_not_on_the_async_client():
+    db, requests = make_database()
+    for name in ("get_cached", "batch", "write_behind", "iterate", "export", "import_"):
+        assert not hasattr(db.child("a"), name)
+    for name in ("batch", "write_behind", "iterate", "export", "import_"):
+        with pytest.raises(AttributeError):
+            getattr(db, name)
+
+
+def test_stream_follows_redirects_with_its_headers():
+    event = b'event: put\ndata: {"path": "/", "data": {"a": 1}}\n\n'
+    redirect = FakeStreamResponse(307, {"Location": "https://other.firebaseio.com/users.json"})
+    events = FakeStreamResponse(200, chunks=[event[:10], event[10:]])
+    requests = FakeRequests(stream_responses={
+        "https://example.firebaseio.com/users.json": redirect,
+        "https://other.firebaseio.com/users.json": events,
+    })
+    received = []
+
+    async def build_headers():
+        return {"Authorization": "Bearer token"}
+
+    async def main():
+        stream = AsyncStream(requests, "https://example.firebaseio.com/users.json", received.append, build_headers,
+                             "users")
+        deadline = time.time() + 5
+        while not received and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        await stream.close()
+
+    run(main())
+    assert received == [{"path": "/", "data": {"a": 1}, "event": "put", "stream_id": "users"}]
+    assert [url for url, headers in requests.session.requests] == [
+        "https://example.firebaseio.com/users.json", "https://other.firebaseio.com/users.json"]
+    assert all(headers["Authorization"] == "Bearer token" for url, headers in requests.session.requests)
+    assert redirect.released and events.released
+
+
+def test_run_many_keeps_order_and_returns_errors():
+    active = []
+    most_active = []
+
+    async def call(i):
+        active.append(i)
+        most_active.append(len(active))
+        await asyncio.sleep(0.01 * (5 - i))
+        active.remove(i)
+        if i == 2:
+            raise ValueError(i)
+        return i * 10
+
+    results = run(run_many(call, [(i,) for i in range(5)], max_workers=2))
+    assert results[:2] == [0, 10]
+    assert isinstance(results[2], ValueError)
+    assert results[3:] == [30, 40]
+    assert max(most_active) == 2
+
+
+def test_run_many_rate_limit():
+    async def call(i):
+        return i
+
+    started = time.time()
+    assert run(run_many(call, [(i,) for i in range(15)], rate_limit=50)) == list(range(15))
+    # a burst of 50 goes through at once
+    assert time.time() - started < 0.5
+    started = time.time()
+    run(run_many(call, [(i,) for i in range(6)], rate_limit=5))
+    assert time.time() - started >= 0.15
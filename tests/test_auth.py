@@ -0,0 +1,125 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+from Crypto.PublicKey import RSA
+from requests.exceptions import HTTPError
+
+from pyrebase.pyrebase import Auth, RateLimiter, run_many
+from tests.tools import FakeResponse, FakeSession
+
+
+def make_auth(respond):
+    return Auth("key", FakeSession(respond), None)
+
+
+def refresh(request):
+    """ Answers token refreshes, slower for earlier tokens so they finish out of order. """
+    token = request.json["refreshToken"]
+    time.sleep(0.01 * (5 - int(token[-1])))
+    if token == "token2":
+        return FakeResponse({"error": {"message": "TOKEN_EXPIRED"}}, 400)
+    return FakeResponse({"user_id": "user" + token[-1], "id_token": "id" + token[-1], "refresh_token": token})
+
+
+def test_refresh_many_keeps_order_and_returns_errors():
+    auth = make_auth(refresh)
+    users = auth.refresh_many(["token{0}".format(i) for i in range(5)], max_workers=5)
+    assert [user["userId"] for user in users[:2] + users[3:]] == ["user0", "user1", "user3", "user4"]
+    assert isinstance(users[2], HTTPError)
+    assert "TOKEN_EXPIRED" in str(users[2])
+    assert all(request.url == "https://securetoken.googleapis.com/v1/token?key=key"
+               for request in auth.requests.requests)
+
+
+def test_sign_in_many_leaves_current_user():
+    def verify_password(request):
+        if request.json["password"] != "secret":
+            return FakeResponse({"error": {"message": "INVALID_PASSWORD"}}, 400)
+        return FakeResponse({"email": request.json["email"], "idToken": "id"})
+
+    auth = make_auth(verify_password)
+    users = auth.sign_in_many([("a@example.com", "secret"), ("b@example.com", "wrong"), ("c@example.com", "secret")])
+    assert users[0]["email"] == "a@example.com"
+    assert isinstance(users[1], HTTPError)
+    assert users[2]["email"] == "c@example.com"
+    assert auth.current_user is None
+
+
+def test_run_many_limits_workers():
+    lock = threading.Lock()
+    active = [0]
+    most_active = [0]
+
+    def call(i):
+        with lock:
+            active[0] += 1
+            most_active[0] = max(most_active[0], active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+        if i == 3:
+            raise ValueError(i)
+        return i
+
+    results = run_many(call, [(i,) for i in range(10)], max_workers=3)
+    assert results[:3] + results[4:] == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert isinstance(results[3], ValueError)
+    assert most_active[0] == 3
+
+
+def test_run_many_paces_calls():
+    started = []
+    run_many(lambda i: started.append(time.time()), [(i,) for i in range(7)], max_workers=7, rate_limit=5)
+    started.sort()
+    # a burst of five, then one call every 0.2 seconds
+    assert started[4] - started[0] < 0.1
+    assert started[6] - started[0] >= 0.35
+
+
+def test_rate_limiter_reserves_in_debt(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    limiter = RateLimiter(10, burst=2)
+    assert [limiter.reserve() for _ in range(4)] == [0, 0, pytest.approx(0.1), pytest.approx(0.2)]
+    now[0] += 1
+    # the debt is paid back and the bucket refills up to the burst
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, pytest.approx(0.1)]
+
+
+def test_rate_limiter_pause(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    limiter = RateLimiter(10, burst=5)
+    limiter.pause(2)
+    assert limiter.reserve() == pytest.approx(2.1)
+
+
+class FakeCredentials:
+    service_account_email = "firebase@example.iam.gserviceaccount.com"
+    _private_key_pkcs8_pem = RSA.generate(1024).exportKey("PEM").decode("utf-8")
+
+
+def token_uid(token):
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode("utf-8"))["uid"]
+
+
+def test_private_key_is_parsed_once(monkeypatch):
+    parsed = []
+    import_key = RSA.importKey
+    monkeypatch.setattr(RSA, "importKey", lambda pem: parsed.append(pem) or import_key(pem))
+    auth = Auth("key", None, FakeCredentials())
+    tokens = [auth.create_custom_token("user{0}".format(i)) for i in range(3)]
+    assert len(parsed) == 1
+    assert auth.get_private_key() is auth.get_private_key()
+    assert [token_uid(token) for token in tokens] == ["user0", "user1", "user2"]
+
+
+def test_custom_tokens_keep_order_across_processes():
+    auth = Auth("key", None, FakeCredentials())
+    uids = ["user{0}".format(i) for i in range(20)]
+    tokens = auth.create_custom_tokens(uids, {"premium": True}, processes=2)
+    assert [token_uid(token) for token in tokens] == uids
@@ -0,0 +1,33 @@
+from pyrebase.pyrebase import common_ancestor
+
+
+def test_common_ancestor():
+    assert common_ancestor(["a/b/c", "a/b/d", "a/b"]) == "a/b"
+    assert common_ancestor(["a/b", "c"]) == ""
+
+
+def test_batch_patches_common_ancestor(database):
+    with database.child("users").batch() as batch:
+        batch.set("Morty/name", "Morty")
+        batch.update("Rick", {"name": "Rick", "age": 70})
+        batch.remove("Jerry")
+    assert database.requests.writes() == [("PATCH", "https://example.firebaseio.com/users.json", {
+        "Morty/name": "Morty", "Rick/name": "Rick", "Rick/age": 70, "Jerry": None})]
+
+
+def test_batch_flushes_on_conflicting_paths(database):
+    batch = database.batch()
+    batch.set("users/Morty/name", "Morty")
+    batch.set("users/Morty", {"name": "Mortimer"})
+    batch.flush()
+    assert [data for method, url, data in database.requests.writes()] == [
+        {"name": "Morty"}, {"Morty": {"name": "Mortimer"}}]
+
+
+def test_batch_flushes_at_max_operations(database):
+    batch = database.batch(max_operations=2)
+    for i in range(5):
+        batch.set("items/{0}".format(i), i)
+    assert len(database.requests.requests) == 2
+    batch.flush()
+    assert database.requests.writes()[-1] == ("PATCH", "https://example.firebaseio.com/items.json", {"4": 4})
@@ -0,0 +1,34 @@
+from collections import OrderedDict
+
+import pytest
+
+from pyrebase.pyrebase import JSONCodec, get_codec
+
+
+def test_json_codec_works_on_bytes():
+    codec = get_codec(None)
+    assert isinstance(codec, JSONCodec)
+    encoded = codec.dumps({"name": "Mörty", 1: [True, None]})
+    assert encoded == b'{"name":"M\\u00f6rty","1":[true,null]}'
+    assert codec.loads(encoded) == {"name": "Mörty", "1": [True, None]}
+    assert codec.loads(encoded.decode("utf-8")) == {"name": "Mörty", "1": [True, None]}
+
+
+def test_json_kwargs():
+    codec = get_codec("json")
+    assert codec.dumps({"b": 1, "a": 2}, sort_keys=True) == b'{"a": 2, "b": 1}'
+    assert isinstance(codec.loads(b'{"a": 1}', object_pairs_hook=OrderedDict), OrderedDict)
+
+
+@pytest.mark.parametrize("name", ["orjson", "ujson"])
+def test_optional_codecs_match_json(name):
+    pytest.importorskip(name)
+    codec = get_codec(name)
+    data = {"name": "Mörty / Smith", 1: [1.5, True, None], "nested": {"a": {}}}
+    assert codec.loads(codec.dumps(data)) == get_codec("json").loads(get_codec("json").dumps(data))
+    assert isinstance(codec.loads(b'{"a": 1}', object_pairs_hook=OrderedDict), OrderedDict)
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec("yaml")
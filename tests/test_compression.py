@@ -0,0 +1,57 @@
+import json
+
+from pyrebase.pyrebase import iter_json
+from tests.tools import make_fake_db
+
+
+def sent(db):
+    """ (headers, raw body) of each write. """
+    return [(request.headers, request.data) for request in db.requests.requests]
+
+
+def test_bodies_are_not_compressed_by_default():
+    db = make_fake_db()
+    db.child("users").set({"name": "x" * 5000})
+    headers, data = sent(db)[0]
+    assert "Content-Encoding" not in headers
+    assert data == b'{"name":"' + b"x" * 5000 + b'"}'
+
+
+def test_bodies_over_the_threshold_are_gzipped():
+    db = make_fake_db(compress_threshold=1024)
+    db.child("users").set({"name": "x" * 5000})
+    db.child("users").update({"name": "small"})
+    (put_headers, put_data), (patch_headers, patch_data) = sent(db)
+    assert put_headers["Content-Encoding"] == "gzip"
+    assert len(put_data) < 1024
+    assert db.requests.requests[0].json == {"name": "x" * 5000}
+    assert "Content-Encoding" not in patch_headers
+    assert patch_data == b'{"name":"small"}'
+
+
+def test_iter_json_chunks_a_document():
+    data = {"users": dict(("u{0}".format(i), {"n": i, "name": "Mörty"}) for i in range(500))}
+    chunks = list(iter_json(data, chunk_size=1000))
+    assert len(chunks) > 1
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    assert json.loads(b"".join(chunks).decode("utf-8")) == data
+
+
+def test_iterators_are_streamed():
+    data = dict(("u{0}".format(i), i) for i in range(1000))
+    for threshold in (None, 1024 * 1024):
+        db = make_fake_db(compress_threshold=threshold)
+        db.child("users").set(iter_json(data, chunk_size=100))
+        request = db.requests.requests[0]
+        # chunked bodies are compressed whatever their size once compression is on
+        assert (request.headers.get("Content-Encoding") == "gzip") == (threshold is not None)
+        assert request.json == data
+
+
+def test_import_compresses_updates():
+    db = make_fake_db(compress_threshold=100)
+    records = [{"path": "u{0}".format(i), "value": "x" * 100} for i in range(10)]
+    db.child("backup").import_(records, max_workers=1)
+    request = db.requests.requests[0]
+    assert request.headers["Content-Encoding"] == "gzip"
+    assert request.json == dict(("u{0}".format(i), "x" * 100) for i in range(10))
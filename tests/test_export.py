@@ -0,0 +1,84 @@
+import io
+import json
+
+from tests.tools import FakeResponse, make_fake_db
+
+
+TREE = {
+    "users": dict(("u{0}".format(i), {"name": "n{0}".format(i)}) for i in range(10)),
+    "config": {"theme": "dark"},
+    "count": 5,
+}
+
+
+def serve(request):
+    """ Serves shallow and $key range reads of TREE. """
+    node = TREE
+    for key in request.path.split("/"):
+        if key:
+            node = node.get(key) if isinstance(node, dict) else None
+    params = request.params
+    if isinstance(node, dict) and params.get("shallow"):
+        node = dict((key, True if isinstance(value, dict) else value) for key, value in node.items())
+    if isinstance(node, dict) and "startAt" in params:
+        node = dict((key, value) for key, value in node.items() if params["startAt"] <= key <= params["endAt"])
+    return FakeResponse(node)
+
+
+def rebuild(lines):
+    tree = {}
+    for line in lines:
+        record = json.loads(line)
+        node = tree
+        keys = record["path"].split("/")
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = record["value"]
+    return tree
+
+
+def test_export_splits_large_nodes_into_ranges():
+    db = make_fake_db(serve)
+    sink = io.StringIO()
+    stats = db.export(sink, max_children=4)
+    lines = sink.getvalue().splitlines()
+    assert rebuild(lines) == TREE
+    assert stats == {"records": 12, "requests": 6}
+    assert len([request for request in db.requests.requests if "startAt" in request.params]) == 3
+
+
+def test_export_resumes_from_file(tmpdir):
+    filename = str(tmpdir.join("export.ndjson"))
+    db = make_fake_db(serve)
+    db.export(filename, max_children=4)
+    with open(filename) as records:
+        lines = records.read().splitlines()
+    with open(filename, "w") as records:
+        records.write("\n".join(lines[:5]) + "\n" + lines[5][:10])
+    stats = db.export(filename, max_children=4)
+    with open(filename) as records:
+        lines = records.read().splitlines()
+    assert stats["records"] == 7
+    assert rebuild(lines) == TREE
+
+
+def test_export_splits_nodes_too_big_to_read_at_once():
+    tree = {"logs": {"day1": dict(("e{0}".format(i), {"text": "x" * 120, "tags": {"a": i}}) for i in range(3))}}
+
+    def respond(request):
+        node = tree
+        for key in request.path.split("/"):
+            if key:
+                node = node.get(key) if isinstance(node, dict) else None
+        if isinstance(node, dict) and request.params.get("shallow"):
+            node = dict((key, True if isinstance(value, dict) else value) for key, value in node.items())
+        return FakeResponse(node)
+
+    db = make_fake_db(respond)
+    sink = io.StringIO()
+    db.export(sink, max_bytes=100)
+    lines = sink.getvalue().splitlines()
+    assert rebuild(lines) == tree
+    # each event is too big for one response and split into its children
+    assert sorted(json.loads(line)["path"] for line in lines) == [
+        "logs/day1/e{0}/{1}".format(i, key) for i in range(3) for key in ("tags", "text")]
@@ -0,0 +1,17 @@
+from tests.tools import FakeResponse
+
+
+def test_get_many_keeps_query_state_per_entry(database):
+    database.requests.respond = lambda request: FakeResponse({"Morty": {"points": 2}, "Rick": {"points": 1}})
+    responses = database.get_many([
+        "users/Morty",
+        {"path": "users", "shallow": True, "key": "user_keys"},
+        {"path": "scores", "order_by_child": "points", "limit_to_last": 10},
+    ])
+    assert list(responses) == ["users/Morty", "user_keys", "scores"]
+    assert sorted(request.url for request in database.requests.requests) == [
+        "https://example.firebaseio.com/scores.json?orderBy=%2522points%2522&limitToLast=10",
+        "https://example.firebaseio.com/users.json?shallow=true",
+        "https://example.firebaseio.com/users/Morty.json?",
+    ]
+    assert responses["scores"].val() == {"Rick": {"points": 1}, "Morty": {"points": 2}}
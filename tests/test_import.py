@@ -0,0 +1,44 @@
+import io
+
+import pytest
+from requests.exceptions import HTTPError
+
+from pyrebase.pyrebase import RetryPolicy
+from tests.tools import make_transport_db
+
+
+def test_import_groups_records_by_size(database):
+    records = [{"path": "users/u{0}".format(i), "value": {"n": i}} for i in range(10)]
+    stats = database.child("backup").import_(records, max_bytes=60, max_workers=1)
+    updates = database.requests.writes()
+    assert stats["records"] == 10
+    assert all(url == "https://example.firebaseio.com/backup.json" for method, url, update in updates)
+    assert 1 < len(updates) < 10
+    merged = {}
+    for method, url, update in updates:
+        merged.update(update)
+    assert merged == dict(("users/u{0}".format(i), {"n": i}) for i in range(10))
+
+
+def test_import_splits_overlapping_paths(database):
+    source = io.StringIO('{"path": "", "value": {"a": 1, "b": {"c": 2}}}\n\n{"path": "b/c", "value": 3}\n')
+    database.import_(source)
+    assert [update for method, url, update in database.requests.writes()] == [{"a": 1, "b": {"c": 2}}, {"b/c": 3}]
+
+
+def test_import_is_retried_by_the_transport_only(script):
+    answers, sent = script
+    db = make_transport_db(RetryPolicy(max_retries=2, backoff=0.001))
+    answers.extend([503, (429, {"Retry-After": "0"}), 200, 200])
+    stats = db.import_(io.StringIO('{"path": "a", "value": 1}\n{"path": "a/b", "value": 2}\n'))
+    assert len(sent) == 4
+    assert (stats["requests"], stats["retries"]) == (2, 2)
+    answers.extend([503] * 10)
+    with pytest.raises(HTTPError):
+        db.import_([{"path": "a", "value": 1}])
+    assert len(sent) == 7
+
+
+def test_import_sends_repeated_paths_in_order(database):
+    database.import_([{"path": "a", "value": 1}, {"path": "b", "value": 1}, {"path": "a", "value": 2}])
+    assert [request.data for request in database.requests.requests] == [b'{"a":1,"b":1}', b'{"a":2}']
@@ -0,0 +1,85 @@
+from pyrebase.pyrebase import firebase_key, firebase_value
+from tests.tools import FakeResponse, make_fake_db
+
+
+def serving(children):
+    """ Serves ordered, filtered and limited children, in no particular order. """
+    def respond(request):
+        params = request.params
+        order_by = params["orderBy"]
+
+        def sort_key(item):
+            if order_by == "$key":
+                return firebase_key(item[0]), ()
+            value = item[1] if order_by == "$value" else item[1].get(order_by)
+            return firebase_value(value), firebase_key(item[0])
+
+        items = sorted(children.items(), key=sort_key)
+        if "startAt" in params:
+            start = params["startAt"]
+            bound = firebase_key(start) if order_by == "$key" else firebase_value(start)
+            items = [item for item in items if sort_key(item)[0] >= bound]
+        if "limitToLast" in params:
+            items = items[-params["limitToLast"]:]
+        else:
+            items = items[:params["limitToFirst"]]
+        return FakeResponse(dict(reversed(items)))
+    return respond
+
+
+def test_iterate_by_key():
+    children = dict(("user{0:03d}".format(i), i) for i in range(25))
+    db = make_fake_db(serving(children))
+    assert list(db.child("users").iterate(page_size=10)) == sorted(children.items())
+    assert [request.params["limitToFirst"] for request in db.requests.requests] == [10, 11, 11]
+
+
+def test_iterate_resumes_from_cursor():
+    children = dict(("user{0:03d}".format(i), i) for i in range(25))
+    db = make_fake_db(serving(children))
+    iterator = db.child("users").iterate(page_size=10, prefetch=True)
+    first = [next(iterator) for _ in range(12)]
+    assert iterator.cursor == "user011"
+    rest = list(db.child("users").iterate(page_size=10, cursor=iterator.cursor))
+    assert first + rest == sorted(children.items())
+
+
+def test_iterate_by_child_with_ties():
+    children = dict(("user{0:03d}".format(i), {"team": i // 8}) for i in range(30))
+    db = make_fake_db(serving(children))
+    iterator = db.iterate(order_by="team", page_size=3, prefetch=True)
+    keys = [key for key, value in iterator]
+    assert keys == sorted(children)
+    assert iterator.cursor == [3, "user029"]
+
+
+def test_iterate_by_child_past_missing_and_object_values():
+    children = {}
+    for i in range(12):
+        team = None if i < 4 else i // 3 if i < 9 else {"name": "team{0}".format(i)}
+        children["user{0:03d}".format(i)] = {"team": team} if team is not None else {"name": "n"}
+    db = make_fake_db(serving(children))
+    keys = [key for key, value in db.iterate(order_by="team", page_size=3)]
+    assert keys == sorted(children)
+    urls = [request.url for request in db.requests.requests]
+    assert any("startAt=null" in url for url in urls)
+    # object values can't be sent as startAt, the rest is read from the end
+    assert not any("startAt=%7B" in url for url in urls)
+    assert any("limitToLast" in url for url in urls)
+
+
+def test_iterate_integer_keys_sent_as_an_array():
+    values = [None, "v1", None] + ["v{0}".format(i) for i in range(3, 9)]
+
+    def respond(request):
+        start = int(request.params.get("startAt", "0"))
+        keys = [index for index, value in enumerate(values) if value is not None and index >= start]
+        keys = keys[:request.params["limitToFirst"]]
+        if not keys:
+            return FakeResponse(None)
+        # Firebase sends integer keyed children as an array, with null for missing keys
+        return FakeResponse([values[index] if index in keys else None for index in range(keys[-1] + 1)])
+
+    db = make_fake_db(respond)
+    expected = [(str(index), value) for index, value in enumerate(values) if value is not None]
+    assert list(db.child("items").iterate(page_size=3)) == expected
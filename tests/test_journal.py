@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+from requests.exceptions import ConnectionError
+
+from pyrebase.pyrebase import RetryPolicy, WriteJournal
+from tests.tools import FakeResponse, make_fake_db, make_transport_db
+
+
+class Server:
+    """ Answers writes with status_code while online and records what it received. """
+    def __init__(self, status_code=200, online=True):
+        self.status_code = status_code
+        self.online = online
+        self.received = []
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        if not self.online:
+            raise ConnectionError("offline")
+        with self.lock:
+            self.received.append((request.method, request.url, request.json))
+        return FakeResponse(status_code=self.status_code, headers={"Retry-After": "0"})
+
+
+def make_database(filename, status_code=200, online=True):
+    server = Server(status_code, online)
+    journal = WriteJournal(str(filename))
+    return make_fake_db(server, journal=journal), journal, server
+
+
+def test_writes_are_journaled_and_sent(tmp_path):
+    db, journal, server = make_database(tmp_path / "writes.db", online=False)
+    assert db.child("users").child("morty").set({"name": "Morty"}) == {"name": "Morty"}
+    key = db.child("posts").push({"title": "Pickle"})["name"]
+    db.child("users").update({"rick": {"name": "Rick"}})
+    server.online = True
+    assert journal.flush(5)
+    journal.close()
+    assert server.received == [("PATCH", "https://example.firebaseio.com/.json", {
+        "users/morty": {"name": "Morty"},
+        "posts/" + key: {"title": "Pickle"},
+        "users/rick": {"name": "Rick"},
+    })]
+    assert journal.stats()["sent"] == 3
+
+
+def test_writes_survive_an_outage_and_a_restart(tmp_path):
+    filename = tmp_path / "writes.db"
+    db, journal, server = make_database(filename, online=False)
+    db.child("devices/d1").set({"reading": 1, "unit": "C"})
+    db.child("devices/d1").update({"reading": 2})
+    db.child("devices/d1/reading").set(3)
+    db.child("devices").set({"d1": {"reading": 4}})
+    db.child("devices/d2").remove()
+    assert journal.flush(0.1) is False
+    # every write below devices was replaced by the set of devices
+    assert journal.pending() == 2
+    assert journal.stats()["compacted"] == 3
+    journal.close(0)
+    assert server.received == []
+
+    db, journal, server = make_database(filename)
+    assert journal.flush(5)
+    journal.close()
+    assert server.received == [("PATCH", "https://example.firebaseio.com/.json", {"devices": {"d1": {"reading": 4}}}),
+                                ("PATCH", "https://example.firebaseio.com/devices.json", {"d2": None})]
+
+
+def test_rejected_writes_are_raised_from_flush(tmp_path):
+    db, journal, server = make_database(tmp_path / "writes.db", status_code=403)
+    db.child("private").set(1)
+    with pytest.raises(Exception):
+        journal.flush(5)
+    assert journal.pending() == 0
+    assert journal.stats()["failed"] == 1
+    journal.close()
+    with pytest.raises(ValueError):
+        db.child("private").set(2)
+
+
+def test_concurrent_writes_share_commits(tmp_path):
+    db, journal, server = make_database(tmp_path / "writes.db")
+
+    def write(n):
+        for i in range(50):
+            db.child("counters").child("c{0}".format(n)).set(i)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert journal.flush(5)
+    journal.close()
+    stats = journal.stats()
+    assert stats["committed"] == 400
+    assert stats["commits"] <= 400
+    final = {}
+    for method, url, data in server.received:
+        final.update(data)
+    assert final == dict(("c{0}".format(n), 49) for n in range(8))
+
+
+def test_journal_requests_skip_transport_retries(tmp_path, script):
+    answers, sent = script
+    journal = WriteJournal(str(tmp_path / "writes.db"))
+    db = make_transport_db(RetryPolicy(max_retries=3, backoff=0.001), journal=journal)
+    answers.extend([(503, {"Retry-After": "0"}), (503, {"Retry-After": "0"}), 200])
+    db.child("a").set(1)
+    assert journal.flush(5)
+    journal.close()
+    # each failure is resent once, by the journal
+    assert sent == ["PATCH"] * 3
+    assert journal.stats()["retries"] == 2
+    # other threads still retry
+    answers.extend([503, 200])
+    assert db.child("a").get().val() is None
+    assert len(sent) == 5
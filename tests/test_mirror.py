@@ -0,0 +1,65 @@
+from pyrebase.pyrebase import LocalMirror, firebase_key, firebase_value
+
+
+class FakeQuery:
+    def stream(self, stream_handler, token=None, stream_id=None):
+        self.stream_handler = stream_handler
+        return self
+
+    def send(self, event, path, data):
+        self.stream_handler({"event": event, "path": path, "data": data})
+
+
+def make_mirror():
+    query = FakeQuery()
+    mirror = LocalMirror(query, indexes=[("players", "points")])
+    query.send("put", "/", {"players": {"a": {"points": 5}, "b": {"points": 1}, "c": {"points": 9}, "d": {}}})
+    return mirror, query
+
+
+def test_firebase_ordering():
+    values = ["b", 2, None, {"x": 1}, True, 1.5, False, "a"]
+    assert sorted(values, key=firebase_value) == [None, False, True, 1.5, 2, "a", "b", {"x": 1}]
+    keys = ["b", "10", "9", "-1", "a", "01"]
+    assert sorted(keys, key=firebase_key) == ["-1", "9", "10", "01", "a", "b"]
+
+
+def test_applies_put_and_patch_at_nested_paths():
+    mirror, query = make_mirror()
+    query.send("patch", "/players", {"b/points": 7, "e": {"points": 6}})
+    query.send("put", "/players/c", None)
+    assert mirror.wait(0)
+    assert mirror.get("players/b") == {"points": 7}
+    assert sorted(mirror.get("players")) == ["a", "b", "d", "e"]
+    query.send("put", "/players/d", None)
+    query.send("put", "/", None)
+    assert mirror.get() is None
+
+
+def test_indexed_queries():
+    mirror, query = make_mirror()
+    query.send("patch", "/players", {"b/points": 7, "e": {"points": 6}})
+    by_points = mirror.query("players", order_by_child="points")
+    assert list(by_points.val()) == ["d", "a", "e", "b", "c"]
+    assert list(mirror.query("players", order_by_child="points", start_at=5, end_at=7).val()) == ["a", "e", "b"]
+    assert list(mirror.query("players", order_by_child="points", limit_to_last=2).val()) == ["b", "c"]
+    assert list(mirror.query("players", order_by_child="points", equal_to=6).val()) == ["e"]
+
+
+def test_queries_without_index():
+    mirror, query = make_mirror()
+    assert list(mirror.query("players", order_by_key=True, start_at="b", end_at="c").val()) == ["b", "c"]
+    assert list(mirror.query("players", order_by_child="points", limit_to_first=2).val()) == ["d", "b"]
+    mirror.add_index("players", "points")
+    assert mirror.query("missing", order_by_key=True).val() is None
+
+
+def test_subscriptions():
+    mirror, query = make_mirror()
+    changes = []
+    subscription = mirror.subscribe("players/b", lambda path, value: changes.append((path, dict(value or {}))))
+    query.send("patch", "/players", {"b/points": 2})
+    query.send("put", "/players/a", {"points": 0})
+    mirror.unsubscribe(subscription)
+    query.send("put", "/players/b", None)
+    assert changes == [("players/b", {"points": 2})]
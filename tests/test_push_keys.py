@@ -0,0 +1,56 @@
+import random
+import threading
+import time
+
+from pyrebase.pyrebase import PUSH_CHARS, Database
+
+
+def make_database():
+    return Database(None, "key", "https://example.firebaseio.com", None)
+
+
+def decode_time(key):
+    number = 0
+    for char in key[:8]:
+        number = number * 64 + PUSH_CHARS.index(char)
+    return number
+
+
+def test_keys_are_unique_and_increasing_across_threads():
+    db = make_database()
+    per_thread = {}
+
+    def generate(thread):
+        keys = []
+        for _ in range(200):
+            keys.extend(db.generate_keys(random.randint(1, 50)))
+            keys.append(db.generate_key())
+        per_thread[thread] = keys
+
+    threads = [threading.Thread(target=generate, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    all_keys = [key for keys in per_thread.values() for key in keys]
+    assert len(set(all_keys)) == len(all_keys)
+    for keys in per_thread.values():
+        assert keys == sorted(keys)
+        assert all(len(key) == 20 and set(key) <= set(PUSH_CHARS) for key in keys)
+
+
+def test_keys_start_with_the_time():
+    db = make_database()
+    before = int(time.time() * 1000)
+    keys = db.generate_keys(1000)
+    assert before <= decode_time(keys[0]) <= int(time.time() * 1000) + 1
+    assert keys == sorted(keys)
+
+
+def test_keys_stay_ordered_when_clock_goes_back(monkeypatch):
+    db = make_database()
+    first = db.generate_keys(3)
+    monkeypatch.setattr(time, "time", lambda: 1.0)
+    later = db.generate_keys(3)
+    assert first + later == sorted(first + later)
+    assert len(set(first + later)) == 6
@@ -0,0 +1,35 @@
+from pyrebase.pyrebase import build_pyre_response
+
+
+def test_val_returns_decoded_data():
+    data = {"Morty": {"age": 14}, "Rick": {"age": 70}}
+    response = build_pyre_response(data, {}, "users")
+    assert response.val() is data
+    assert [(pyre.key(), pyre.val()) for pyre in response.each()] == list(data.items())
+
+
+def test_list_indices_with_duplicate_values():
+    response = build_pyre_response(["a", "b", "a", None, "b"], {}, "letters")
+    assert [pyre.key() for pyre in response.each()] == [0, 1, 2, 3, 4]
+    assert response.val() == ["a", "b", "a", None, "b"]
+
+
+def test_primitives_and_shallow():
+    assert build_pyre_response(3, {}, "count").val() == 3
+    assert build_pyre_response(3, {}, "count").each() is None
+    assert sorted(build_pyre_response({"a": 1, "b": 2}, {"shallow": True}, "").val()) == ["a", "b"]
+
+
+def test_ordered_results_keep_received_order():
+    data = {"c": {"age": 3}, "a": {"age": 1}}
+    assert list(build_pyre_response(data, {"orderBy": "age"}, "users").val()) == ["c", "a"]
+
+
+def test_sort_in_firebase_order():
+    data = {"e": {"age": "x"}, "d": {}, "c": {"age": 2}, "b": {"age": True}, "a": {"age": 2}, "f": {"age": None}}
+    response = build_pyre_response(data, {"orderBy": "age"}, "users", sort=True)
+    assert list(response.val()) == ["d", "f", "b", "a", "c", "e"]
+    by_key = build_pyre_response({"b": 1, "10": 2, "9": 3}, {"orderBy": "$key"}, "", sort=True)
+    assert list(by_key.val()) == ["9", "10", "b"]
+    by_value = build_pyre_response({"b": 1, "a": 1, "c": "1"}, {"orderBy": "$value"}, "", sort=True)
+    assert list(by_value.val()) == ["a", "b", "c"]
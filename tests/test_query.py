@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+from pyrebase.pyrebase import Database, Query
+
+
+def make_database():
+    return Database(None, "key", "https://example.firebaseio.com", None)
+
+
+def test_builders_return_new_queries():
+    db = make_database()
+    users = db.child("users")
+    recent = users.order_by_child("ts").limit_to_last(50)
+    assert isinstance(users, Query)
+    assert users.path == "users" and users.params == ()
+    assert recent.path == "users"
+    assert recent.build_query == {"orderBy": "ts", "limitToLast": 50}
+    assert users.child("Morty").path == "users/Morty"
+    assert db.child("/users", "Morty").path == "users/Morty"
+
+
+def test_queries_are_immutable_and_hashable():
+    db = make_database()
+    query = db.child("users").shallow()
+    with pytest.raises(AttributeError):
+        query.path = "other"
+    assert query == db.child("users").shallow()
+    assert query != make_database().child("users").shallow()
+    assert {query: 1}[db.child("users").shallow()] == 1
+
+
+def test_build_request_url_keeps_parameter_order():
+    db = make_database()
+    query = db.order_by_child("ts").start_at(3).order_by_child("name")
+    assert query.build_request_url("token") == \
+        "https://example.firebaseio.com/.json?auth=token&orderBy=%2522name%2522&startAt=3"
+
+
+def test_query_shared_between_threads():
+    query = make_database().child("users").order_by_key()
+    urls = []
+    threads = [threading.Thread(target=lambda i=i: urls.append(query.child(i).build_request_url(None)))
+               for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(urls) == sorted("https://example.firebaseio.com/users/{0}.json?orderBy=%2522%2524key%2522".format(i)
+                                  for i in range(20))
+    assert query.path == "users"
+
+
+def test_build_request_url_sends_json_values():
+    db = make_database()
+    url = db.child("users").order_by_child("age").start_at(None).end_at(2.5).build_request_url(None)
+    assert url.endswith("?orderBy=%2522age%2522&startAt=null&endAt=2.5")
+    assert db.child("users").shallow().build_request_url(None).endswith("?shallow=true")
@@ -0,0 +1,91 @@
+import pytest
+
+from pyrebase.pyrebase import JSONCodec, ReadCache
+from tests.tools import FakeResponse, make_fake_db
+
+
+class CountingCodec(JSONCodec):
+    def __init__(self):
+        JSONCodec.__init__(self)
+        self.decoded = 0
+
+    def loads(self, data, **json_kwargs):
+        self.decoded += 1
+        return JSONCodec.loads(self, data, **json_kwargs)
+
+
+class Server:
+    """ Serves data with an ETag per top level path; writes change the ETag. """
+    def __init__(self):
+        self.data = {"config": {"theme": "dark"}, "users": {}}
+        self.etags = {}
+
+    def __call__(self, request):
+        if request.method == "PUT":
+            self.etags[request.path.split("/")[0]] = "etag-2"
+            return FakeResponse(request.json)
+        etag = self.etags.setdefault(request.path, "etag-1")
+        if request.headers.get("if-none-match") == etag:
+            return FakeResponse(b"", 304, {"ETag": etag})
+        return FakeResponse(self.data.get(request.path), headers={"ETag": etag})
+
+
+def make_database(**kwargs):
+    server = Server()
+    return make_fake_db(server, cache=ReadCache(**kwargs), codec=CountingCodec()), server
+
+
+def revalidations(db):
+    return [request.headers.get("if-none-match") for request in db.requests.requests if request.method == "GET"]
+
+
+def test_revalidates_with_etag():
+    db, server = make_database()
+    assert db.child("config").get().val() == {"theme": "dark"}
+    assert db.child("config").get().val() == {"theme": "dark"}
+    assert revalidations(db) == [None, "etag-1"]
+    assert db.codec.decoded == 1
+    stats = db.cache.stats()
+    assert (stats["misses"], stats["revalidations"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_ttl_skips_request():
+    db, server = make_database(ttl=60)
+    db.child("config").get()
+    db.child("config").get()
+    assert len(db.requests.requests) == 1
+    assert db.cache.stats()["hits"] == 1
+
+
+def test_writes_and_invalidate_drop_entries():
+    db, server = make_database(ttl=60)
+    db.child("config").get()
+    db.child("config", "theme").set("light")
+    assert db.cache.stats()["entries"] == 0
+    db.child("config").get()
+    db.child("users").get()
+    db.cache.invalidate("users")
+    assert [entry.path for entry in db.cache.entries.values()] == ["config"]
+
+
+def test_evicts_least_recently_used():
+    db, server = make_database(max_bytes=40)
+    server.data = {"a": "x" * 15, "b": "y" * 15, "c": "z" * 15}
+    db.child("a").get()
+    db.child("b").get()
+    db.child("a").get()
+    db.child("c").get()
+    assert [entry.path for entry in db.cache.entries.values()] == ["a", "c"]
+    assert db.cache.stats()["evictions"] == 1
+
+
+def test_changed_data_counts_against_hit_rate():
+    db, server = make_database()
+    db.child("config").get()
+    server.data["config"] = {"theme": "light"}
+    server.etags["config"] = "etag-2"
+    assert db.child("config").get().val() == {"theme": "light"}
+    db.child("config").get()
+    stats = db.cache.stats()
+    assert (stats["misses"], stats["stale"], stats["revalidations"]) == (1, 1, 1)
+    assert stats["hit_rate"] == pytest.approx(1 / 3.0)
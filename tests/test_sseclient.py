@@ -0,0 +1,112 @@
+import pytest
+
+from sseclient import SSEClient
+from sseclient.sseclient import EventBuffer
+
+
+class FakeRaw:
+    chunked = True
+
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.raw = FakeRaw()
+
+    def iter_content(self, chunk_size=1):
+        return iter(self.chunks)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def get(self, url, stream=False, **kwargs):
+        return FakeResponse(self.chunks)
+
+
+def make_client(chunks):
+    return SSEClient("http://localhost/", session=FakeSession(chunks), build_headers=lambda: {})
+
+
+class TestEventBuffer:
+    def test_incomplete_event(self):
+        buf = EventBuffer()
+        buf.feed(b'event: put\ndata: 1\n')
+        assert buf.next_event() is None
+
+    def test_terminator_split_across_chunks(self):
+        buf = EventBuffer()
+        buf.feed(b'data: 1\r\n\r')
+        assert buf.next_event() is None
+        buf.feed(b'\ndata: 2')
+        assert buf.next_event() == 'data: 1'
+        assert buf.next_event() is None
+
+    def test_several_events_in_one_chunk(self):
+        buf = EventBuffer()
+        buf.feed(b'data: 1\n\ndata: 2\n\ndata: 3')
+        assert buf.next_event() == 'data: 1'
+        assert buf.next_event() == 'data: 2'
+        assert buf.next_event() is None
+        assert len(buf) == len(b'data: 3')
+
+    def test_multibyte_character_split_across_chunks(self):
+        encoded = u'data: "été"\n\n'.encode('utf-8')
+        buf = EventBuffer()
+        buf.feed(encoded[:8])
+        assert buf.next_event() is None
+        buf.feed(encoded[8:])
+        assert buf.next_event() == u'data: "été"'
+
+
+class TestSSEClient:
+    def test_parses_events_from_chunks(self):
+        client = make_client([b'event: put\nda', b'ta: {"path": "/"}\n\nevent: patch\ndata: 2\n\n'])
+        first = next(client)
+        second = next(client)
+        assert (first.event, first.data) == ('put', '{"path": "/"}')
+        assert (second.event, second.data) == ('patch', '2')
+
+    def test_skips_null_events(self):
+        client = make_client([b'event: keep-alive\ndata: null\n\n'])
+        assert next(client) is None
+
+    @pytest.mark.parametrize('size', [100, 100000])
+    def test_large_event(self, size):
+        payload = b'x' * size
+        event = b'event: put\ndata: ' + payload + b'\n\n'
+        chunks = [event[i:i + 1000] for i in range(0, len(event), 1000)]
+        assert next(make_client(chunks)).data == payload.decode('utf-8')
+
+
+class TestStreamedEvents:
+    body = (b'event: put\ndata: {"path": "/", "data": {"a": 1}}\nid: 7\n\n'
+            b'event: keep-alive\ndata: null\n\n'
+            b'event: patch\ndata: {"path": "/", "data": {"b": 2}}\n\n')
+
+    @pytest.mark.parametrize('size', [1, 5, 1000])
+    def test_streams_data_of_selected_events(self, size):
+        chunks = [self.body[i:i + size] for i in range(0, len(self.body), size)]
+        client = SSEClient("http://localhost/", session=FakeSession(chunks), build_headers=lambda: {},
+                           stream_events=('put',))
+        put = next(client)
+        assert put.event == 'put'
+        # events that arrived in full are returned with their data as usual
+        data = b''.join(put.data_stream) if put.data_stream else put.data.encode('utf-8')
+        assert data == b'{"path": "/", "data": {"a": 1}}'
+        assert next(client) is None
+        patch = next(client)
+        assert (patch.event, patch.data_stream) == ('patch', None)
+        assert client.last_id == '7'
+
+    def test_unread_data_is_skipped(self):
+        chunks = [self.body[i:i + 3] for i in range(0, len(self.body), 3)]
+        client = SSEClient("http://localhost/", session=FakeSession(chunks), build_headers=lambda: {},
+                           stream_events=('put',))
+        next(next(client).data_stream)
+        assert next(client) is None
+        assert next(client).data == '{"path": "/", "data": {"b": 2}}'
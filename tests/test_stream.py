@@ -0,0 +1,207 @@
+import json
+import threading
+import time
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from pyrebase.pyrebase import ChunkedDecoder, StreamData, StreamManager
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestStreamData:
+    payload = {
+        "path": "/users",
+        "data": {
+            "a": {"name": "Morty", "tags": ["x", {"y": "}]\"\\"}]},
+            "b": "été",
+            "c": None,
+            "d": 1.5e3,
+            "e": True,
+        },
+    }
+
+    @pytest.mark.parametrize('size', [1, 7, 100000])
+    def test_yields_children(self, size):
+        stream_data = StreamData(chunked(json.dumps(self.payload).encode("utf-8"), size))
+        assert stream_data.path == "/users"
+        children = list(stream_data)
+        assert [key for _, key, _ in children] == ["a", "b", "c", "d", "e"]
+        assert dict((key, value) for _, key, value in children) == self.payload["data"]
+        assert all(path == "/users" for path, _, _ in children)
+
+    def test_list_data(self):
+        stream_data = StreamData([b'{"path": "/", "data": [null, 1]}'])
+        assert list(stream_data) == [("/", 0, None), ("/", 1, 1)]
+
+    def test_primitive_data(self):
+        assert list(StreamData([b'{"path": "/a", "data": "b"}'])) == [("/a", None, "b")]
+
+    def test_data_before_path(self):
+        stream_data = StreamData([b'{"data": {"a": 1}, "path": "/"}'])
+        assert stream_data.path == "/"
+        assert list(stream_data) == [("/", "a", 1)]
+
+    def test_truncated_data(self):
+        with pytest.raises(ValueError):
+            list(StreamData([b'{"path": "/", "data": {"a": [1, 2']))
+
+
+class TestChunkedDecoder:
+    body = b'4;ext=1\r\nWiki\r\n5\r\npedia\r\nE\r\n in\r\n\r\nchunks.\r\n0\r\n\r\n'
+
+    @pytest.mark.parametrize('size', [1, 3, 1000])
+    def test_decodes_body(self, size):
+        decoder = ChunkedDecoder()
+        decoded = b''.join(decoder.feed(chunk) for chunk in chunked(self.body, size))
+        assert decoded == b'Wikipedia in\r\n\r\nchunks.'
+        assert decoder.done
+
+
+class EventServer(ThreadingMixIn, HTTPServer):
+    """ Serves event streams, each connection answered by the next function of connections. """
+    daemon_threads = True
+
+    def __init__(self, connections):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), EventHandler)
+        self.connections = list(connections)
+        self.requests = []
+        self.stop = threading.Event()
+        threading.Thread(target=self.serve_forever).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # clients closing their streams reset the connection
+        pass
+
+    def close(self):
+        self.stop.set()
+        self.shutdown()
+        self.server_close()
+
+
+class EventHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Last-Event-ID")))
+        self.server.connections.pop(0)(self)
+
+    def redirect(self, path):
+        self.send_response(307)
+        self.send_header("Location", self.server.url + path)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_event(self, event_id, data):
+        event = "retry: 10\nid: {0}\nevent: put\ndata: {1}\n\n".format(
+            event_id, json.dumps({"path": "/", "data": data})).encode("utf-8")
+        self.wfile.write("{0:x}\r\n".format(len(event)).encode("ascii") + event + b"\r\n")
+        self.wfile.flush()
+
+    def end_events(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+class TestStreamManager:
+    def test_redirect_and_reconnect(self):
+        def first(handler):
+            handler.start_events()
+            handler.send_event(1, "a")
+            handler.send_event(2, "b")
+            handler.end_events()
+
+        def second(handler):
+            handler.start_events()
+            handler.send_event(3, "c")
+            handler.server.stop.wait()
+            handler.end_events()
+
+        server = EventServer([lambda handler: handler.redirect("/events.json"), first, second])
+        manager = StreamManager(max_workers=2)
+        received = []
+        try:
+            stream = manager.stream(server.url + "/start.json", received.append, lambda: {}, stream_id="s")
+            wait_for(lambda: len(received) == 3)
+            stream.close()
+        finally:
+            server.close()
+            manager.close()
+        assert [(msg["event"], msg["data"], msg["stream_id"]) for msg in received] == [
+            ("put", "a", "s"), ("put", "b", "s"), ("put", "c", "s")]
+        # the reconnect goes to the stream's own url and resumes after the last event
+        assert server.requests == [("/start.json", None), ("/events.json", None), ("/start.json", "2")]
+        metrics = manager.metrics()
+        assert metrics["events"] == 3
+        assert metrics["reconnects"] == 1
+        assert metrics["handler_calls"] == 3
+        assert metrics["queue_depth"] == 0
+        assert metrics["streams"] == 0
+
+    def test_reading_pauses_while_handlers_catch_up(self):
+        more = threading.Event()
+
+        def events(handler):
+            handler.start_events()
+            for i in range(10):
+                handler.send_event(i, i)
+            more.wait(5)
+            for i in range(10, 20):
+                handler.send_event(i, i)
+            handler.server.stop.wait()
+            handler.end_events()
+
+        server = EventServer([events])
+        manager = StreamManager(max_workers=1, max_pending=4)
+        gate = threading.Event()
+        received = []
+
+        def handler(msg):
+            gate.wait(5)
+            received.append(msg["data"])
+
+        try:
+            stream = manager.stream(server.url + "/events.json", handler, lambda: {})
+            wait_for(lambda: stream.paused)
+            assert manager.metrics()["queue_depth"] >= 4
+            gate.set()
+            wait_for(lambda: len(received) == 10)
+            wait_for(lambda: not stream.paused)
+            more.set()
+            wait_for(lambda: len(received) == 20)
+            stream.close()
+        finally:
+            more.set()
+            server.close()
+            manager.close()
+        assert received == list(range(20))
+        assert manager.metrics()["events"] == 20
@@ -0,0 +1,59 @@
+import collections
+import threading
+import time
+
+from pyrebase.pyrebase import AccessTokenCache
+
+AccessTokenInfo = collections.namedtuple('AccessTokenInfo', 'access_token expires_in')
+
+
+class FakeCredentials:
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.calls = 0
+
+    def get_access_token(self):
+        time.sleep(0.01)
+        self.calls += 1
+        return AccessTokenInfo('token_%d' % self.calls, self.expires_in)
+
+
+def test_concurrent_callers_share_one_refresh():
+    credentials = FakeCredentials()
+    cache = AccessTokenCache(credentials, background=False)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(cache.get_access_token())) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert credentials.calls == 1
+    assert set(tokens) == {'token_1'}
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hits'] == 49
+
+
+def test_expired_token_is_refreshed():
+    credentials = FakeCredentials(expires_in=30)
+    cache = AccessTokenCache(credentials, refresh_margin=0, background=False)
+    assert cache.get_access_token() == 'token_1'
+    # within the expiry skew, so fetched again
+    assert cache.get_access_token() == 'token_2'
+
+
+def test_counters_add_up_under_concurrency():
+    cache = AccessTokenCache(FakeCredentials(), background=False)
+    cache.get_access_token()
+
+    def get_tokens():
+        for _ in range(2000):
+            cache.get_access_token()
+
+    threads = [threading.Thread(target=get_tokens) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 40000
@@ -0,0 +1,51 @@
+import datetime
+
+import pytest
+from requests.exceptions import HTTPError
+
+from tests.tools import FakeResponse, make_fake_db
+
+
+class Counter:
+    """ A counter another writer bumps before each of our first conflicts writes. """
+    def __init__(self, conflicts):
+        self.value = 0
+        self.conflicts = conflicts
+
+    def __call__(self, request):
+        if request.method == "GET":
+            assert request.headers["X-Firebase-ETag"] == "true"
+            return FakeResponse(self.value, headers={"ETag": str(self.value)})
+        if self.conflicts:
+            self.conflicts -= 1
+            self.value += 1
+        if request.headers["if-match"] != str(self.value):
+            return FakeResponse(self.value, 412, {"ETag": str(self.value)})
+        self.value = request.json
+        return FakeResponse(self.value, headers={"ETag": str(self.value)})
+
+
+def puts(db):
+    return len([request for request in db.requests.requests if request.method == "PUT"])
+
+
+def test_transaction_retries_on_conflict(monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+    db = make_fake_db(Counter(conflicts=3))
+    assert db.child("counter").transaction(lambda value: value + 1) == 4
+    assert puts(db) == 4
+
+
+def test_transaction_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda seconds: None)
+    db = make_fake_db(Counter(conflicts=10))
+    with pytest.raises(HTTPError):
+        db.child("counter").transaction(lambda value: value + 1, max_retries=2)
+    assert puts(db) == 3
+
+
+def test_json_kwargs_only_encode():
+    db = make_fake_db(Counter(conflicts=0))
+    stamp = datetime.date(2026, 1, 1)
+    assert db.child("counter").transaction(lambda value: {"count": value + 1, "at": stamp},
+                                           json_kwargs={"default": str}) == {"count": 1, "at": "2026-01-01"}
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+import requests
+
+import pyrebase
+from pyrebase.pyrebase import CircuitBreaker, CircuitOpenError, RateLimiter, RetryingAdapter, RetryPolicy
+from tests.tools import make_session
+
+
+def test_idempotent_requests_are_retried(script):
+    answers, sent = script
+    answers.extend([503, (429, {"Retry-After": "0"}), requests.exceptions.ReadTimeout("slow"), 200])
+    adapter = RetryingAdapter(RetryPolicy(max_retries=3, backoff=0.001))
+    response = make_session(adapter).put("https://example.firebaseio.com/a.json", data=b"1")
+    assert response.status_code == 200
+    assert sent == ["PUT"] * 4
+    stats = adapter.stats()
+    assert stats["retries"] == 3
+    assert stats["throttled_responses"] == 1
+    assert stats["failures"] == 2
+
+
+def test_retries_give_up(script):
+    answers, sent = script
+    answers.extend([503, 503])
+    adapter = RetryingAdapter(RetryPolicy(max_retries=1, backoff=0.001))
+    assert make_session(adapter).get("https://example.firebaseio.com/a.json").status_code == 503
+    answers.append((429, {"Retry-After": "3600"}))
+    assert make_session(adapter).get("https://example.firebaseio.com/a.json").status_code == 429
+    assert len(sent) == 3
+
+
+def test_posts_are_only_retried_when_safe(script):
+    answers, sent = script
+    session = make_session(RetryingAdapter(RetryPolicy(max_retries=3, backoff=0.001)))
+    answers.append(503)
+    assert session.post("https://example.firebaseio.com/a.json", data=b"1").status_code == 503
+    answers.extend([429, requests.exceptions.ConnectTimeout("unreachable"), 200])
+    assert session.post("https://example.firebaseio.com/a.json", data=b"1").status_code == 200
+    answers.append(requests.exceptions.ReadTimeout("slow"))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.post("https://example.firebaseio.com/a.json", data=b"1")
+    assert sent == ["POST"] * 5
+
+
+def test_streamed_bodies_are_not_retried(script):
+    answers, sent = script
+    answers.append(503)
+    session = make_session(RetryingAdapter(RetryPolicy(backoff=0.001)))
+    response = session.put("https://example.firebaseio.com/a.json", data=iter([b"1"]))
+    assert response.status_code == 503
+    assert len(sent) == 1
+
+
+def test_circuit_breaker_opens_and_recovers(script):
+    answers, sent = script
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    adapter = RetryingAdapter(None, None, breaker)
+    session = make_session(adapter)
+    answers.extend([500, requests.exceptions.ConnectionError("down")])
+    assert session.get("https://example.firebaseio.com/a.json").status_code == 500
+    with pytest.raises(requests.exceptions.ConnectionError):
+        session.get("https://example.firebaseio.com/a.json")
+    with pytest.raises(CircuitOpenError):
+        session.get("https://example.firebaseio.com/a.json")
+    assert breaker.state("example.firebaseio.com") == "open"
+    # other hosts are not affected
+    answers.append(200)
+    assert session.get("https://www.googleapis.com/a").status_code == 200
+    time.sleep(0.06)
+    assert breaker.state("example.firebaseio.com") == "half-open"
+    answers.append(200)
+    assert session.get("https://example.firebaseio.com/a.json").status_code == 200
+    assert breaker.state("example.firebaseio.com") == "closed"
+    assert adapter.stats()["rejected"] == 1
+
+
+def test_rate_limiter_is_shared_and_paused_by_429(script):
+    answers, sent = script
+    limiter = RateLimiter(100, burst=1)
+    adapter = RetryingAdapter(RetryPolicy(), limiter)
+    session = make_session(adapter)
+    answers.extend([200, 200])
+    started = time.time()
+    session.get("https://example.firebaseio.com/a.json")
+    session.get("https://example.firebaseio.com/a.json")
+    assert adapter.stats()["throttled"] == 1
+    answers.extend([(429, {"Retry-After": "0.1"}), 200])
+    session.get("https://example.firebaseio.com/a.json")
+    assert time.time() - started >= 0.1
+    assert adapter.stats()["throttled_responses"] == 1
+
+
+def test_config_keys():
+    firebase = pyrebase.initialize_app({
+        "apiKey": "key",
+        "authDomain": "example.firebaseapp.com",
+        "databaseURL": "https://example.firebaseio.com",
+        "storageBucket": "example.appspot.com",
+        "httpRetries": 5,
+        "httpRateLimit": 20,
+        "httpCircuitBreaker": 10,
+    })
+    transport = firebase.transport
+    assert isinstance(transport, RetryingAdapter)
+    assert transport.retry_policy.max_retries == 5
+    assert transport.rate_limiter.rate == 20
+    assert transport.circuit_breaker.failure_threshold == 10
+    assert firebase.requests.get_adapter("https://www.googleapis.com/") is transport
+
+
+@pytest.mark.parametrize("database_url", ["", "example.firebaseio.com"])
+def test_apps_without_a_database_url(database_url):
+    # Auth and Storage only apps leave databaseURL empty
+    firebase = pyrebase.initialize_app({
+        "apiKey": "key",
+        "authDomain": "example.firebaseapp.com",
+        "databaseURL": database_url,
+        "storageBucket": "example.appspot.com",
+    })
+    assert isinstance(firebase.transport, RetryingAdapter)
+    assert firebase.requests.get_adapter("https://www.googleapis.com/") is firebase.transport
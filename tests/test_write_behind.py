@@ -0,0 +1,122 @@
+import time
+
+import pytest
+
+from pyrebase.pyrebase import RetryPolicy, set_child
+from tests.tools import FakeResponse, make_fake_db, make_transport_db
+
+
+def make_database(status_code=200, delay=0):
+    def respond(request):
+        time.sleep(delay)
+        return FakeResponse(status_code=status_code, headers={"Retry-After": "0"})
+    return make_fake_db(respond)
+
+
+def updates(db):
+    return [(url, update) for method, url, update in db.requests.writes()]
+
+
+def test_writes_to_a_path_are_coalesced():
+    db = make_database()
+    with db.child("devices").write_behind(flush_interval=60) as queue:
+        for i in range(100):
+            queue.update("d1", {"reading": i, "seen": i})
+        queue.set("d2", {"reading": 1})
+        queue.flush()
+        assert updates(db) == [("https://example.firebaseio.com/devices.json",
+                                    {"d1/reading": 99, "d1/seen": 99, "d2": {"reading": 1}})]
+        stats = queue.stats()
+    assert stats["queued"] == 201
+    assert stats["coalesced"] == 198
+    assert stats["written"] == 3
+    assert stats["pending"] == 0
+
+
+def test_sets_replace_and_updates_merge_into_pending_paths():
+    db = make_database()
+    queue = db.write_behind(flush_interval=60)
+    queue.update("users/morty", {"name": "Morty", "age": 14})
+    queue.set("users/morty", {"name": "Mortimer"})
+    queue.update("users/morty", {"age": 15})
+    queue.remove("users/morty/name")
+    queue.set("users/rick/name", "Rick")
+    queue.close()
+    assert updates(db) == [("https://example.firebaseio.com/users.json",
+                                {"morty": {"age": 15}, "rick/name": "Rick"})]
+
+
+def test_set_child_copies():
+    tree = {"a": {"b": 1}}
+    assert set_child(tree, "a/c", 2) == {"a": {"b": 1, "c": 2}}
+    assert set_child(tree, "a/b", None) == {"a": {}}
+    assert set_child(5, "a", None) == 5
+    assert set_child(None, "a/b", 1) == {"a": {"b": 1}}
+    assert tree == {"a": {"b": 1}}
+
+
+def test_full_groups_are_sent_without_waiting_for_the_interval():
+    db = make_database()
+    queue = db.child("devices").write_behind(flush_interval=60, max_operations=10)
+    for i in range(25):
+        queue.set("d{0}".format(i), i)
+    deadline = time.time() + 5
+    while len(updates(db)) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sum(len(update) for url, update in updates(db)) >= 20
+    queue.close()
+    assert sum(len(update) for url, update in updates(db)) == 25
+    assert all(len(update) <= 10 for url, update in updates(db))
+
+
+def test_writes_are_sent_after_the_interval():
+    db = make_database()
+    queue = db.write_behind(flush_interval=0.05)
+    queue.set("a", 1)
+    deadline = time.time() + 5
+    while not updates(db) and time.time() < deadline:
+        time.sleep(0.01)
+    assert updates(db) == [("https://example.firebaseio.com/.json", {"a": 1})]
+    queue.close()
+
+
+def test_writes_are_dropped_when_full():
+    db = make_database(delay=0.2)
+    queue = db.write_behind(flush_interval=60, max_pending=2, block=False)
+    queue.set("a", 1)
+    queue.set("b", 1)
+    queue.set("c", 1)
+    queue.set("a", 2)
+    assert queue.stats()["dropped"] == 1
+    queue.close()
+    assert updates(db) == [("https://example.firebaseio.com/.json", {"a": 2, "b": 1})]
+
+
+def test_failures_are_raised_from_flush():
+    db = make_database(status_code=400)
+    queue = db.write_behind(flush_interval=60)
+    queue.set("a", 1)
+    with pytest.raises(Exception):
+        queue.flush()
+    assert queue.stats()["failed"] == 1
+    queue.flush()
+    queue.close()
+    with pytest.raises(ValueError):
+        queue.set("a", 2)
+
+
+def test_failed_updates_are_retried_by_the_transport_only(script):
+    answers, sent = script
+    db = make_transport_db(RetryPolicy(max_retries=2, backoff=0.001))
+    queue = db.write_behind(flush_interval=60)
+    answers.extend([503, 200])
+    queue.set("a", 1)
+    queue.flush()
+    answers.extend([503] * 10)
+    queue.set("a", 2)
+    with pytest.raises(Exception):
+        queue.flush()
+    queue.close()
+    assert len(sent) == 5
+    stats = queue.stats()
+    assert (stats["requests"], stats["retries"], stats["written"], stats["failed"]) == (2, 3, 1, 1)
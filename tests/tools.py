@@ -1,11 +1,149 @@
+import gzip
+import json
+import threading
+
+import requests
+from requests.exceptions import HTTPError
+
 from pyrebase import pyrebase
-from tests import config
+
+try:
+    from urllib.parse import parse_qsl, unquote, urlsplit
+except ImportError:
+    from urllib import unquote
+    from urlparse import parse_qsl, urlsplit
 
 
 def make_db(service_account=False):
+    from tests import config
+
     if service_account:
         c = config.SERVICE_CONFIG
     else:
         c = config.SIMPLE_CONFIG
 
     return pyrebase.initialize_app(c).database()
+
+
+DATABASE_URL = "https://example.firebaseio.com"
+
+
+def make_fake_db(respond=None, **kwargs):
+    """ A Database sending its requests to a FakeSession, available as db.requests. """
+    return pyrebase.Database(None, "key", DATABASE_URL, FakeSession(respond), **kwargs)
+
+
+def make_session(adapter):
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+def make_transport_db(retry_policy, **kwargs):
+    """ A Database sending its requests through a RetryingAdapter, answered by the script fixture. """
+    return pyrebase.Database(None, "key", DATABASE_URL, make_session(pyrebase.RetryingAdapter(retry_policy)), **kwargs)
+
+
+def make_response(status_code, headers={}):
+    """ A requests.Response for the script fixture. """
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    response._content = b"null"
+    response._content_consumed = True
+    return response
+
+
+class FakeResponse:
+    """ The parts of requests.Response the services use. data is sent as JSON unless it is bytes. """
+    def __init__(self, data=None, status_code=200, headers=None):
+        self.content = data if isinstance(data, bytes) else json.dumps(data).encode("utf-8")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError("{0} Error".format(self.status_code))
+
+
+class FakeRequest:
+    """ A request received by a FakeSession. """
+    def __init__(self, method, url, headers, data):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.data = data
+        parts = urlsplit(url)
+        self.path = parts.path.strip("/")
+        if self.path.endswith(".json"):
+            self.path = self.path[:-len(".json")]
+        self.params = {}
+        for name, value in parse_qsl(parts.query):
+            try:
+                self.params[name] = json.loads(unquote(value))
+            except ValueError:
+                self.params[name] = value
+
+    @property
+    def json(self):
+        """ The decoded body. """
+        data = self.data
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return json.loads(data)
+
+
+class FakeSession:
+    """
+    Records requests and answers them with respond(request), which returns
+    a FakeResponse or raises. By default every request gets a null body.
+    """
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda request: FakeResponse())
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, headers=None, data=None):
+        if data is not None and not isinstance(data, (bytes, str)):
+            data = b"".join(data)
+        request = FakeRequest(method, url, dict(headers or {}), data)
+        with self.lock:
+            self.requests.append(request)
+        return self.respond(request)
+
+    def writes(self):
+        """ (method, url, decoded body) of every request with a body. """
+        with self.lock:
+            return [(request.method, request.url, request.json) for request in self.requests
+                    if request.data is not None]
+
+    def get(self, url, headers=None, stream=False):
+        return self.request("GET", url, headers)
+
+    def put(self, url, headers=None, data=None):
+        return self.request("PUT", url, headers, data)
+
+    def patch(self, url, headers=None, data=None):
+        return self.request("PATCH", url, headers, data)
+
+    def post(self, url, headers=None, data=None):
+        return self.request("POST", url, headers, data)
+
+    def delete(self, url, headers=None):
+        return self.request("DELETE", url, headers)